@@ -0,0 +1,24 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the Shopcart Service
+
+The database is seeded with shopcarts and items made by the test
+factories, then a weighted mix of requests is driven through the WSGI app,
+with the Order Service replaced by a local stub. The latency percentiles
+and throughput of every endpoint are reported as JSON, so the reports of
+two commits can be compared.
+
+Run them from the root of the repository with:
+  python -m benchmarks --carts 10000 --requests 5000 --output report.json
+"""
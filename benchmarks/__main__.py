@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs the benchmarks of the Shopcart Service, see the benchmarks package
+
+  python -m benchmarks --help
+"""
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+import click
+from sqlalchemy import func
+from benchmarks import seed, workload
+from benchmarks.order_stub import StubOrderService
+from service import create_app
+from service.models import Shopcart, db
+
+DEFAULT_DATABASE_URI = "sqlite:///" + os.path.join(tempfile.gettempdir(),
+                                                   "shopcarts-benchmark.db")
+
+
+def current_commit():
+    """ Returns the git commit of the working tree, or None outside of git """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option("--database-uri", default=DEFAULT_DATABASE_URI, show_default=True,
+              help="Database to benchmark; DATABASE_SHARD_URIS adds shards to it.")
+@click.option("--reset", is_flag=True,
+              help="Drop and recreate the tables before seeding.")
+@click.option("--carts", type=click.IntRange(0), default=10000, show_default=True,
+              help="Number of shopcarts the database is seeded up to.")
+@click.option("--items-per-cart", type=click.IntRange(0), default=5, show_default=True,
+              help="Largest number of items in a seeded shopcart.")
+@click.option("--requests", "request_count", type=click.IntRange(1), default=5000,
+              show_default=True, help="Number of requests to send.")
+@click.option("--concurrency", type=click.IntRange(1), default=1, show_default=True,
+              help="Number of threads sending requests.")
+@click.option("--mix", default=None,
+              help="Weights of the operations, e.g. get_cart=70,add_item=30. "
+                   "Defaults to create_cart=10,add_item=30,get_cart=30,query_items=20,"
+                   "place_order=10.")
+@click.option("--order-latency-ms", type=click.FloatRange(0), default=0.0, show_default=True,
+              help="Time the stub Order Service takes to accept an order.")
+@click.option("--seed", "random_seed", type=int, default=0, show_default=True,
+              help="Seed of the random choices, for repeatable runs.")
+@click.option("--output", type=click.File("w"), default="-",
+              help="File the JSON report is written to, stdout by default.")
+def main(database_uri, reset, carts, items_per_cart, request_count, concurrency, mix,
+         order_latency_ms, random_seed, output):
+    """ Seeds the database, drives a request mix through the app and reports as JSON """
+    # pylint: disable=too-many-arguments,too-many-locals
+    try:
+        mix = workload.parse_mix(mix) if mix else dict(workload.DEFAULT_MIX)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="--mix")
+
+    stub = StubOrderService(latency=order_latency_ms / 1000).start()
+    # create_app() loads config.py, which reads the environment
+    os.environ["DATABASE_URI"] = database_uri
+    os.environ["ORDER_ENDPOINT"] = stub.endpoint
+    os.environ["ORDER_OUTBOX"] = "false"
+    with redirect_stdout(sys.stderr):  # keep stdout for the report
+        app = create_app()
+    # the request logs would be most of the work
+    logging.getLogger("service").setLevel(logging.WARNING)
+    app.logger.setLevel(logging.WARNING)
+
+    try:
+        with app.app_context():
+            if reset:
+                db.drop_all()
+            db.create_all()
+
+            existing = db.session.query(Shopcart.id).count()
+            started = time.perf_counter()
+            items = seed.seed(max(0, carts - existing), items_per_cart,
+                              rng=random.Random(random_seed))
+            seed_elapsed = time.perf_counter() - started
+            click.echo("Seeded {} shopcarts and {} items in {:.1f}s".format(
+                max(0, carts - existing), items, seed_elapsed), err=True)
+
+            cart_ids = [row.id for row in db.session.query(Shopcart.id)]
+            # one row per shard
+            last_user_id = max(row[0] or 0 for row in
+                               db.session.query(func.max(Shopcart.user_id)).all())
+            db.session.remove()
+
+        pool = workload.CartPool(cart_ids, last_user_id)
+        report = {
+            "commit": current_commit(),
+            "database": db.get_engine(app).dialect.name,
+            "shards": len(db.get_shard_engines(app)),
+            "carts": len(pool),
+            "concurrency": concurrency,
+            "mix": mix,
+            "order_latency_ms": order_latency_ms,
+            "seed_sec": round(seed_elapsed, 3),
+        }
+        report.update(workload.run(app, pool, mix, request_count, concurrency, random_seed))
+        report["orders_received"] = stub.orders
+    finally:
+        stub.stop()
+
+    json.dump(report, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,80 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local stand-in for the Order Service
+
+It accepts every order with 201 Created, after an optional delay that
+plays the part of the latency of the real service.
+"""
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubOrderService:
+    """ Accepts the orders posted to it on a local port """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.orders = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        """ The URL the orders are posted to """
+        return "http://127.0.0.1:{}/orders".format(self._server.server_address[1])
+
+    def start(self):
+        """ Serves the orders from a background thread """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops serving and closes the port """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _handler(self):
+        stub = self
+
+        class OrderHandler(BaseHTTPRequestHandler):
+            """ Answers every POST with 201 Created """
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """ Accepts an order """
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                with stub._lock:  # pylint: disable=protected-access
+                    stub.orders += 1
+                body = b"{}"
+                self.send_response(201)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        return OrderHandler
@@ -0,0 +1,91 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bulk loading of benchmark data
+
+The shopcarts and items are made by the test factories, and inserted in
+batches with executemany() on the shard of each shopcart, since going
+through the session would take hours for a million shopcarts. The ids are
+picked here, so that each one lands on its shard, and the PostgreSQL
+sequences are moved past them afterwards.
+"""
+import random
+from datetime import datetime
+from sqlalchemy import func, select
+from service import migrations
+from service.models import Shopcart, ShopcartItem, db
+from service.sharding import ShardMap
+from tests.shopcart_factory import ShopcartFactory, ShopcartItemFactory
+
+SEED_BATCH_SIZE = 5000
+
+
+def seed(carts, items_per_cart, batch_size=SEED_BATCH_SIZE, rng=random):
+    """ Adds shopcarts to the database, each with up to items_per_cart items
+    :param carts: the number of shopcarts to add
+    :type carts: int
+    :param items_per_cart: the largest number of items in a shopcart
+    :type items_per_cart: int
+    :param batch_size: the number of shopcarts inserted per transaction
+    :type batch_size: int
+
+    :return: the number of items added
+    :rtype: int
+    """
+    engines = db.get_shard_engines()
+    shards = ShardMap(len(engines))
+    last_ids = {
+        model: [engine.execute(select([func.max(model.id)])).scalar() or 0
+                for engine in engines]
+        for model in (Shopcart, ShopcartItem)
+    }
+    last_user_id = max(engine.execute(select([func.max(Shopcart.user_id)])).scalar() or 0
+                       for engine in engines)
+
+    def next_id(model, shard):
+        last_ids[model][shard] = shards.next_id(max(last_ids[model]), shard)
+        return last_ids[model][shard]
+
+    items = 0
+    for start in range(0, carts, batch_size):
+        now = datetime.utcnow()
+        rows = [([], []) for _ in engines]
+        for user_id in range(last_user_id + start + 1,
+                             last_user_id + min(start + batch_size, carts) + 1):
+            shard = shards.for_user(user_id)
+            shopcart = ShopcartFactory.build(id=next_id(Shopcart, shard), user_id=user_id,
+                                             version=1)
+            shopcart.create_time = shopcart.update_time = now
+            rows[shard][0].append(shopcart.serialize())
+
+            skus = set()
+            for _ in range(rng.randint(0, items_per_cart)):
+                shopcart_item = ShopcartItemFactory.build(sid=shopcart.id, version=1)
+                if shopcart_item.sku in skus:
+                    continue
+                skus.add(shopcart_item.sku)
+                shopcart_item.id = next_id(ShopcartItem, shard)
+                shopcart_item.create_time = shopcart_item.update_time = now
+                rows[shard][1].append(shopcart_item.serialize())
+
+        for engine, (shopcart_rows, item_rows) in zip(engines, rows):
+            with engine.begin() as conn:
+                if shopcart_rows:
+                    conn.execute(Shopcart.__table__.insert(), shopcart_rows)
+                if item_rows:
+                    conn.execute(ShopcartItem.__table__.insert(), item_rows)
+            items += len(item_rows)
+
+    for shard, engine in enumerate(engines):
+        migrations.restart_sequences(engine, shard, len(engines))
+    return items
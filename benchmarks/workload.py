@@ -0,0 +1,244 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The request mix of the benchmarks
+
+Every operation picks a shopcart from a shared pool and returns the
+request to send. Only the time spent by the WSGI app on the request is
+measured, not the time taken to build it.
+"""
+import math
+import random
+import threading
+import time
+from collections import Counter
+from tests.shopcart_factory import ShopcartItemFactory
+
+# The relative weight of each operation in the default mix
+DEFAULT_MIX = {
+    "create_cart": 10,
+    "add_item": 30,
+    "get_cart": 30,
+    "query_items": 20,
+    "place_order": 10,
+}
+
+ENDPOINTS = {
+    "create_cart": "POST /api/shopcarts",
+    "add_item": "POST /api/shopcarts/{id}/items",
+    "get_cart": "GET /api/shopcarts/{id}",
+    "query_items": "GET /api/shopcarts/items?sku=&limit=",
+    "place_order": "PUT /api/shopcarts/{id}/place-order",
+}
+
+QUERY_PAGE_SIZE = 100
+PERCENTILES = (50, 95, 99)
+
+
+class CartPool:
+    """ The ids of the shopcarts the requests work on, shared by every worker """
+
+    def __init__(self, cart_ids, last_user_id):
+        self._cart_ids = list(cart_ids)
+        self._last_user_id = last_user_id
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cart_ids)
+
+    def add(self, cart_id):
+        """ Adds a new shopcart to the pool """
+        with self._lock:
+            self._cart_ids.append(cart_id)
+
+    def pick(self, rng):
+        """ Returns a random shopcart, or None if the pool is empty """
+        with self._lock:
+            return rng.choice(self._cart_ids) if self._cart_ids else None
+
+    def take(self, rng):
+        """ Removes a random shopcart from the pool and returns it, or None """
+        with self._lock:
+            if not self._cart_ids:
+                return None
+            index = rng.randrange(len(self._cart_ids))
+            self._cart_ids[index], self._cart_ids[-1] = self._cart_ids[-1], self._cart_ids[index]
+            return self._cart_ids.pop()
+
+    def next_user_id(self):
+        """ Returns a user that has no shopcart yet """
+        with self._lock:
+            self._last_user_id += 1
+            return self._last_user_id
+
+
+def create_cart(pool, rng):  # pylint: disable=unused-argument
+    """ Creates a shopcart for a new user """
+    def created(resp):
+        if resp.status_code == 201:
+            pool.add(resp.get_json()["id"])
+    return "POST", "/api/shopcarts", {"user_id": pool.next_user_id()}, created
+
+
+def add_item(pool, rng):
+    """ Adds an item made by the factory to a shopcart """
+    cart_id = pool.pick(rng)
+    if cart_id is None:
+        return None
+    shopcart_item = ShopcartItemFactory.build()
+    body = {"sku": shopcart_item.sku, "name": shopcart_item.name,
+            "price": shopcart_item.price, "amount": shopcart_item.amount}
+    return "POST", "/api/shopcarts/{}/items".format(cart_id), body, None
+
+
+def get_cart(pool, rng):
+    """ Reads a shopcart with its items """
+    cart_id = pool.pick(rng)
+    if cart_id is None:
+        return None
+    return "GET", "/api/shopcarts/{}".format(cart_id), None, None
+
+
+def query_items(pool, rng):  # pylint: disable=unused-argument
+    """ Reads the first page of the items with a sku """
+    sku = ShopcartItemFactory.build().sku
+    url = "/api/shopcarts/items?sku={}&limit={}".format(sku, QUERY_PAGE_SIZE)
+    return "GET", url, None, None
+
+
+def place_order(pool, rng):
+    """ Places the order of a shopcart, which deletes it """
+    cart_id = pool.take(rng)
+    if cart_id is None:
+        return None
+    return "PUT", "/api/shopcarts/{}/place-order".format(cart_id), None, None
+
+
+OPERATIONS = {
+    "create_cart": create_cart,
+    "add_item": add_item,
+    "get_cart": get_cart,
+    "query_items": query_items,
+    "place_order": place_order,
+}
+
+
+def parse_mix(text):
+    """ Parses a mix like "get_cart=70,add_item=30" into weights by operation """
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation {}, pick from {}".format(
+                name, ", ".join(OPERATIONS)))
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise ValueError("The weight of {} must be a number".format(name)) from None
+        if mix[name] < 0:
+            raise ValueError("The weight of {} must not be negative".format(name))
+    if not any(mix.values()):
+        raise ValueError("At least one operation needs a positive weight")
+    return mix
+
+
+def run(app, pool, mix, requests, concurrency=1, random_seed=0):
+    """ Sends requests, picked by the weights of the mix, through the WSGI app
+    :param app: the Flask app
+    :param pool: the shopcarts to work on
+    :type pool: CartPool
+    :param mix: the weight of each operation
+    :type mix: dict
+    :param requests: the number of requests to send
+    :type requests: int
+    :param concurrency: the number of threads sending requests
+    :type concurrency: int
+
+    :return: the report of the run
+    :rtype: dict
+    """
+    names = [name for name, weight in mix.items() if weight > 0]
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    statuses = {name: Counter() for name in names}
+    lock = threading.Lock()
+
+    def work(worker, count):
+        rng = random.Random(random_seed * 1000 + worker)
+        client = app.test_client()
+        local_latencies = {name: [] for name in names}
+        local_statuses = {name: Counter() for name in names}
+        for name in rng.choices(names, weights, k=count):
+            request = OPERATIONS[name](pool, rng)
+            if request is None:
+                # the pool ran dry, so fill it up again
+                name = "create_cart"
+                request = create_cart(pool, rng)
+                local_latencies.setdefault(name, [])
+                local_statuses.setdefault(name, Counter())
+            method, url, body, callback = request
+            started = time.perf_counter()
+            resp = client.open(url, method=method, json=body)
+            local_latencies[name].append(time.perf_counter() - started)
+            local_statuses[name][resp.status_code] += 1
+            if callback is not None:
+                callback(resp)
+        with lock:
+            for name, values in local_latencies.items():
+                latencies.setdefault(name, []).extend(values)
+                statuses.setdefault(name, Counter()).update(local_statuses[name])
+
+    counts = [requests // concurrency + (1 if worker < requests % concurrency else 0)
+              for worker in range(concurrency)]
+    threads = [threading.Thread(target=work, args=(worker, count))
+               for worker, count in enumerate(counts)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": sum(len(values) for values in latencies.values()),
+        "elapsed_sec": round(elapsed, 3),
+        "requests_per_sec": round(requests / elapsed, 1) if elapsed else None,
+        "endpoints": {
+            name: summarize(ENDPOINTS[name], latencies[name], statuses[name], elapsed)
+            for name in sorted(latencies) if latencies[name]
+        },
+    }
+
+
+def summarize(endpoint, latencies, statuses, elapsed):
+    """ Returns the throughput, status codes and latency percentiles of an endpoint """
+    latencies = sorted(latencies)
+    summary = {
+        "endpoint": endpoint,
+        "requests": len(latencies),
+        "requests_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "latency_ms": {
+            "p{}".format(rank): round(percentile(latencies, rank) * 1000, 3)
+            for rank in PERCENTILES
+        },
+    }
+    summary["latency_ms"]["mean"] = round(sum(latencies) / len(latencies) * 1000, 3)
+    summary["latency_ms"]["max"] = round(latencies[-1] * 1000, 3)
+    return summary
+
+
+def percentile(values, rank):
+    """ Returns the nearest-rank percentile of a sorted list """
+    return values[max(0, math.ceil(rank / 100 * len(values)) - 1)]
@@ -17,3 +17,107 @@ if 'VCAP_SERVICES' in os.environ:
     DATABASE_URI = vcap['user-provided'][0]['credentials']['url']
 
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
+
+# GET requests read from DATABASE_REPLICA_URI, a streaming replica of the
+# database, when it is set. Writes, and the reads that follow them in the
+# same request, always go to DATABASE_URI
+DATABASE_REPLICA_URI = os.getenv("DATABASE_REPLICA_URI")
+SQLALCHEMY_BINDS = {"replica": DATABASE_REPLICA_URI} if DATABASE_REPLICA_URI else {}
+
+# Shopcarts are spread over several databases by a hash of their user_id
+# when DATABASE_SHARD_URIS lists the databases besides DATABASE_URI, which
+# is shard 0. The number of shards must not change once carts are stored,
+# since every id encodes the shard it lives in
+DATABASE_SHARD_URIS = [uri for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri]
+SQLALCHEMY_BINDS.update({
+    "shard{}".format(shard): uri for shard, uri in enumerate(DATABASE_SHARD_URIS, start=1)
+})
+
+# Connection pool of each gunicorn worker. Every worker keeps up to
+# DB_POOL_SIZE + DB_MAX_OVERFLOW connections to each database (the primary,
+# every shard and the replica), and WEB_CONCURRENCY workers (see
+# gunicorn.conf.py, which exports the counts it uses) must fit in the
+# DB_MAX_CONNECTIONS the databases allow us
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", "1"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+# 0 means no statement timeout. gunicorn.conf.py sets one for the web
+# workers only, so the command line tasks, like db-upgrade and purge-carts,
+# are never cancelled halfway
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "100"))
+
+SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": DB_POOL_PRE_PING}
+if DATABASE_URI.startswith("postgres"):
+    # SQLite, used by some test runs, has no queue pool and no statement timeout
+    SQLALCHEMY_ENGINE_OPTIONS.update({
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE
+    })
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        SQLALCHEMY_ENGINE_OPTIONS["connect_args"] = {
+            "options": "-c statement_timeout={}".format(DB_STATEMENT_TIMEOUT_MS)
+        }
+
+# Abandoned shopcarts are purged by `flask purge-carts` once neither the
+# shopcart nor any of its items has been updated for CART_TTL_HOURS
+CART_TTL_HOURS = float(os.getenv("CART_TTL_HOURS", "720"))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "500"))
+PURGE_SLEEP_SECONDS = float(os.getenv("PURGE_SLEEP_SECONDS", "0.1"))
+
+# With INSTRUMENTATION=true every response has a Server-Timing header with
+# the number of SQL statements of the request and the time spent in the
+# database, on serialization and in the Order Service. Requests that run
+# more than QUERY_BUDGET statements are logged as warnings
+INSTRUMENTATION = os.getenv("INSTRUMENTATION", "false").lower() in ("true", "1", "yes")
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "10"))
+
+# GET /shopcarts/{id} is served from a read-through cache, without a query
+# while the copy is current. "redis" keeps the shopcarts for
+# SHOPCART_CACHE_TTL seconds on the Redis server at REDIS_URL, shared by every
+# worker, "memory" keeps up to SHOPCART_CACHE_SIZE shopcarts in the worker
+# and "none" turns the cache off. The writes of a worker only reach the
+# memory cache of that worker, so it is only the default for a single one
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SHOPCART_CACHE_BACKEND = os.getenv("SHOPCART_CACHE_BACKEND",
+                                   "memory" if WEB_CONCURRENCY == 1 else "redis")
+SHOPCART_CACHE_SIZE = int(os.getenv("SHOPCART_CACHE_SIZE", "1024"))
+SHOPCART_CACHE_TTL = float(os.getenv("SHOPCART_CACHE_TTL", "30"))
+
+# The writes that are not idempotent accept an Idempotency-Key header. The
+# response to a key is replayed to the retries of the request until
+# `flask purge-idempotency-keys` deletes it, IDEMPOTENCY_TTL seconds later.
+# "database" keeps the keys in a table of the primary, shared by every worker,
+# "memory" keeps up to IDEMPOTENCY_SIZE keys in the worker, for tests and
+# single process runs only, and "none" turns the keys off
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "database")
+IDEMPOTENCY_SIZE = int(os.getenv("IDEMPOTENCY_SIZE", "10000"))
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+
+# Orders are posted to the Order Service through a pooled HTTP session.
+# Only connection failures and 503 responses are retried, since the order
+# service may already have processed a request that timed out while reading
+ORDER_ENDPOINT = os.getenv(
+    "ORDER_ENDPOINT", "https://nyu-order-service-f20.us-south.cf.appdomain.cloud/orders"
+)
+ORDER_CONNECT_TIMEOUT = float(os.getenv("ORDER_CONNECT_TIMEOUT", "3.05"))
+ORDER_READ_TIMEOUT = float(os.getenv("ORDER_READ_TIMEOUT", "10"))
+ORDER_RETRIES = int(os.getenv("ORDER_RETRIES", "3"))
+ORDER_RETRY_BACKOFF = float(os.getenv("ORDER_RETRY_BACKOFF", "0.3"))
+ORDER_POOL_SIZE = int(os.getenv("ORDER_POOL_SIZE", "10"))
+
+# With ORDER_OUTBOX=true placing an order only stores it in the order_outbox
+# table, and `flask dispatch-orders` posts it to the Order Service
+ORDER_OUTBOX = os.getenv("ORDER_OUTBOX", "false").lower() in ("true", "1", "yes")
+ORDER_OUTBOX_BATCH_SIZE = int(os.getenv("ORDER_OUTBOX_BATCH_SIZE", "50"))
+ORDER_OUTBOX_POLL_SECONDS = float(os.getenv("ORDER_OUTBOX_POLL_SECONDS", "1"))
+ORDER_OUTBOX_RETRY_SECONDS = float(os.getenv("ORDER_OUTBOX_RETRY_SECONDS", "5"))
+ORDER_OUTBOX_MAX_RETRY_SECONDS = float(os.getenv("ORDER_OUTBOX_MAX_RETRY_SECONDS", "3600"))
+# An order that fails this many times is marked failed and no longer sent
+ORDER_OUTBOX_MAX_ATTEMPTS = int(os.getenv("ORDER_OUTBOX_MAX_ATTEMPTS", "20"))
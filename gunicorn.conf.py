@@ -0,0 +1,88 @@
+"""
+Gunicorn configuration for the Shopcart Service
+
+Every setting can be overridden with an environment variable:
+
+WEB_CONCURRENCY - worker processes, by default 2 per CPU plus 1, at most
+                  GUNICORN_MAX_WORKERS (4)
+GUNICORN_WORKER_CLASS - gthread (default) or gevent for I/O bound traffic
+GUNICORN_THREADS - threads per gthread worker (4)
+GUNICORN_WORKER_CONNECTIONS - concurrent requests per gevent worker (100)
+GUNICORN_MAX_REQUESTS - requests after which a worker is replaced (1000)
+GUNICORN_PRELOAD - load the app once in the master before forking (true,
+                   but false for gevent)
+WEB_STATEMENT_TIMEOUT_MS - PostgreSQL statement_timeout of the workers (30000)
+
+The worker and thread counts are exported back to the environment, so the
+connection pool check of the service sees the concurrency actually used.
+The statement timeout is exported as DB_STATEMENT_TIMEOUT_MS, which only
+the web workers get: the command line tasks run without one.
+"""
+import os
+import sys
+import logging
+
+
+def _cpu_count():
+    """ Returns the number of CPUs this process may run on """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = "0.0.0.0:{}".format(os.getenv("PORT", "8080"))
+
+workers = int(os.getenv(
+    "WEB_CONCURRENCY",
+    min(2 * _cpu_count() + 1, int(os.getenv("GUNICORN_MAX_WORKERS", "4")))
+))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+
+# replace workers now and then so that leaks cannot build up, and add jitter
+# so that the workers are not all replaced at the same time
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", str(max_requests // 10)))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# gevent has to patch the standard library before the app is imported
+preload_app = os.getenv(
+    "GUNICORN_PRELOAD", "false" if worker_class == "gevent" else "true"
+).lower() in ("true", "1", "yes")
+
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+os.environ["WEB_CONCURRENCY"] = str(workers)
+os.environ["GUNICORN_THREADS"] = str(worker_connections if worker_class == "gevent" else threads)
+os.environ["DB_STATEMENT_TIMEOUT_MS"] = os.getenv("WEB_STATEMENT_TIMEOUT_MS", "30000")
+
+
+def pre_fork(server, worker):  # pylint: disable=unused-argument
+    """ Closes any connection the master opened while preloading the app
+    Loading the app does no database I/O, but a forked worker would otherwise
+    share the sockets of such connections with the master and every other worker.
+    """
+    models = sys.modules.get("service.models")
+    if models is not None and server.cfg.preload_app:
+        for engine in models.db.get_engines(server.app.wsgi()):
+            engine.dispose()
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """ Makes psycopg2 cooperative in gevent workers """
+    if worker_class != "gevent":
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        logging.getLogger("gunicorn.error").warning(
+            "psycogreen is not installed, database calls will block the gevent workers"
+        )
+        return
+    patch_psycopg()
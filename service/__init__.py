@@ -15,36 +15,62 @@
 
 """
 Package for the application models and service routes
+
+The app is built by create_app(), which does no database I/O, so starting
+a worker is cheap. The tables are created beforehand by `flask init-db`.
 """
 import logging
 from flask import Flask
+from service import routes, commands, instrumentation
+from service.cache import shopcart_cache
+from service.idempotency import idempotency_store
+from service.models import init_db, init_unit_of_work, check_pool_capacity
+from service.orders import order_client
+
 
-# NOTE: Do not change the order of this code
-# The Flask app must be created
-# BEFORE you import modules that depend on it !!!
+def create_app(config="config"):
+    """ Creates the Flask app of the Shopcart Service
+    :param config: the configuration object or the name of its module
+    :type config: str
 
-# Create the Flask aoo
-app = Flask(__name__)
+    :return: the Flask app
+    :rtype: Flask
+    """
+    app = Flask(__name__)
 
-# Load Configurations
-app.config.from_object('config')
+    # Load Configurations
+    app.config.from_object(config)
 
-# Import the routes After the Flask app is created
-from service import routes
+    init_db(app)
+    check_pool_capacity(app.config)
+    shopcart_cache.init_app(app)
+    order_client.init_app(app)
+    instrumentation.init_app(app)
+    # The hooks run in the reverse order: the response is stored for its
+    # idempotency key, then the request is committed, then the timings are sent
+    init_unit_of_work(app)
+    idempotency_store.init_app(app)
+    app.register_blueprint(routes.blueprint)
 
-# Set up logging for production
-app.logger.propagate = False
-print('Setting up logging for {}...'.format(__name__))
-if __name__ != '__main__':
-    gunicorn_logger = logging.getLogger('gunicorn.error')
-    if gunicorn_logger:
-        app.logger.handlers = gunicorn_logger.handlers
-        app.logger.setLevel(gunicorn_logger.level)
+    # Register the command line tasks
+    app.cli.add_command(commands.init_db_command)
+    app.cli.add_command(commands.db_upgrade_command)
+    app.cli.add_command(commands.purge_carts_command)
+    app.cli.add_command(commands.purge_idempotency_keys_command)
+    app.cli.add_command(commands.dispatch_orders_command)
 
-app.logger.info(70 * '*')
-app.logger.info('  S H O P C A R T   S E R V I C E   R U N N I N G  '.center(70, '*'))
-app.logger.info(70 * '*')
+    # Set up logging for production
+    app.logger.propagate = False
+    print('Setting up logging for {}...'.format(__name__))
+    if __name__ != '__main__':
+        gunicorn_logger = logging.getLogger('gunicorn.error')
+        if gunicorn_logger:
+            app.logger.handlers = gunicorn_logger.handlers
+            app.logger.setLevel(gunicorn_logger.level)
 
-routes.init_db()
+    app.logger.info(70 * '*')
+    app.logger.info('  S H O P C A R T   S E R V I C E   R U N N I N G  '.center(70, '*'))
+    app.logger.info(70 * '*')
 
-app.logger.info('Service initialized!')
+    app.logger.info('Service initialized!')
+    return app
@@ -0,0 +1,304 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Read-through cache for serialized Shopcarts
+
+The cache holds the dictionary built by Shopcart.serialize_with_items()
+for each shopcart id, with the entity tag it was read at, and serves it
+without going to the database. Next to every entry the cache keeps the
+generation of its shopcart, a random token that every model method that
+writes the shopcart or its items replaces once its change is committed.
+An entry is stored with the generation read before the shopcart was, and
+is only served while that is still the current generation, so a copy
+read before a concurrent write commits is never served after it.
+
+Backends
+--------
+RedisCache - a Redis server shared by every worker, entries expire after a TTL
+LRUCache - in-process store bounded by size, entries expire after a TTL
+NullCache - stores nothing, turns caching off
+
+The in-process store is private to each worker process, so the writes of
+one worker do not reach the copies of the others: it is only meant for a
+single worker. The idempotency keys can be kept by the same backends, in
+tests, besides the table of the database they use in production.
+"""
+import logging
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend:
+    """
+    Interface of a key/value store for the cache
+    Values are plain dictionaries, so a remote store only has to pickle them
+    """
+
+    # The writes of a transactional backend are committed or rolled back
+    # with the changes of the request
+    transactional = False
+
+    def get(self, key):
+        """ Returns the value stored for a key, or None """
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """ Returns the values stored for several keys, None for the missing ones
+        A remote store reads them in a single round trip.
+        """
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        """ Stores a value for a key """
+        raise NotImplementedError
+
+    def add(self, key, value):
+        """ Stores a value for a key that has none, atomically
+        :return: True if the value was stored
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Removes the value stored for a key, if any """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes every value """
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    """ A backend that never stores anything """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def add(self, key, value):
+        return True
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    """
+    An in-process backend that keeps the most recently used values
+    and forgets values older than a TTL
+    """
+
+    def __init__(self, max_size=1024, ttl=30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def add(self, key, value):
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(CacheBackend):
+    """
+    A backend on a Redis server, shared by every worker, that forgets
+    values older than a TTL. Its keys start with a namespace, so several
+    caches can share a server.
+    """
+
+    def __init__(self, client, ttl=30.0, namespace=""):
+        self.client = client
+        self.ttl = ttl
+        self.namespace = namespace
+
+    @classmethod
+    def from_url(cls, url, ttl=30.0, namespace=""):
+        """ Connects to the Redis server at a redis:// URL
+        :raises ValueError: if the redis package is not installed
+        """
+        try:
+            import redis  # pylint: disable=import-outside-toplevel
+        except ImportError as error:
+            raise ValueError("The redis cache backend needs the redis package") from error
+        return cls(redis.Redis.from_url(url), ttl=ttl, namespace=namespace)
+
+    def _key(self, key):
+        return "{}:{}".format(self.namespace, key) if self.namespace else key
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        return pickle.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        values = self.client.mget([self._key(key) for key in keys])
+        return [pickle.loads(value) if value is not None else None for value in values]
+
+    def set(self, key, value):
+        self.client.set(self._key(key), pickle.dumps(value), px=int(self.ttl * 1000))
+
+    def add(self, key, value):
+        return bool(self.client.set(self._key(key), pickle.dumps(value),
+                                    px=int(self.ttl * 1000), nx=True))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self._key("*")))
+        if keys:
+            self.client.delete(*keys)
+
+
+def create_backend(name, max_size, ttl, url=None, namespace=""):
+    """ Returns a new backend by its name in the configuration, "redis", "memory" or "none"
+    :param name: the name of the backend
+    :type name: str
+    :param max_size: the number of values an LRUCache keeps
+    :type max_size: int
+    :param ttl: the number of seconds a value is kept
+    :type ttl: float
+    :param url: the redis:// URL of the server of a RedisCache
+    :type url: str
+    :param namespace: the prefix of the keys of a RedisCache
+    :type namespace: str
+
+    :return: the backend
+    :rtype: CacheBackend
+    """
+    if name == "redis":
+        return RedisCache.from_url(url, ttl=ttl, namespace=namespace)
+    if name == "memory":
+        return LRUCache(max_size=max_size, ttl=ttl)
+    if name == "none":
+        return NullCache()
+    raise ValueError("Unknown cache backend: {}".format(name))
+
+
+class ShopcartCache:
+    """ Caches serialized Shopcarts by id on top of a backend """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else NullCache()
+
+    def init_app(self, app):
+        """ Sets up the backend from the Flask app configuration
+        :param app: the Flask app
+        :type data: Flask
+        """
+        self.backend = create_backend(app.config.get("SHOPCART_CACHE_BACKEND", "memory"),
+                                      app.config.get("SHOPCART_CACHE_SIZE", 1024),
+                                      app.config.get("SHOPCART_CACHE_TTL", 30.0),
+                                      url=app.config.get("REDIS_URL"),
+                                      namespace="shopcart")
+        logger.info("Shopcart cache backend is %s", type(self.backend).__name__)
+
+    @staticmethod
+    def _key(shopcart_id):
+        return str(shopcart_id)
+
+    @staticmethod
+    def _generation_key(shopcart_id):
+        return "{}:generation".format(shopcart_id)
+
+    def lookup(self, shopcart_id):
+        """ Returns the cached shopcart, if it is still current, and its generation
+        :param shopcart_id: the id of the shopcart
+        :type shopcart_id: int
+
+        :return: the serialized shopcart or None, and the generation to cache
+            a copy read from now on with
+        :rtype: tuple
+        """
+        data, generation = self.backend.get_many(
+            [self._key(shopcart_id), self._generation_key(shopcart_id)]
+        )
+        if generation is None:
+            # nothing written since the generation expired, start a new one
+            self.backend.add(self._generation_key(shopcart_id), uuid.uuid4().hex)
+            return None, self.backend.get(self._generation_key(shopcart_id))
+        if data is None or data["generation"] != generation:
+            return None, generation
+        return data["shopcart"], generation
+
+    def get(self, shopcart_id):
+        """ Returns the serialized shopcart, or None if it is not cached """
+        return self.lookup(shopcart_id)[0]
+
+    def set(self, shopcart_id, data, generation):
+        """ Caches a serialized shopcart
+        :param generation: the generation returned by lookup() before the shopcart was read
+        :type generation: str
+        """
+        if generation is not None:
+            self.backend.set(self._key(shopcart_id), {"generation": generation, "shopcart": data})
+
+    def invalidate(self, *shopcart_ids):
+        """ Starts a new generation of shopcarts after their changes were committed """
+        for shopcart_id in shopcart_ids:
+            self.backend.set(self._generation_key(shopcart_id), uuid.uuid4().hex)
+
+    def clear(self):
+        """ Drops every cached shopcart """
+        self.backend.clear()
+
+
+shopcart_cache = ShopcartCache()
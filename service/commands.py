@@ -0,0 +1,152 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Command line tasks for the Shopcart Service
+
+They are registered on app.cli and run with the flask command, e.g.:
+  FLASK_APP=service flask init-db
+"""
+import time
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from service import migrations
+from service.models import db, Shopcart
+from service.idempotency import IdempotencyKey
+from service.orders import dispatch_outbox
+
+
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    """ Creates the tables that do not exist yet, on every shard """
+    db.create_all()
+    _configure_shards()
+    click.echo("Database tables are created")
+
+
+@click.command("db-upgrade")
+@with_appcontext
+def db_upgrade_command():
+    """ Adds missing indexes and constraints to an existing database, on every shard """
+    for engine in db.get_shard_engines():
+        migrations.upgrade(engine)
+    _configure_shards()
+    click.echo("Database schema is up to date")
+
+
+def _configure_shards():
+    """ Makes every shard hand out only its own ids """
+    engines = db.get_shard_engines()
+    if len(engines) > 1:
+        for shard, engine in enumerate(engines):
+            migrations.configure_shard_sequences(engine, shard, len(engines))
+
+
+@click.command("purge-carts")
+@click.option("--ttl-hours", type=float, default=None,
+              help="Age in hours after which an untouched shopcart is purged.")
+@click.option("--batch-size", type=int, default=None,
+              help="Number of shopcarts deleted per transaction.")
+@click.option("--sleep", type=float, default=None,
+              help="Seconds to pause between batches.")
+@with_appcontext
+def purge_carts_command(ttl_hours, batch_size, sleep):
+    """ Deletes the shopcarts that have been abandoned for longer than the TTL """
+    config = current_app.config
+    ttl_hours = config["CART_TTL_HOURS"] if ttl_hours is None else ttl_hours
+    batch_size = config["PURGE_BATCH_SIZE"] if batch_size is None else batch_size
+    sleep = config["PURGE_SLEEP_SECONDS"] if sleep is None else sleep
+    if batch_size <= 0:
+        raise click.BadParameter("must be positive", param_hint="--batch-size")
+
+    cutoff = datetime.utcnow() - timedelta(hours=ttl_hours)
+    click.echo("Purging shopcarts not updated since {}".format(cutoff.isoformat()))
+
+    started = time.monotonic()
+    total_shopcarts = total_items = 0
+    while True:
+        shopcarts, items = Shopcart.purge_expired(cutoff, batch_size)
+        total_shopcarts += shopcarts
+        total_items += items
+        if shopcarts:
+            click.echo("Purged {} shopcarts and {} items".format(shopcarts, items))
+        if shopcarts < batch_size:
+            break
+        time.sleep(sleep)
+
+    elapsed = time.monotonic() - started
+    rate = (total_shopcarts + total_items) / elapsed if elapsed > 0 else 0.0
+    click.echo("Purged {} shopcarts and {} items in {:.2f}s ({:.0f} rows/sec)".format(
+        total_shopcarts, total_items, elapsed, rate
+    ))
+
+
+@click.command("purge-idempotency-keys")
+@click.option("--batch-size", type=int, default=None,
+              help="Number of keys deleted per transaction.")
+@click.option("--sleep", type=float, default=None,
+              help="Seconds to pause between batches.")
+@with_appcontext
+def purge_idempotency_keys_command(batch_size, sleep):
+    """ Deletes the idempotency keys older than IDEMPOTENCY_TTL seconds """
+    config = current_app.config
+    batch_size = config["PURGE_BATCH_SIZE"] if batch_size is None else batch_size
+    sleep = config["PURGE_SLEEP_SECONDS"] if sleep is None else sleep
+    if batch_size <= 0:
+        raise click.BadParameter("must be positive", param_hint="--batch-size")
+
+    cutoff = datetime.utcnow() - timedelta(seconds=config["IDEMPOTENCY_TTL"])
+    total = 0
+    while True:
+        deleted = IdempotencyKey.purge_expired(cutoff, batch_size)
+        total += deleted
+        if deleted < batch_size:
+            break
+        time.sleep(sleep)
+    click.echo("Purged {} idempotency keys sent before {}".format(total, cutoff.isoformat()))
+
+
+@click.command("dispatch-orders")
+@click.option("--batch-size", type=int, default=None,
+              help="Number of orders sent, one transaction each, before checking for more.")
+@click.option("--poll", type=float, default=None,
+              help="Seconds to wait when no order is due.")
+@click.option("--once", is_flag=True,
+              help="Send the orders that are due and exit.")
+@with_appcontext
+def dispatch_orders_command(batch_size, poll, once):
+    """ Sends the orders in the outbox to the Order Service """
+    config = current_app.config
+    batch_size = config["ORDER_OUTBOX_BATCH_SIZE"] if batch_size is None else batch_size
+    poll = config["ORDER_OUTBOX_POLL_SECONDS"] if poll is None else poll
+    if batch_size <= 0:
+        raise click.BadParameter("must be positive", param_hint="--batch-size")
+
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = dispatch_outbox(batch_size,
+                                       config["ORDER_OUTBOX_RETRY_SECONDS"],
+                                       config["ORDER_OUTBOX_MAX_RETRY_SECONDS"],
+                                       config["ORDER_OUTBOX_MAX_ATTEMPTS"])
+        total_sent += sent
+        total_failed += failed
+        if sent or failed:
+            click.echo("Sent {} orders, {} failed".format(sent, failed))
+        if sent + failed < batch_size:
+            if once:
+                break
+            time.sleep(poll)
+
+    click.echo("Sent {} orders, {} failed".format(total_sent, total_failed))
@@ -3,3 +3,22 @@ Constants for the Shopcart Service
 """
 
 NOT_FOUND = "Not Found"
+
+# Keyset pagination of the list endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NEXT_AFTER_ID_HEADER = "X-Next-After-Id"
+
+# Newline delimited JSON streaming of the list endpoints
+NDJSON_MIMETYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 500
+
+# Largest number of items accepted by a batch add
+MAX_BATCH_SIZE = 1000
+
+# Columns the Shopcart Item queries can be sorted by, prefixed with - for descending
+ITEM_SORT_COLUMNS = ("id", "sid", "sku", "price", "amount", "create_time", "update_time")
+ITEM_SORT_CHOICES = ITEM_SORT_COLUMNS + tuple("-" + column for column in ITEM_SORT_COLUMNS)
+
+# Number of skus returned by the sku stats by default
+DEFAULT_STATS_SIZE = 10
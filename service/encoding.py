@@ -0,0 +1,113 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON encoding of plain rows for the list endpoints
+
+A RowEncoder turns rows of column values, in the order of the fields of a
+flask-restplus model, straight into JSON. The text is the same, byte for
+byte, as json.dumps(marshal(row, model)), which is what flask-restplus
+returns, without building an ORM object, a dictionary and an OrderedDict
+for every row. Strings are escaped by the C accelerated encoder of the
+json module.
+
+Only the fields the list endpoints need are supported: Integer, Float,
+String, Boolean and ISO 8601 DateTime, without defaults or attributes.
+"""
+import json
+from json import encoder
+from flask import current_app
+from flask_restplus import fields, representations
+
+_float_repr = float.__repr__
+_int_repr = int.__repr__
+_encode_string = encoder.encode_basestring_ascii
+
+
+def _encode_integer(value):
+    return "null" if value is None else _int_repr(int(value))
+
+
+def _encode_float(value):
+    if value is None:
+        return "null"
+    value = float(value)
+    if value != value:  # pylint: disable=comparison-with-itself
+        return "NaN"
+    if value == encoder.INFINITY:
+        return "Infinity"
+    if value == -encoder.INFINITY:
+        return "-Infinity"
+    return _float_repr(value)
+
+
+def _encode_string_field(value):
+    return "null" if value is None else _encode_string(str(value))
+
+
+def _encode_boolean(value):
+    if value is None:
+        return "null"
+    return "true" if value else "false"
+
+
+def _encode_datetime(value):
+    return "null" if value is None else '"' + value.isoformat() + '"'
+
+
+FIELD_ENCODERS = {
+    fields.Integer: _encode_integer,
+    fields.Float: _encode_float,
+    fields.String: _encode_string_field,
+    fields.Boolean: _encode_boolean,
+    fields.DateTime: _encode_datetime,
+}
+
+
+class RowEncoder:
+    """ Encodes rows of values in the field order of a model as JSON """
+
+    def __init__(self, model):
+        self.model = model
+        self.names = list(model)
+        self.encoders = []
+        keys = []
+        for name, field in model.items():
+            field_encoder = FIELD_ENCODERS.get(type(field))
+            if field_encoder is None or field.attribute is not None or field.default is not None \
+                    or getattr(field, "dt_format", "iso8601") != "iso8601":
+                raise TypeError("Field {} of model {} can not be encoded from a row".format(
+                    name, model.name))
+            self.encoders.append(field_encoder)
+            keys.append(_encode_string(name).replace("{", "{{").replace("}", "}}") + ": {}")
+        self.template = "{{" + ", ".join(keys) + "}}"
+
+    def encode(self, row):
+        """ Returns the JSON object of a row """
+        return self.template.format(*[field_encoder(value) for field_encoder, value
+                                      in zip(self.encoders, row)])
+
+    def encode_list(self, rows):
+        """ Returns the JSON array of a list of rows """
+        return "[" + ", ".join([self.encode(row) for row in rows]) + "]"
+
+
+def encodes_like(api):
+    """ Tells if the JSON responses of an Api are written as RowEncoder writes them
+    A debug app indents them, RESTPLUS_JSON can change any setting of
+    json.dumps, and flask-restplus uses ujson instead when it is installed.
+    """
+    output_json = api.representations.get("application/json")
+    return (getattr(output_json, "__wrapped__", output_json) is representations.output_json
+            and representations.dumps is json.dumps
+            and not current_app.debug
+            and not current_app.config.get("RESTPLUS_JSON"))
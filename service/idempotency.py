@@ -0,0 +1,335 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Idempotency keys for the writes that are not idempotent
+
+A client that retries a request sends it again with the same
+Idempotency-Key header. The first request with a key runs, and its
+response is stored if its changes are committed. The retries get that
+response back, with an Idempotent-Replayed header, without running
+again, so an item is not added twice and an order is not posted twice.
+
+- a key sent again with another method, path or body gets
+  422 Unprocessable Entity
+- only the responses of the requests that are committed, those below
+  400, are stored: a request that failed committed nothing, so its
+  retries run again
+
+Backends
+--------
+database - the idempotency_key table of the primary, shared by every
+           worker. The key is taken and the response stored in the
+           transaction of the request, so they are committed or rolled
+           back with its changes. A retry that comes while the first
+           request is still running waits for it on PostgreSQL.
+memory - an LRUCache of the worker, for tests and single process runs
+         only. A retry that comes while the first request is still
+         running gets 409 Conflict.
+none - turns the keys off
+
+IdempotencyKey - The response to a request sent with an Idempotency-Key
+Attributes:
+-----------
+key (string) - the key the client sent
+fingerprint (string) - a digest of the method, path and body of the request
+status (int) - the status of the response, None while the request runs
+headers (string) - the headers of the response as JSON
+body (bytes) - the body of the response
+create_time (DateTime) - the time the key was first sent
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime
+from functools import wraps
+from http import HTTPStatus
+from flask import abort, current_app, g, request
+from flask_api import status  # HTTP Status Codes
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from service.cache import CacheBackend, NullCache, create_backend
+from service.models import ConflictError, db, utcnow
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+# The headers that only belong to the response they were sent with
+_UNSTORED_HEADERS = {"Content-Length", "Server-Timing"}
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the response to a request sent with an Idempotency-Key
+    The key is reserved and its response stored in the transaction of the
+    request, so the response is kept exactly when the changes of the request
+    are committed. The rows are kept on the primary, shared by every worker.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    ##################################################
+    # IdempotencyKey Table Schema
+    ##################################################
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer)
+    headers = db.Column(db.Text)
+    body = db.Column(db.LargeBinary)
+    create_time = db.Column(db.DateTime, nullable=False, server_default=utcnow(), index=True)
+
+    @classmethod
+    def reserve(cls, key: str, fingerprint: str):
+        """ Takes a key for the running request, unless it is taken already, without committing
+            While the request that took the key runs, PostgreSQL makes the
+            requests that try to take it again wait for it to commit or roll back.
+            :param key: the idempotency key
+            :type key: str
+            :param fingerprint: the digest of the request
+            :type fingerprint: str
+
+            :return: True if the key was taken
+            :rtype: bool
+        """
+        cls.logger.info("Processing reservation of idempotency key %s ...", key)
+        table = cls.__table__
+        values = {"key": key, "fingerprint": fingerprint, "create_time": utcnow()}
+        if db.session.get_bind().dialect.name == "postgresql":
+            statement = postgresql.insert(table).values(values).on_conflict_do_nothing(
+                index_elements=[table.c.key]
+            )
+        else:
+            # SQLite, used by some test runs, spells ON CONFLICT DO NOTHING that way
+            statement = table.insert().values(values).prefix_with("OR IGNORE")
+        return db.session.execute(statement).rowcount == 1
+
+    @classmethod
+    def find(cls, key: str):
+        """ Returns what is stored for a key
+            :param key: the idempotency key
+            :type key: str
+
+            :return: the fingerprint, and the status, headers and body of the
+                response, or None if the key is free
+            :rtype: dict
+        """
+        cls.logger.info("Processing lookup of idempotency key %s ...", key)
+        table = cls.__table__
+        row = db.session.execute(
+            select([table.c.fingerprint, table.c.status, table.c.headers, table.c.body])
+            .where(table.c.key == key)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "fingerprint": row.fingerprint,
+            "status": row.status,
+            "headers": json.loads(row.headers) if row.headers is not None else None,
+            "body": row.body
+        }
+
+    @classmethod
+    def store(cls, key: str, status_code: int, headers: list, body: bytes):
+        """ Stores the response of the request that took a key, without committing """
+        cls.logger.info("Processing response of idempotency key %s ...", key)
+        table = cls.__table__
+        db.session.execute(table.update().where(table.c.key == key).values(
+            status=status_code, headers=json.dumps(headers), body=body
+        ))
+
+    @classmethod
+    def release(cls, key: str):
+        """ Frees a key, without committing """
+        cls.logger.info("Processing release of idempotency key %s ...", key)
+        table = cls.__table__
+        db.session.execute(table.delete().where(table.c.key == key))
+
+    @classmethod
+    def purge_expired(cls, cutoff: datetime, batch_size: int):
+        """ Deletes one batch of the keys sent before the cutoff in its own transaction
+            :param cutoff: the time before which keys are forgotten
+            :type cutoff: datetime
+            :param batch_size: the maximum number of keys to delete
+            :type batch_size: int
+
+            :return: the number of keys deleted
+            :rtype: int
+        """
+        cls.logger.info("Processing purge of up to %s idempotency keys older than %s",
+                        batch_size, cutoff)
+        table = cls.__table__
+        expired = (select([table.c.key])
+                   .where(table.c.create_time < cutoff)
+                   .limit(batch_size))
+        deleted = db.session.execute(table.delete().where(table.c.key.in_(expired))).rowcount
+        db.session.commit()
+        return deleted
+
+    @classmethod
+    def clear(cls):
+        """ Deletes every key, without committing """
+        cls.logger.info("Processing deletion of every idempotency key")
+        db.session.execute(cls.__table__.delete())
+
+
+
+class DatabaseBackend(CacheBackend):
+    """ Keeps the idempotency keys in the idempotency_key table of the primary """
+
+    transactional = True
+
+    def get(self, key):
+        return IdempotencyKey.find(key)
+
+    def set(self, key, value):
+        IdempotencyKey.store(key, value["status"], value["headers"], value["body"])
+
+    def add(self, key, value):
+        return IdempotencyKey.reserve(key, value["fingerprint"])
+
+    def delete(self, key):
+        IdempotencyKey.release(key)
+
+    def clear(self):
+        IdempotencyKey.clear()
+
+
+class IdempotencyStore:
+    """ Keeps the responses of the requests by their idempotency key on top of a backend """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else NullCache()
+
+    def init_app(self, app):
+        """ Sets up the backend from the Flask app configuration and stores the responses
+        Call it after the unit of work is set up, so that the responses are
+        stored before the request is committed.
+        :param app: the Flask app
+        :type data: Flask
+
+        :raises ValueError: if the memory backend is used by several workers
+        """
+        name = app.config.get("IDEMPOTENCY_BACKEND", "database")
+        if name == "database":
+            self.backend = DatabaseBackend()
+        else:
+            if name == "memory" and app.config.get("WEB_CONCURRENCY", 1) > 1:
+                raise ValueError("IDEMPOTENCY_BACKEND=memory only keeps the keys of one worker, "
+                                 "use database with WEB_CONCURRENCY > 1")
+            self.backend = create_backend(name, app.config.get("IDEMPOTENCY_SIZE", 10000),
+                                          app.config.get("IDEMPOTENCY_TTL", 86400.0),
+                                          url=app.config.get("REDIS_URL"),
+                                          namespace="idempotency")
+        logger.info("Idempotency key backend is %s", type(self.backend).__name__)
+        app.after_request(self._store_response)
+        app.teardown_request(self._release_request)
+
+    def reserve(self, key, fingerprint):
+        """ Marks a key as taken by a running request, unless it is taken already
+        :param key: the idempotency key
+        :type key: str
+        :param fingerprint: the digest of the request
+        :type fingerprint: str
+
+        :return: None if the key was free, or else what is stored for it: the
+            fingerprint, and the status, headers and body of the response once
+            the request has finished
+        :rtype: dict
+        """
+        if self.backend.add(key, {"fingerprint": fingerprint, "status": None}):
+            return None
+        # the key may have expired since
+        return self.backend.get(key) or self.reserve(key, fingerprint)
+
+    def store(self, key, fingerprint, response):
+        """ Stores the response of the request that took a key """
+        self.backend.set(key, {
+            "fingerprint": fingerprint,
+            "status": response.status_code,
+            "headers": [(name, value) for name, value in response.headers
+                        if name not in _UNSTORED_HEADERS],
+            "body": response.get_data()
+        })
+
+    def release(self, key):
+        """ Frees a key, so the request can run again """
+        self.backend.delete(key)
+
+    def clear(self):
+        """ Forgets every key """
+        self.backend.clear()
+
+    def _store_response(self, response):
+        taken = g.get("idempotency_key")
+        if taken is None:
+            return response
+        key, fingerprint = taken
+        # the same test as the commit of the request
+        if response.status_code < 400:
+            self.store(key, fingerprint, response)
+        elif not self.backend.transactional:
+            self.release(key)
+        return response
+
+    def _release_request(self, error):
+        # the request failed after its response was stored, e.g. in the commit
+        taken = g.pop("idempotency_key", None)
+        if taken is not None and error is not None and not self.backend.transactional:
+            self.release(taken[0])
+
+
+idempotency_store = IdempotencyStore()
+
+
+def request_fingerprint():
+    """ Returns a digest of the method, path, query string and body of the request """
+    digest = hashlib.sha256()
+    digest.update("{} {}\n".format(request.method, request.full_path).encode("utf-8"))
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def idempotent(view):
+    """ Makes a view replay its response to the retries of a request with an Idempotency-Key """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  "{} must have 1 to {} characters".format(IDEMPOTENCY_HEADER, MAX_KEY_LENGTH))
+
+        fingerprint = request_fingerprint()
+        stored = idempotency_store.reserve(key, fingerprint)
+        if stored is None:
+            g.idempotency_key = (key, fingerprint)
+            return view(*args, **kwargs)
+
+        if stored["fingerprint"] != fingerprint:
+            # flask_api has no name for 422
+            abort(HTTPStatus.UNPROCESSABLE_ENTITY,
+                  "{} {} was used for another request".format(IDEMPOTENCY_HEADER, key))
+        if stored["status"] is None:
+            raise ConflictError("The request with {} {} is still running".format(
+                IDEMPOTENCY_HEADER, key))
+        logger.info("Replaying the response to %s %s", IDEMPOTENCY_HEADER, key)
+        response = current_app.response_class(stored["body"], status=stored["status"],
+                                               headers=stored["headers"])
+        response.headers[REPLAYED_HEADER] = "true"
+        return response
+
+    return wrapper
@@ -0,0 +1,140 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-request timings of the Shopcart Service
+
+With INSTRUMENTATION turned on, every request records:
+
+- db: the number of SQL statements it ran and the time they took, on
+  every engine, including the shard queries that run in other threads
+- serialize: the time spent encoding the response to JSON
+- order: the time spent posting orders to the Order Service
+
+They are sent back in a Server-Timing header, along with the total time
+of the request, and logged with the endpoint. A request that runs more
+than QUERY_BUDGET statements is logged as a warning.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_START_TIMES = "instrumentation_start_times"
+
+
+class RequestTimings:
+    """ The statements and the time spent on each kind of work by one request """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.durations = {"db": 0.0}
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        """ Adds time spent on a kind of work """
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + duration
+
+    def add_query(self, duration):
+        """ Counts a SQL statement that took some time """
+        with self._lock:
+            self.queries += 1
+            self.durations["db"] += duration
+
+    def server_timing(self):
+        """ Returns the value of the Server-Timing header """
+        metrics = ['db;dur={:.1f};desc="{} queries"'.format(self.durations["db"] * 1000,
+                                                             self.queries)]
+        metrics.extend("{};dur={:.1f}".format(name, duration * 1000)
+                       for name, duration in sorted(self.durations.items()) if name != "db")
+        metrics.append("total;dur={:.1f}".format((time.perf_counter() - self.started) * 1000))
+        return ", ".join(metrics)
+
+
+def current_timings():
+    """ Returns the timings of the current request, or None when nothing is recorded """
+    return g.get("request_timings") if has_app_context() else None
+
+
+@contextmanager
+def timed(name):
+    """ Adds the time spent in a block to the timings of the current request """
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+def use_timings(timings):
+    """ Records the work of the current app context, e.g. in another thread, in timings """
+    if timings is not None:
+        g.request_timings = timings
+
+
+def _before_cursor_execute(conn, *args):  # pylint: disable=unused-argument
+    if current_timings() is not None:
+        conn.info.setdefault(_START_TIMES, []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, *args):  # pylint: disable=unused-argument
+    timings = current_timings()
+    start_times = conn.info.get(_START_TIMES)
+    if timings is not None and start_times:
+        timings.add_query(time.perf_counter() - start_times.pop())
+
+
+def _listen():
+    """ Starts timing the statements of every engine """
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _start_request():
+    if current_app.config.get("INSTRUMENTATION"):
+        _listen()
+        g.request_timings = RequestTimings()
+
+
+def _finish_request(response):
+    timings = g.pop("request_timings", None)
+    if timings is None:
+        return response
+    response.headers["Server-Timing"] = timings.server_timing()
+    budget = current_app.config.get("QUERY_BUDGET")
+    endpoint = request.endpoint or request.path
+    if budget is not None and timings.queries > budget:
+        logger.warning("%s %s ran %s queries, over the budget of %s", request.method, endpoint,
+                       timings.queries, budget)
+    logger.info("%s %s: %s", request.method, endpoint, response.headers["Server-Timing"])
+    return response
+
+
+def init_app(app):
+    """ Records the timings of the requests of a Flask app when INSTRUMENTATION is on
+    :param app: the Flask app
+    :type data: Flask
+    """
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,305 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Online schema migrations for the Shopcart Service
+
+db.create_all() only creates the tables that are missing, so a database
+created by an older version of the service never gets the columns,
+indexes, constraints and column defaults declared on the models. upgrade()
+adds them in place.
+
+Every step is idempotent. On PostgreSQL the indexes are built with
+CREATE INDEX CONCURRENTLY and the foreign key is added NOT VALID and then
+validated, so reads and writes keep flowing while the migration runs.
+The statements run without a statement timeout, however long the tables,
+but the ALTER TABLEs give up after LOCK_TIMEOUT rather than queue every
+query of their table behind a long transaction; the upgrade can then be
+run again.
+"""
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+from service.models import utcnow
+
+logger = logging.getLogger(__name__)
+
+# (index name, table, columns, unique)
+INDEXES = [
+    ("ix_shopcart_user_id", "shopcart", "user_id", False),
+    # the purge of abandoned shopcarts looks them up by update_time
+    ("ix_shopcart_update_time", "shopcart", "update_time", False),
+    ("ix_shopcart_item_sku", "shopcart_item", "sku", False),
+    ("ix_shopcart_item_name", "shopcart_item", "name", False),
+    ("uq_shopcart_item_sid_sku", "shopcart_item", "sid, sku", True),
+]
+
+# The tables whose ids encode the shard of their rows
+SHARDED_SEQUENCES = [
+    ("shopcart_id_seq", "shopcart"),
+    ("shopcart_item_id_seq", "shopcart_item"),
+    ("order_outbox_id_seq", "order_outbox"),
+]
+
+# The timestamps the database fills in with the current UTC time
+TIMESTAMP_DEFAULTS = [
+    ("shopcart", "create_time"),
+    ("shopcart", "update_time"),
+    ("shopcart_item", "create_time"),
+    ("shopcart_item", "update_time"),
+]
+
+# The tables whose rows count their versions, starting from 1
+VERSIONED_TABLES = ["shopcart", "shopcart_item"]
+
+# How long an ALTER TABLE waits for the lock on its table (PostgreSQL only)
+LOCK_TIMEOUT = "5s"
+
+UNIQUE_CONSTRAINT = ("uq_shopcart_item_sid_sku", "shopcart_item")
+FOREIGN_KEY = ("shopcart_item_sid_fkey", "shopcart_item", "sid", ("shopcart", "id"))
+
+
+def upgrade(engine):
+    """ Adds the missing columns, indexes, constraints and column defaults to an existing database
+    :param engine: the engine of the database to upgrade
+    :type engine: sqlalchemy.engine.Engine
+    """
+    logger.info("Upgrading the database schema")
+    upgrade_columns(engine)
+    if engine.dialect.name == "postgresql":
+        upgrade_postgres_online(engine)
+    else:
+        upgrade_sqlite(engine)
+    logger.info("Database schema is up to date")
+
+
+def upgrade_columns(engine):
+    """ Adds the version columns and merges the duplicate items in one transaction """
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("SET LOCAL statement_timeout = 0"))
+            conn.execute(text("SET LOCAL lock_timeout = '{}'".format(LOCK_TIMEOUT)))
+        for table in VERSIONED_TABLES:
+            add_version_column(conn, table)
+        add_failed_time_column(conn)
+        merge_duplicate_items(conn)
+
+
+def upgrade_postgres_online(engine):
+    """ Builds the indexes, constraints and column defaults while the service keeps running """
+    with engine.connect() as conn:
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.execute(text("SET statement_timeout = 0"))
+        try:
+            for name, table, columns, unique in INDEXES:
+                create_index_concurrently(conn, name, table, columns, unique)
+
+            # a concurrent index build waits for the transactions before it
+            # and must not time out, but the ALTER TABLEs from here on must
+            conn.execute(text("SET lock_timeout = '{}'".format(LOCK_TIMEOUT)))
+            add_unique_constraint(conn, *UNIQUE_CONSTRAINT)
+            add_foreign_key(conn, *FOREIGN_KEY)
+            for table, column in TIMESTAMP_DEFAULTS:
+                set_column_default(conn, table, column, utcnow())
+        finally:
+            # the connection goes back to the pool
+            conn.execute(text("RESET statement_timeout"))
+            conn.execute(text("RESET lock_timeout"))
+
+
+def upgrade_sqlite(engine):
+    """ Builds the indexes, and warns about the column defaults SQLite cannot add """
+    with engine.connect() as conn:
+        for name, table, columns, unique in INDEXES:
+            create_index(conn, name, table, columns, unique)
+        for table, column in TIMESTAMP_DEFAULTS:
+            if not _has_default(conn, table, column):
+                logger.warning("%s.%s has no default and SQLite cannot add one, "
+                               "create the table again with flask init-db", table, column)
+
+
+def configure_shard_sequences(engine, shard, count):
+    """
+    Makes the id sequences of a shard hand out only the ids of that shard,
+    those with id % count == shard (PostgreSQL only)
+    Other databases have no sequences; the service picks the ids of their rows.
+    :param engine: the engine of the shard
+    :type engine: sqlalchemy.engine.Engine
+    :param shard: the number of the shard
+    :type shard: int
+    :param count: the number of shards
+    :type count: int
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        for sequence, table in SHARDED_SEQUENCES:
+            increment = conn.execute(text(
+                "SELECT increment_by FROM pg_sequences "
+                "WHERE schemaname = current_schema() AND sequencename = :name"
+            ), name=sequence).scalar()
+            if increment != count:
+                restart_sequence(conn, sequence, table, shard, count)
+
+
+def restart_sequences(engine, shard=0, count=1):
+    """
+    Restarts the id sequences of a shard after the largest id of their
+    tables, e.g. once rows have been loaded with their ids (PostgreSQL only)
+    :param engine: the engine of the shard
+    :type engine: sqlalchemy.engine.Engine
+    :param shard: the number of the shard
+    :type shard: int
+    :param count: the number of shards
+    :type count: int
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        for sequence, table in SHARDED_SEQUENCES:
+            restart_sequence(conn, sequence, table, shard, count)
+
+
+def restart_sequence(conn, sequence, table, shard, count):
+    """ Makes a sequence hand out the ids of a shard that follow the largest id of its table """
+    # lock out writers so that no id is handed out while the sequence changes
+    conn.execute(text("LOCK TABLE {} IN EXCLUSIVE MODE".format(table)))
+    last_id = conn.execute(text("SELECT MAX(id) FROM {}".format(table))).scalar() or 0
+    start = last_id - last_id % count + shard
+    if start <= last_id:
+        start += count
+    logger.info("Sequence %s of shard %s restarts at %s by %s", sequence, shard,
+                start, count)
+    conn.execute(text("ALTER SEQUENCE {} INCREMENT BY {} RESTART WITH {}".format(
+        sequence, count, start
+    )))
+
+
+def add_version_column(conn, table):
+    """
+    Adds the version column to a table unless it already exists
+    The default is a constant, so PostgreSQL 11 and later add the column
+    without rewriting the table
+    """
+    if any(info["name"] == "version" for info in inspect(conn).get_columns(table)):
+        return
+    logger.info("Adding column %s.version", table)
+    conn.execute(text("ALTER TABLE {} ADD COLUMN version INTEGER NOT NULL DEFAULT 1".format(
+        table
+    )))
+
+
+def add_failed_time_column(conn):
+    """ Adds the failed_time column to the order outbox, if the outbox exists without it """
+    inspector = inspect(conn)
+    if "order_outbox" not in inspector.get_table_names():
+        return
+    if any(info["name"] == "failed_time" for info in inspector.get_columns("order_outbox")):
+        return
+    logger.info("Adding column order_outbox.failed_time")
+    conn.execute(text("ALTER TABLE order_outbox ADD COLUMN failed_time TIMESTAMP"))
+
+
+def merge_duplicate_items(conn):
+    """
+    Folds shopcart items that share a (sid, sku) into the oldest one,
+    so that the unique index can be built
+    """
+    duplicates = conn.execute(text(
+        "SELECT sid, sku, MIN(id) AS keep_id, SUM(amount) AS amount FROM shopcart_item "
+        "GROUP BY sid, sku HAVING COUNT(*) > 1"
+    )).fetchall()
+    for sid, sku, keep_id, amount in duplicates:
+        logger.warning("Merging duplicate items with sku %s in shopcart %s", sku, sid)
+        conn.execute(text("UPDATE shopcart_item SET amount = :amount WHERE id = :keep_id"),
+                     amount=amount, keep_id=keep_id)
+        conn.execute(text("DELETE FROM shopcart_item "
+                          "WHERE sid = :sid AND sku = :sku AND id <> :keep_id"),
+                     sid=sid, sku=sku, keep_id=keep_id)
+
+
+def create_index(conn, name, table, columns, unique):
+    """ Creates an index unless it already exists """
+    logger.info("Creating index %s on %s (%s)", name, table, columns)
+    conn.execute(text("CREATE {}INDEX IF NOT EXISTS {} ON {} ({})".format(
+        "UNIQUE " if unique else "", name, table, columns
+    )))
+
+
+def create_index_concurrently(conn, name, table, columns, unique):
+    """ Creates an index without blocking writes to its table (PostgreSQL only) """
+    # A failed concurrent build leaves an invalid index behind that
+    # IF NOT EXISTS would skip, so it has to be dropped and built again
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+    ), name=name).scalar()
+    if invalid:
+        logger.warning("Dropping invalid index %s", name)
+        conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name)))
+
+    logger.info("Creating index %s on %s (%s) concurrently", name, table, columns)
+    conn.execute(text("CREATE {}INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({})".format(
+        "UNIQUE " if unique else "", name, table, columns
+    )))
+
+
+def add_unique_constraint(conn, name, table):
+    """ Turns an existing unique index into a constraint of the same name (PostgreSQL only) """
+    if _has_constraint(conn, name):
+        return
+    logger.info("Adding unique constraint %s to %s", name, table)
+    conn.execute(text("ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE USING INDEX {name}".format(
+        table=table, name=name
+    )))
+
+
+def add_foreign_key(conn, name, table, column, references):
+    """ Adds a foreign key without scanning the table under an exclusive lock (PostgreSQL only)
+    :param references: the referenced table and column
+    :type references: tuple
+    """
+    if not _has_constraint(conn, name):
+        logger.info("Adding foreign key %s on %s (%s)", name, table, column)
+        conn.execute(text("ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) "
+                          "REFERENCES {} ({}) NOT VALID".format(
+                              table, name, column, *references)))
+
+    # Validation only takes a SHARE UPDATE EXCLUSIVE lock. It fails if old
+    # rows point at deleted shopcarts, in which case the constraint is left
+    # NOT VALID: it is still enforced for every new row.
+    try:
+        conn.execute(text("ALTER TABLE {} VALIDATE CONSTRAINT {}".format(table, name)))
+    except IntegrityError as error:
+        logger.warning("Foreign key %s left NOT VALID: %s", name, error)
+
+
+def set_column_default(conn, table, column, default):
+    """ Sets the default of a column, which only changes the catalog (PostgreSQL only) """
+    logger.info("Setting the default of %s.%s", table, column)
+    conn.execute(text("ALTER TABLE {} ALTER COLUMN {} SET DEFAULT {}".format(
+        table, column, default.compile(dialect=conn.dialect)
+    )))
+
+
+def _has_default(conn, table, column):
+    """ Checks if a column has a default """
+    return any(info["name"] == column and info["default"] is not None
+               for info in inspect(conn).get_columns(table))
+
+
+def _has_constraint(conn, name):
+    """ Checks if a constraint exists (PostgreSQL only) """
+    return conn.execute(
+        text("SELECT 1 FROM pg_constraint WHERE conname = :name"), name=name
+    ).scalar() is not None
@@ -13,7 +13,9 @@
 
 """
 Models for Shopcarts
-All of the models are stored in this module
+The models of the shopcarts and their items are stored in this module. The
+order outbox and the idempotency keys are stored with the code that uses
+them, in service.orders and service.idempotency
 Models
 ------
 Shopcart -
@@ -23,6 +25,8 @@ id (int) - shop cart id
 user_id (int) - user id
 create_time (DateTime) - the time this shopcart was created
 update_time (DateTime) - the time this shopcart was updated
+version (int) - the number of times this shopcart was written
+items (list) - the ShopcartItems in this shopcart
 ShopcartItem - Contains product information for an item in a shopcart
 Attributes:
 -----------
@@ -34,14 +38,175 @@ price (float) - price for one
 amount (int) - number of product
 create_time (DateTime) - the time this product was created
 update_time (DateTime) - the time this product was updated
+version (int) - the number of times this product was written
 """
 
+import hashlib
 import logging
+from collections import OrderedDict
 from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
+from flask import has_request_context
+from sqlalchemy import and_, event, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql.expression import FunctionElement
+from service.cache import shopcart_cache
+from service.sharding import ShardedSession, ShardedSQLAlchemy
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Create the SQLAlchemy object to be initialized later in init_db(). Its
+# sessions keep every shopcart on its shard, and read from the replica,
+# if there is one, during GET requests. Objects keep their values after a
+# commit, so a write is not followed by a SELECT to read them back
+db = ShardedSQLAlchemy(session_options={"expire_on_commit": False})
+
+# The key of the session info that holds the shopcarts to drop from the cache on commit
+CHANGED_SHOPCARTS = "changed_shopcarts"
+
+# Half a cent, the largest difference between two prices that round to the same cent
+PRICE_TOLERANCE = 0.005
+
+
+class utcnow(FunctionElement):  # pylint: disable=invalid-name,too-many-ancestors
+    """ The current time in UTC, as the naive timestamps are stored, read by the database """
+    type = db.DateTime()
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kwargs):  # pylint: disable=unused-argument
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, "postgresql")
+def _utcnow_postgresql(element, compiler, **kwargs):  # pylint: disable=unused-argument
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow, "sqlite")
+def _utcnow_sqlite(element, compiler, **kwargs):  # pylint: disable=unused-argument
+    # CURRENT_TIMESTAMP has no fraction of a second on SQLite
+    return "STRFTIME('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+def init_db(app):
+    """ Initializes SQLAlchemy from the Flask app without connecting to the database
+    The tables are created by `flask init-db` before the service starts
+    :param app: the Flask app
+    :type data: Flask
+    """
+    logging.getLogger(__name__).info("Initializing database")
+    db.init_app(app)
+
+
+def init_unit_of_work(app):
+    """ Makes every request of the Flask app a single transaction
+    The model methods only send their changes to the database. They are
+    committed once, after a request has succeeded, and rolled back when
+    it fails, so a write costs one commit however many rows it touches.
+    :param app: the Flask app
+    :type data: Flask
+    """
+    app.after_request(commit_request)
+    app.teardown_request(rollback_request)
+
+
+def commit_request(response):
+    """ Commits the changes of a request that succeeded and rolls back the others """
+    if response.status_code < 400:
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return response
+
+
+def rollback_request(error):
+    """ Rolls back the changes of a request that raised before it was committed """
+    if error is not None:
+        db.session.rollback()
+
+
+def read_from_primary():
+    """ Sends the reads of the rest of the request to the primary
+    Used before caching what is read, since a replica that has not caught up
+    yet would return the rows from before the last writes.
+    """
+    session = db.session()
+    if session.reads_from_replica():
+        session.use_primary()
+
+
+def save_changes():
+    """ Sends the changes of the session to the database
+    During a request they are committed by commit_request(). Outside of one,
+    e.g. in a command line task or a test, they are committed right away.
+    """
+    if has_request_context():
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def invalidate_on_commit(*shopcart_ids):
+    """ Starts a new cache generation of shopcarts once their changes are committed """
+    db.session.info.setdefault(CHANGED_SHOPCARTS, set()).update(shopcart_ids)
+
+
+@event.listens_for(ShardedSession, "after_commit")
+def _invalidate_changed_shopcarts(session):
+    shopcart_ids = session.info.pop(CHANGED_SHOPCARTS, None)
+    if shopcart_ids:
+        shopcart_cache.invalidate(*shopcart_ids)
+
+
+@event.listens_for(ShardedSession, "after_rollback")
+def _forget_changed_shopcarts(session):
+    session.info.pop(CHANGED_SHOPCARTS, None)
+
+
+def check_pool_capacity(config):
+    """ Warns about connection pool settings that do not fit the concurrency
+    Every gunicorn thread may need a connection of each database, or two of
+    each shard when a listing fans out to the shards while the request holds
+    one already. Every worker process has its own pool for each database, so
+    the pools of all of the workers must fit in the number of connections the
+    databases allow.
+    :param config: the Flask app configuration
+    :type config: dict
+
+    :return: the warnings
+    :rtype: list
+    """
+    logger = logging.getLogger(__name__)
+    warnings = []
+    options = config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+    if "pool_size" not in options:
+        return warnings
+
+    per_pool = options["pool_size"] + options.get("max_overflow", 0)
+    # the primary, the shards besides it and the replica each have a pool
+    engines = 1 + len(config.get("SQLALCHEMY_BINDS") or {})
+    per_thread = 2 if config.get("DATABASE_SHARD_URIS") else 1
+    threads = config["GUNICORN_THREADS"]
+    if threads * per_thread > per_pool:
+        warnings.append(
+            "{} threads per worker need up to {} connections but share only {}, requests "
+            "will wait up to {}s for one".format(threads, threads * per_thread, per_pool,
+                                                 options.get("pool_timeout", 30))
+        )
+    per_worker = per_pool * engines
+    total = config["WEB_CONCURRENCY"] * per_worker
+    if total > config["DB_MAX_CONNECTIONS"]:
+        warnings.append(
+            "{} workers may open {} connections but the databases allow {}".format(
+                config["WEB_CONCURRENCY"], total, config["DB_MAX_CONNECTIONS"])
+        )
+    for warning in warnings:
+        logger.warning("Connection pool: %s", warning)
+    logger.info("Connection pool: %s workers x %s pools x %s connections",
+                config["WEB_CONCURRENCY"], engines, per_pool)
+    return warnings
 
 
 class DataValidationError(Exception):
@@ -50,6 +215,12 @@ class DataValidationError(Exception):
     pass
 
 
+class ConflictError(Exception):
+    """ Used when a write was meant for a version of a record that is not the current one """
+
+    pass
+
+
 class Shopcart(db.Model):
     """
     Class that represents a Shopcart
@@ -58,18 +229,25 @@ class Shopcart(db.Model):
     """
 
     logger = logging.getLogger(__name__)
-    app = None
 
     ##################################################
     # Shopcart Table Schema
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer)
-    create_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, index=True)
+    create_time = db.Column(db.DateTime, nullable=False, server_default=utcnow())
     update_time = db.Column(db.DateTime,
                             nullable=False,
-                            default=datetime.utcnow,
-                            onupdate=datetime.utcnow)
+                            server_default=utcnow(),
+                            onupdate=utcnow(),
+                            index=True)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    items = db.relationship('ShopcartItem', order_by='ShopcartItem.id', lazy='select')
+
+    # The timestamps are set by the database and read back by the INSERT
+    # or UPDATE itself, with RETURNING where the database supports it. Every
+    # UPDATE of the ORM only applies to the version it read, and bumps it
+    __mapper_args__ = {"eager_defaults": True, "version_id_col": version}
 
     ##################################################
     # INSTANCE METHODS
@@ -84,20 +262,24 @@ class Shopcart(db.Model):
         """
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
-        db.session.commit()
-        db.session.refresh(self)
+        db.session.flush()
+        # ids can be reused once a table is dropped, so nothing stale may stay behind
+        invalidate_on_commit(self.id)
+        save_changes()
 
     def delete(self):
         """
         Removes a Shopcart and everything in it
+        Both deletes are set based and share the transaction of the request
         """
-        items = ShopcartItem.find_by_shopcartid(self.id)
-
-        for item in items:
-            item.delete()
+        ShopcartItem.query.on_shard_of(self.id).filter(ShopcartItem.sid == self.id).delete()
+        Shopcart.query.on_shard_of(self.id).filter(Shopcart.id == self.id).delete()
+        invalidate_on_commit(self.id)
+        save_changes()
 
-        db.session.delete(self)
-        db.session.commit()
+    def shard(self, shards):
+        """ Returns the shard a new Shopcart is stored in """
+        return shards.for_user(self.user_id)
 
     def serialize(self):
         """ Serializes a Shopcart into a dictionary """
@@ -105,9 +287,16 @@ class Shopcart(db.Model):
             "id": self.id,
             "user_id": self.user_id,
             "create_time": self.create_time,
-            "update_time": self.update_time
+            "update_time": self.update_time,
+            "version": self.version
         }
 
+    def serialize_with_items(self):
+        """ Serializes a Shopcart and the items in it into a dictionary """
+        shopcart = self.serialize()
+        shopcart["items"] = [item.serialize() for item in self.items]
+        return shopcart
+
     def deserialize(self, data: dict):
         """
         Deserializes a Shopcart from a dictionary
@@ -131,19 +320,6 @@ class Shopcart(db.Model):
 
         return self
 
-    @classmethod
-    def init_db(cls, app):
-        """Initializes the database session
-        :param app: the Flask app
-        :type data: Flask
-        """
-        cls.logger.info("Initializing database")
-        cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
-
     @classmethod
     def all(cls):
         """ Returns all of the Shopcarts in the database """
@@ -151,10 +327,160 @@ class Shopcart(db.Model):
         return cls.query.order_by(cls.id).all()
 
     @classmethod
-    def find(cls, sid):
-        """ Finds a shopcart based on the id provided """
+    def all_with_items(cls):
+        """ Returns all of the Shopcarts with their items loaded in a single extra query """
+        cls.logger.info("Processing all Shopcarts with items")
+        return cls.query.options(selectinload(cls.items)).order_by(cls.id).all()
+
+    @classmethod
+    def find_page_with_items(cls, after_id: int, limit: int, user_id: int = None):
+        """ Returns a page of Shopcarts with their items, ordered by id
+            :param after_id: only shopcarts with an id greater than this one are returned
+            :type after_id: int
+            :param limit: the maximum number of shopcarts to return
+            :type limit: int
+            :param user_id: if given, only the shopcarts of this user are returned
+            :type user_id: int
+
+            :return: a list of at most limit shopcarts
+            :rtype: list
+        """
+        cls.logger.info("Processing page of %s Shopcarts after id %s ...", limit, after_id)
+        query = cls.query if user_id is None else cls.find_by_user(user_id)
+        return (query.options(selectinload(cls.items))
+                .filter(cls.id > after_id)
+                .order_by(cls.id)
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def stream_with_items(cls, batch_size: int, user_id: int = None):
+        """ Yields Shopcarts with their items, fetching them one page at a time
+            Eager loading of the items cannot be combined with a server side
+            cursor, so the shopcarts are walked in keyset pages of batch_size
+            instead, which keeps memory bounded by the size of a page.
+        """
+        cls.logger.info("Processing stream of Shopcarts in batches of %s", batch_size)
+        after_id = 0
+        while True:
+            shopcarts = cls.find_page_with_items(after_id, batch_size, user_id)
+            for shopcart in shopcarts:
+                yield shopcart
+            if len(shopcarts) < batch_size:
+                return
+            after_id = shopcarts[-1].id
+
+    @classmethod
+    def purge_expired(cls, cutoff: datetime, batch_size: int):
+        """ Deletes one batch of the shopcarts abandoned before the cutoff
+            A shopcart is abandoned when neither it nor any of its items has
+            been updated since the cutoff. The batch is deleted in its own short
+            transaction, and on PostgreSQL shopcarts that are being written to
+            are skipped instead of waited on.
+            :param cutoff: the time before which shopcarts are considered abandoned
+            :type cutoff: datetime
+            :param batch_size: the maximum number of shopcarts to delete
+            :type batch_size: int
+
+            :return: the number of shopcarts and of items deleted
+            :rtype: tuple
+        """
+        cls.logger.info("Processing purge of up to %s shopcarts older than %s", batch_size, cutoff)
+        recent_items = db.session.query(ShopcartItem.id).filter(
+            ShopcartItem.sid == cls.id, ShopcartItem.update_time >= cutoff
+        ).exists()
+        rows = (db.session.query(cls.id)
+                .filter(cls.update_time < cutoff, ~recent_items)
+                .order_by(cls.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+                .all())
+        ids = [row.id for row in rows]
+        if not ids:
+            db.session.rollback()
+            return 0, 0
+
+        items = ShopcartItem.query.filter(ShopcartItem.sid.in_(ids)).delete(
+            synchronize_session=False
+        )
+        shopcarts = cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        invalidate_on_commit(*ids)
+        db.session.commit()
+        return shopcarts, items
+
+    @classmethod
+    def find(cls, sid, for_update=False):
+        """ Finds a shopcart based on the id provided
+            With for_update the shopcart row stays locked until the session commits,
+            which also blocks new items from being added to it
+        """
         cls.logger.info("Processing lookup for shopcart id %s ...", sid)
-        return cls.query.get(sid)
+        query = cls.query.with_for_update() if for_update else cls.query
+        return query.get(sid)
+
+    @classmethod
+    def find_etag(cls, sid):
+        """ Returns a strong entity tag for a shopcart and its items
+            The tag changes whenever the shopcart or one of its items is updated,
+            or an item is added or removed. It is computed by a single aggregate
+            query, so no item is loaded. The update times alone are not enough:
+            they are the start time of each transaction, so a slow request can
+            commit an older one than a write that committed before it. Every
+            write bumps a version though, and every added item has a new id.
+            :param sid: the id of the shopcart
+            :type sid: int
+
+            :return: the entity tag, or None if the shopcart doesn't exist
+            :rtype: str
+        """
+        cls.logger.info("Processing entity tag lookup for shopcart id %s ...", sid)
+        row = (db.session.query(cls.update_time,
+                                cls.version,
+                                db.func.max(ShopcartItem.update_time),
+                                db.func.count(ShopcartItem.id),
+                                db.func.sum(ShopcartItem.id),
+                                db.func.sum(ShopcartItem.version))
+               .outerjoin(ShopcartItem, ShopcartItem.sid == cls.id)
+               .filter(cls.id == sid)
+               .on_shard_of(sid)
+               .group_by(cls.id, cls.update_time, cls.version)
+               .first())
+        if row is None:
+            return None
+        version = "{}:{}:{}:{}:{}:{}:{}".format(sid, *row)
+        return hashlib.sha1(version.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def summarize(cls, sid):
+        """ Returns the totals of a shopcart, computed by a single aggregate query
+            :param sid: the id of the shopcart
+            :type sid: int
+
+            :return: the subtotal, number of lines and number of units of the shopcart,
+                or None if the shopcart doesn't exist
+            :rtype: dict
+        """
+        cls.logger.info("Processing summary for shopcart id %s ...", sid)
+        row = (db.session.query(
+            cls.id,
+            cls.user_id,
+            db.func.coalesce(db.func.sum(ShopcartItem.price * ShopcartItem.amount), 0),
+            db.func.count(ShopcartItem.id),
+            db.func.coalesce(db.func.sum(ShopcartItem.amount), 0))
+               .outerjoin(ShopcartItem, ShopcartItem.sid == cls.id)
+               .filter(cls.id == sid)
+               .on_shard_of(sid)
+               .group_by(cls.id, cls.user_id)
+               .first())
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "user_id": row[1],
+            "subtotal": round(float(row[2]), 2),
+            "lines": row[3],
+            "units": int(row[4])
+        }
 
     @classmethod
     def find_by_user(cls, user_id: int):
@@ -166,7 +492,19 @@ class Shopcart(db.Model):
             :rtype: Shopcart
         """
         cls.logger.info("Processing user id query for %s ...", user_id)
-        return cls.query.filter(cls.user_id == user_id)
+        return cls.query.on_user_shard(user_id).filter(cls.user_id == user_id)
+
+    @classmethod
+    def find_by_user_with_items(cls, user_id: int):
+        """ Returns the shopcarts for a user with their items loaded in a single extra query
+            :param user_id: the id of the user to find the shopcarts for
+            :type user_id: int
+
+            :return: a list of shopcarts with that user id
+            :rtype: list
+        """
+        cls.logger.info("Processing user id query with items for %s ...", user_id)
+        return cls.find_by_user(user_id).options(selectinload(cls.items)).order_by(cls.id).all()
 
 
 class ShopcartItem(db.Model):
@@ -177,22 +515,28 @@ class ShopcartItem(db.Model):
     """
 
     logger = logging.getLogger(__name__)
-    app = None
 
     ##################################################
     # ShopcartItems Table Schema
     ##################################################
+    # The unique (sid, sku) index also serves lookups by sid alone
+    __table_args__ = (db.UniqueConstraint('sid', 'sku', name='uq_shopcart_item_sid_sku'),)
+
     id = db.Column(db.Integer, primary_key=True)
-    sid = db.Column(db.Integer)
-    sku = db.Column(db.Integer)
-    name = db.Column(db.String)
+    sid = db.Column(db.Integer, db.ForeignKey('shopcart.id'))
+    sku = db.Column(db.Integer, index=True)
+    name = db.Column(db.String, index=True)
     price = db.Column(db.Float)
     amount = db.Column(db.Integer)
-    create_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    create_time = db.Column(db.DateTime, nullable=False, server_default=utcnow())
     update_time = db.Column(db.DateTime,
                             nullable=False,
-                            default=datetime.utcnow,
-                            onupdate=datetime.utcnow)
+                            server_default=utcnow(),
+                            onupdate=utcnow())
+    # the statements written without the ORM bump the version themselves
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"eager_defaults": True, "version_id_col": version}
 
     ##################################################
     # INSTANCE METHODS
@@ -210,45 +554,237 @@ class ShopcartItem(db.Model):
             raise DataValidationError("Invalid shopcart id: shopcart doesn't exist")
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
-        db.session.commit()
-        db.session.refresh(self)
+        invalidate_on_commit(self.sid)
+        self._save()
 
     def add(self):
         """
         Adds an item to shopcart database.
         If this item already exists in then it updates it in the database.
+        On PostgreSQL this is a single INSERT ... ON CONFLICT DO UPDATE,
+        so concurrent adds of the same sku are summed instead of duplicated.
         """
+        row = self._upsert(self.sid, [self])[0]
+        invalidate_on_commit(self.sid)
+        save_changes()
+        self._copy_row(row)
 
-        shopcart = Shopcart().find(self.sid)
-        if shopcart is None:
-            raise DataValidationError("Invalid shopcart id: shopcart doesn't exist")
-        shopcart_item = ShopcartItem().find_by_sku_and_sid(self.sku, self.sid)
-        if shopcart_item:
-            self.id = shopcart_item.id
-            self.amount = shopcart_item.amount + self.amount
-            shopcart_item.amount = self.amount
-            shopcart_item.update()
-            self.create_time = shopcart_item.create_time
-            self.update_time = shopcart_item.update_time
-        else:
-            self.id = None
-            db.session.add(self)
-            db.session.commit()
-            db.session.refresh(self)
+    @classmethod
+    def add_all(cls, sid, shopcart_items):
+        """
+        Adds several items to a shopcart in a single statement.
+        Items with the same sku are merged in memory first, so every sku
+        is written once by a single multi-row statement. The rows are written
+        in the order of their skus, so that two batches for the same shopcart
+        lock them in the same order and cannot deadlock.
+        :param sid: the id of the shopcart to add the items to
+        :type sid: int
+        :param shopcart_items: the deserialized items to add
+        :type shopcart_items: list
+
+        :return: one stored item per item added, in the same order: the merged
+            row of its sku, shared by the items with the same sku
+        :rtype: list
+        """
+        cls.logger.info("Processing batch of %s items for shopcart %s", len(shopcart_items), sid)
+        merged = {}
+        for shopcart_item in shopcart_items:
+            if shopcart_item.sku in merged:
+                merged[shopcart_item.sku].amount += shopcart_item.amount
+            else:
+                merged[shopcart_item.sku] = ShopcartItem(sid=sid,
+                                                         sku=shopcart_item.sku,
+                                                         name=shopcart_item.name,
+                                                         price=shopcart_item.price,
+                                                         amount=shopcart_item.amount)
+        rows_to_write = [merged[sku] for sku in sorted(merged)]
+        rows = cls._upsert(sid, rows_to_write)
+        invalidate_on_commit(sid)
+        save_changes()
+        for shopcart_item, row in zip(rows_to_write, rows):
+            shopcart_item._copy_row(row)  # pylint: disable=protected-access
+        return [merged[shopcart_item.sku] for shopcart_item in shopcart_items]
+
+    @classmethod
+    def _upsert(cls, sid, shopcart_items):
+        """
+        Writes items with distinct skus to a shopcart without committing
+        :return: the stored rows, in the same order as the items
+        :rtype: list
+        """
+        now = utcnow()
+        values = [{
+            "sid": sid,
+            "sku": shopcart_item.sku,
+            "name": shopcart_item.name,
+            "price": shopcart_item.price,
+            "amount": shopcart_item.amount,
+            "create_time": now,
+            "update_time": now
+        } for shopcart_item in shopcart_items]
+
+        if db.session.get_bind().dialect.name != "postgresql":
+            return cls._upsert_without_on_conflict(sid, values)
+
+        try:
+            rows = db.session.execute(cls._upsert_statement(values),
+                                      bind=db.shard_engine(db.shards.for_id(sid))).fetchall()
+        except IntegrityError as error:
+            # the only constraint the upsert can violate is the shopcart foreign key
+            db.session.rollback()
+            raise DataValidationError("Invalid shopcart id: shopcart doesn't exist") from error
+        rows_by_sku = {row[cls.__table__.c.sku]: row for row in rows}
+        return [rows_by_sku[value["sku"]] for value in values]
+
+    @classmethod
+    def _upsert_without_on_conflict(cls, sid, values):
+        """
+        Writes items for databases without INSERT ... ON CONFLICT support.
+        Each UPDATE comes first so that it takes the write lock before
+        the existence of the row is decided.
+        """
+        table = cls.__table__
+        shards = db.shards
+        shard = shards.for_id(sid)
+        bind = db.shard_engine(shard)
+        rows = []
+        shopcart_checked = False
+        for value in values:
+            matches_item = and_(table.c.sid == sid, table.c.sku == value["sku"])
+            result = db.session.execute(
+                table.update()
+                .where(matches_item)
+                .values(amount=table.c.amount + value["amount"],
+                        update_time=value["update_time"],
+                        version=table.c.version + 1),
+                bind=bind
+            )
+            if result.rowcount == 0:
+                if not shopcart_checked:
+                    if Shopcart.find(sid) is None:
+                        db.session.rollback()
+                        raise DataValidationError("Invalid shopcart id: shopcart doesn't exist")
+                    shopcart_checked = True
+                if shards.count > 1:
+                    # there is no sequence to hand out the ids of the shard
+                    last_id = db.session.execute(select([db.func.max(table.c.id)]),
+                                                 bind=bind).scalar()
+                    value = dict(value, id=shards.next_id(last_id, shard))
+                db.session.execute(table.insert().values(value), bind=bind)
+            rows.append(db.session.execute(select([table]).where(matches_item),
+                                           bind=bind).fetchone())
+        return rows
 
-    def update(self):
+    @classmethod
+    def _upsert_statement(cls, rows):
+        """
+        Builds an INSERT of the rows that adds their amount to the items
+        already in the shopcart and returns the resulting rows (PostgreSQL only)
+        :param rows: the column values of the items, at most one per (sid, sku)
+        :type rows: list
+        """
+        table = cls.__table__
+        statement = postgresql.insert(table).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=[table.c.sid, table.c.sku],
+            set_={
+                "amount": table.c.amount + statement.excluded.amount,
+                "update_time": statement.excluded.update_time,
+                "version": table.c.version + 1
+            }
+        ).returning(*table.c)
+
+    def _copy_row(self, row):
+        """ Copies the columns of a shopcart_item row onto this ShopcartItem """
+        for column in self.__table__.columns:
+            setattr(self, column.key, row[column])
+
+    def update(self, version=None):
         """
         Updates a ShopcartItem to the database
+        The UPDATE only applies to the version that was read. With a version,
+        the write is also refused unless that is the version that was read.
+        :param version: the version of the item the changes were made to, if known
+        :type version: int
         """
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
-        db.session.refresh(self)
+        if version is not None and version != self.version:
+            raise ConflictError(
+                "Shopcart item {} is at version {}, not {}".format(self.id, self.version, version)
+            )
+        invalidate_on_commit(self.sid)
+        self._save()
+
+    @classmethod
+    def change_amount(cls, sid, item_id, delta):
+        """
+        Adds delta to the amount of an item in a shopcart.
+        The amount is changed by a single UPDATE, which returns the new row
+        on PostgreSQL, so concurrent changes are all counted without reading
+        the item first. The item is deleted when its amount drops to zero.
+        :param sid: the id of the shopcart
+        :type sid: int
+        :param item_id: the id of the item
+        :type item_id: int
+        :param delta: the number of products to add, negative to remove them
+        :type delta: int
+
+        :return: the item with its new amount, which is zero or less when it has
+            been deleted, or None if the shopcart has no such item
+        :rtype: ShopcartItem
+        """
+        cls.logger.info("Processing change of %s to item %s in shopcart %s", delta, item_id, sid)
+        table = cls.__table__
+        bind = db.shard_engine(db.shards.for_id(sid))
+        matches_item = and_(table.c.id == item_id, table.c.sid == sid)
+        statement = (table.update()
+                     .where(matches_item)
+                     .values(amount=table.c.amount + delta, update_time=utcnow(),
+                             version=table.c.version + 1))
+        if db.session.get_bind().dialect.name == "postgresql":
+            row = db.session.execute(statement.returning(*table.c), bind=bind).fetchone()
+        elif db.session.execute(statement, bind=bind).rowcount:
+            # the UPDATE holds the write lock, so the row read back is the one it wrote
+            row = db.session.execute(select([table]).where(matches_item), bind=bind).fetchone()
+        else:
+            row = None
+        if row is None:
+            return None
+        if row[table.c.amount] <= 0:
+            db.session.execute(table.delete().where(matches_item), bind=bind)
+        invalidate_on_commit(sid)
+        save_changes()
+        shopcart_item = cls()
+        shopcart_item._copy_row(row)  # pylint: disable=protected-access
+        return shopcart_item
 
     def delete(self):
         """Removes a ShopcartItem from the data store"""
         db.session.delete(self)
-        db.session.commit()
+        invalidate_on_commit(self.sid)
+        self._save()
+
+    def _save(self):
+        """ Saves the changes of the session, reporting a sku that is already in the shopcart
+        and an item that was written by someone else since it was read
+        """
+        try:
+            save_changes()
+        except IntegrityError as error:
+            db.session.rollback()
+            raise DataValidationError(
+                "Invalid shopcart item: sku {} is already in shopcart {}".format(self.sku, self.sid)
+            ) from error
+        except StaleDataError as error:
+            db.session.rollback()
+            raise ConflictError(
+                "Shopcart item {} has been changed since it was read".format(self.id)
+            ) from error
+
+    def shard(self, shards):
+        """ Returns the shard a new ShopcartItem is stored in, the one of its shopcart """
+        return shards.for_id(self.sid)
 
     def serialize(self):
         """ Serializes a Shopcart into a dictionary """
@@ -260,7 +796,8 @@ class ShopcartItem(db.Model):
             "price": self.price,
             "amount": self.amount,
             "create_time": self.create_time,
-            "update_time": self.update_time
+            "update_time": self.update_time,
+            "version": self.version
         }
 
     def deserialize(self, data: dict):
@@ -296,19 +833,6 @@ class ShopcartItem(db.Model):
             ) from error
         return self
 
-    @classmethod
-    def init_db(cls, app):
-        """Initializes the database session
-        :param app: the Flask app
-        :type data: Flask
-        """
-        cls.logger.info("Initializing database")
-        cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
-
     @classmethod
     def all(cls):
         """ Returns all of the Shopcart Items in the database """
@@ -316,60 +840,131 @@ class ShopcartItem(db.Model):
         return cls.query.order_by(cls.id).all()
 
     @classmethod
-    def find_by_sku(cls, sku: int):
-        """ Returns all shopcart items by sku
-            :param sku: the sku to find the shopcart items for
-            :type sku: int
-
-            :return: a list of shopcart items with that sku, or 404_NOT_FOUND if not found
-            :rtype: list
+    def find_by_filters(cls, sort: str = "id", **filters):
+        """ Returns a query of the shopcart items that match all of the filters
+            Every filter that is None is ignored. The filters are combined into
+            a single WHERE clause, so sorting and limiting happen in the database.
+            :param sort: the column to order by, prefixed with - for descending
+            :type sort: str
+            :param filters: sku, name, sid, price, min_price, max_price, amount,
+                min_amount, max_amount, updated_after and updated_before
+            :type filters: dict
+
+            :return: a query of the matching shopcart items, ties ordered by id
+            :rtype: Query
         """
-        cls.logger.info("Processing sku query for %s ...", sku)
-        return cls.query.filter(cls.sku == sku).order_by(cls.id).all()
+        cls.logger.info("Processing query for %s sorted by %s ...", filters, sort)
+        conditions = []
+        for name, column in (("sku", cls.sku), ("name", cls.name),
+                             ("sid", cls.sid), ("amount", cls.amount)):
+            if filters.get(name) is not None:
+                conditions.append(column == filters[name])
+        if filters.get("price") is not None:
+            # prices are floats, so a price matches anything that rounds to the same cent
+            conditions.append(cls.price.between(filters["price"] - PRICE_TOLERANCE,
+                                                filters["price"] + PRICE_TOLERANCE))
+        if filters.get("min_price") is not None:
+            conditions.append(cls.price >= filters["min_price"])
+        if filters.get("max_price") is not None:
+            conditions.append(cls.price <= filters["max_price"])
+        if filters.get("min_amount") is not None:
+            conditions.append(cls.amount >= filters["min_amount"])
+        if filters.get("max_amount") is not None:
+            conditions.append(cls.amount <= filters["max_amount"])
+        if filters.get("updated_after") is not None:
+            conditions.append(cls.update_time >= filters["updated_after"])
+        if filters.get("updated_before") is not None:
+            conditions.append(cls.update_time < filters["updated_before"])
+
+        column = getattr(cls, sort.lstrip("-"))
+        order = column.desc() if sort.startswith("-") else column.asc()
+        query = cls.query.filter(*conditions).order_by(order)
+        if filters.get("sid") is not None:
+            query = query.on_shard_of(filters["sid"])
+        if column is not cls.id:
+            query = query.order_by(cls.id)
+        return query
 
     @classmethod
-    def find_by_name(cls, name: str):
-        """ Returns all shopcart items by product name
-            :param name: the name of the product to find shopcart items for
-            :type sku: string
-
-            :return: a list of shopcart items with that product, or 404_NOT_FOUND if not found
-            :rtype: list
+    def as_rows(cls, query):
+        """ Turns a query of Shopcart Items into a query of plain rows
+            The rows hold the values of serialize(), in the same order, and
+            are read without building a ShopcartItem for each of them
         """
-        cls.logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name).order_by(cls.id).all()
+        return query.with_entities(cls.id, cls.sid, cls.sku, cls.name, cls.price, cls.amount,
+                                   cls.create_time, cls.update_time, cls.version)
 
     @classmethod
-    def find_by_price(cls, price: float):
-        """ Returns all shopcart items by product price
-            :param sku: the price to find the shopcart items for
-            :type sku: float
-
-            :return: a list of shopcart items with that products with that price,
-            or 404_NOT_FOUND if not found
+    def sku_stats(cls, limit: int, sort: str = "units"):
+        """ Returns the most popular skus, computed by a GROUP BY query on every shard
+            :param limit: the number of skus to return
+            :type limit: int
+            :param sort: "units" to rank the skus by the number of units in shopcarts,
+                or "revenue" by the total price of those units
+            :type sort: str
+
+            :return: the units, revenue and number of shopcarts of each sku, best first
             :rtype: list
         """
-        cls.logger.info("Processing price query for %s ...", price)
-        return cls.query.filter(cls.price == price).order_by(cls.id).all()
+        cls.logger.info("Processing top %s skus by %s ...", limit, sort)
+        units = db.func.sum(cls.amount).label("units")
+        revenue = db.func.sum(cls.price * cls.amount).label("revenue")
+        rank = revenue if sort == "revenue" else units
+        query = (db.session.query(cls.sku,
+                                  db.func.max(cls.name).label("name"),
+                                  units,
+                                  revenue,
+                                  db.func.count(cls.sid).label("shopcarts"))
+                 .group_by(cls.sku)
+                 .order_by(rank.desc(), cls.sku))
+        if db.shards.count == 1:
+            stats = [cls._sku_stats_row(row) for row in query.limit(limit).all()]
+        else:
+            # every shard only counts its own items, so the totals are added up here
+            stats = cls._add_up_sku_stats([cls._sku_stats_row(row) for row in query.all()])
+            stats = sorted(stats, key=lambda stat: (-stat[sort], stat["sku"]))[:limit]
+        for stat in stats:
+            stat["revenue"] = round(stat["revenue"], 2)
+        return stats
+
+    @staticmethod
+    def _sku_stats_row(row):
+        """ Converts a row of sku stats into a dictionary """
+        return {
+            "sku": row.sku,
+            "name": row.name,
+            "units": int(row.units),
+            "revenue": float(row.revenue),
+            "shopcarts": row.shopcarts
+        }
 
-    @classmethod
-    def find_by_amount(cls, amount: int):
-        """ Returns all shopcart items by amount of a product
-            :param sku: the amount to find the shopcart items for
-            :type sku: int
+    @staticmethod
+    def _add_up_sku_stats(stats):
+        """ Adds up the stats of the skus found in several shards """
+        totals = OrderedDict()
+        for stat in stats:
+            total = totals.setdefault(stat["sku"], dict(stat, units=0, revenue=0.0, shopcarts=0))
+            total["name"] = max(total["name"] or "", stat["name"] or "") or None
+            for key in ("units", "revenue", "shopcarts"):
+                total[key] += stat[key]
+        return list(totals.values())
 
-            :return: a list of shopcart items with that product amount,
-            or 404_NOT_FOUND if not found
-            :rtype: list
+    @classmethod
+    def find_by_shopcartid(cls, sid, for_update=False):
+        """ Finds a items in a shopcart based on the shopcart id provided
+            With for_update the item rows stay locked until the session commits
         """
-        cls.logger.info("Processing sku amount for %s ...", amount)
-        return cls.query.filter(cls.amount == amount).order_by(cls.id).all()
+        cls.logger.info("Processing lookup or 404 for id %s ...", sid)
+        query = cls.query.on_shard_of(sid).filter_by(sid=sid).order_by(cls.id)
+        if for_update:
+            query = query.with_for_update()
+        return query.all()
 
     @classmethod
-    def find_by_shopcartid(cls, sid):
-        """ Finds a items in a shopcart based on the shopcart id provided """
-        cls.logger.info("Processing lookup or 404 for id %s ...", sid)
-        return cls.query.filter_by(sid=sid).order_by(cls.id).all()
+    def find_rows_by_shopcartid(cls, sid):
+        """ Finds the items in a shopcart as plain rows, see as_rows() """
+        cls.logger.info("Processing rows lookup for id %s ...", sid)
+        return cls.as_rows(cls.query.on_shard_of(sid).filter_by(sid=sid).order_by(cls.id)).all()
 
     @classmethod
     def find(cls, item_id):
@@ -383,4 +978,4 @@ class ShopcartItem(db.Model):
         cls.logger.info(
             "Processing lookup for shopcart item with sku %s and sid %s", str(sku), str(sid)
         )
-        return cls.query.filter_by(sid=sid).filter_by(sku=sku).first()
+        return cls.query.on_shard_of(sid).filter_by(sid=sid).filter_by(sku=sku).first()
@@ -0,0 +1,278 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Client for the Order Service
+
+Orders are posted through a single requests Session per process, so
+connections to the Order Service are pooled and kept alive. Every request
+has a connect and a read timeout. Only failures that guarantee the order
+was not processed are retried with backoff: connection errors and
+503 Service Unavailable.
+
+In outbox mode the orders are stored in the order_outbox table instead,
+and dispatch_outbox() sends them from a separate process.
+
+OrderOutbox - An order waiting to be sent to the Order Service
+Attributes:
+-----------
+id (int) - for index purpose
+shopcart_id (int) - id of the shopcart the order was placed for
+payload (string) - the order as JSON
+attempts (int) - number of failed attempts to send the order
+next_attempt_time (DateTime) - the time the order is due to be sent
+last_error (string) - why the last attempt failed
+create_time (DateTime) - the time this order was placed
+failed_time (DateTime) - the time the order was given up on, if it was
+"""
+import json
+import logging
+from datetime import datetime, timedelta
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from service.instrumentation import timed
+from service.models import Shopcart, ShopcartItem, db, invalidate_on_commit, save_changes
+
+logger = logging.getLogger(__name__)
+
+
+class OrderOutbox(db.Model):
+    """
+    Class that represents an order waiting to be sent to the Order Service
+    The shopcart is deleted in the same transaction the order is stored in,
+    so placing an order does not wait for the Order Service
+    """
+
+    logger = logging.getLogger(__name__)
+
+    ##################################################
+    # OrderOutbox Table Schema
+    ##################################################
+    id = db.Column(db.Integer, primary_key=True)
+    shopcart_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    last_error = db.Column(db.String)
+    create_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # set once the order is given up on, after too many failed attempts
+    failed_time = db.Column(db.DateTime)
+
+    ##################################################
+    # INSTANCE METHODS
+    ##################################################
+
+    def shard(self, shards):
+        """ Returns the shard a new OrderOutbox is stored in, the one of its shopcart """
+        return shards.for_id(self.shopcart_id)
+
+    def sent(self):
+        """ Removes an order that the Order Service has accepted, without committing """
+        db.session.delete(self)
+
+    def failed(self, error: str, retry_at: datetime):
+        """ Records a failed attempt to send an order, without committing
+        :param error: why the attempt failed
+        :type error: str
+        :param retry_at: the time of the next attempt
+        :type retry_at: datetime
+        """
+        self.attempts += 1
+        self.last_error = error
+        self.next_attempt_time = retry_at
+
+    def give_up(self, error: str, now: datetime):
+        """ Records the last failed attempt to send an order and gives up on it, without committing
+        :param error: why the attempt failed
+        :type error: str
+        :param now: the current time
+        :type now: datetime
+        """
+        self.attempts += 1
+        self.last_error = error
+        self.failed_time = now
+
+    def serialize(self):
+        """ Serializes an OrderOutbox into a dictionary """
+        return {
+            "id": self.id,
+            "shopcart_id": self.shopcart_id,
+            "order": json.loads(self.payload),
+            "attempts": self.attempts,
+            "next_attempt_time": self.next_attempt_time,
+            "last_error": self.last_error,
+            "create_time": self.create_time,
+            "failed_time": self.failed_time
+        }
+
+    @classmethod
+    def enqueue(cls, shopcart, order: dict):
+        """ Stores an order and deletes its shopcart in the same transaction
+        :param shopcart: the shopcart the order was placed for
+        :type shopcart: Shopcart
+        :param order: the order to send to the Order Service
+        :type order: dict
+
+        :return: the stored order
+        :rtype: OrderOutbox
+        """
+        cls.logger.info("Processing outbox order for shopcart id %s ...", shopcart.id)
+        outbox = cls(shopcart_id=shopcart.id, payload=json.dumps(order))
+        db.session.add(outbox)
+        ShopcartItem.query.on_shard_of(shopcart.id).filter(
+            ShopcartItem.sid == shopcart.id
+        ).delete()
+        Shopcart.query.on_shard_of(shopcart.id).filter(Shopcart.id == shopcart.id).delete()
+        invalidate_on_commit(shopcart.id)
+        save_changes()
+        return outbox
+
+    @classmethod
+    def find_next_due(cls, now: datetime):
+        """ Returns the oldest order that is due to be sent, leaving out the failed ones
+            The row stays locked until the session commits, and on PostgreSQL
+            rows locked by another dispatcher are skipped instead of waited on.
+            Only one row is locked at a time, so a slow Order Service holds up
+            a single order rather than a whole batch.
+            :param now: the current time
+            :type now: datetime
+
+            :return: the order, or None if no order is due
+            :rtype: OrderOutbox
+        """
+        cls.logger.info("Processing lookup of the next due order")
+        return (cls.query.filter(cls.next_attempt_time <= now, cls.failed_time.is_(None))
+                .order_by(cls.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+                .first())
+
+    @classmethod
+    def all(cls):
+        """ Returns all of the orders in the outbox """
+        cls.logger.info("Processing all outbox orders")
+        return cls.query.order_by(cls.id).all()
+
+
+def build_order(shopcart, shopcart_items):
+    """ Builds the order the Order Service expects for a shopcart and its items """
+    order_items = []
+    for item in shopcart_items:
+        order_items.append({
+            "item_id": int(item.id),
+            "product_id": int(item.sku),
+            "quantity": int(item.amount),
+            "price": item.price,
+            "status": "PLACED"
+        })
+    return {
+        "customer_id": int(shopcart.user_id),
+        "order_items": order_items,
+    }
+
+
+class OrderClient:
+    """ Posts orders to the Order Service """
+
+    def __init__(self):
+        self.endpoint = None
+        self.timeout = None
+        self.session = None
+
+    def init_app(self, app):
+        """ Sets up the HTTP session from the Flask app configuration
+        :param app: the Flask app
+        :type data: Flask
+        """
+        config = app.config
+        self.endpoint = config["ORDER_ENDPOINT"]
+        self.timeout = (config["ORDER_CONNECT_TIMEOUT"], config["ORDER_READ_TIMEOUT"])
+        retries = Retry(total=config["ORDER_RETRIES"],
+                        connect=config["ORDER_RETRIES"],
+                        read=0,
+                        status=config["ORDER_RETRIES"],
+                        status_forcelist=(503,),
+                        method_whitelist=frozenset(["POST"]),
+                        backoff_factor=config["ORDER_RETRY_BACKOFF"],
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=config["ORDER_POOL_SIZE"],
+                              max_retries=retries)
+        session = requests.Session()
+        session.headers.update({"content-type": "application/json"})
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if self.session is not None:
+            self.session.close()
+        self.session = session
+
+    def post(self, payload: str):
+        """ Posts an order serialized as JSON
+        :param payload: the order as JSON
+        :type payload: str
+
+        :return: the response of the Order Service
+        :rtype: requests.Response
+        :raises requests.RequestException: if the Order Service could not be reached in time
+        """
+        with timed("order"):
+            return self.session.post(self.endpoint, data=payload, timeout=self.timeout)
+
+
+order_client = OrderClient()
+
+
+def dispatch_outbox(batch_size, retry_seconds, max_retry_seconds, max_attempts):
+    """ Sends up to batch_size of the orders in the outbox that are due
+    Orders the Order Service accepts are removed. The others are tried again
+    later, backing off exponentially from retry_seconds up to max_retry_seconds,
+    until they have failed max_attempts times: they are then marked failed and
+    kept in the outbox, but never sent again.
+    Each order is locked, sent and committed in its own transaction, so no lock
+    is held across the posts of other orders. An order is sent at least once:
+    it is sent again if the service stops after posting it but before committing.
+
+    :return: the number of orders sent and of orders that failed
+    :rtype: tuple
+    """
+    now = datetime.utcnow()
+    sent = failed = 0
+    for _ in range(batch_size):
+        outbox = OrderOutbox.find_next_due(now)
+        if outbox is None:
+            db.session.rollback()
+            break
+        try:
+            res = order_client.post(outbox.payload)
+            error = None if res.status_code == 201 else "HTTP {} {}".format(
+                res.status_code, res.text[:200]
+            )
+        except requests.RequestException as exc:
+            error = str(exc)
+
+        if error is None:
+            outbox.sent()
+            sent += 1
+        else:
+            if outbox.attempts + 1 >= max_attempts:
+                logger.error("Order %s for shopcart %s failed %s times, giving up: %s",
+                             outbox.id, outbox.shopcart_id, outbox.attempts + 1, error)
+                outbox.give_up(error, now)
+            else:
+                logger.warning("Order %s for shopcart %s not sent: %s",
+                               outbox.id, outbox.shopcart_id, error)
+                delay = min(retry_seconds * 2 ** outbox.attempts, max_retry_seconds)
+                outbox.failed(error, now + timedelta(seconds=delay))
+            failed += 1
+        db.session.commit()
+    return sent, failed
@@ -0,0 +1,94 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Read replica routing for the database session
+
+When SQLALCHEMY_BINDS has a "replica" engine, the plain SELECTs of GET
+and HEAD requests are sent to it. Everything else goes to the primary:
+writes, SELECT ... FOR UPDATE, raw connections, other requests and the
+command line tasks. Once a session has used the primary for anything but
+a plain SELECT it stays on the primary, so a request always reads its
+own writes.
+
+Without a replica every statement goes to the primary, as before.
+"""
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql import Select
+
+REPLICA_BIND = "replica"
+READ_ONLY_METHODS = ("GET", "HEAD")
+
+
+def _is_plain_select(clause):
+    """ Tells if a statement only reads and takes no locks """
+    return isinstance(clause, Select) and clause._for_update_arg is None  # pylint: disable=protected-access
+
+
+class RoutingSession(SignallingSession):
+    """ A session that reads from the replica during read only requests """
+
+    def __init__(self, db, read_only=None, **options):
+        super().__init__(db, **options)
+        self.db = db
+        self.replica = db.get_replica_engine(self.app)
+        self.pinned = False
+        # None lets the method of the current request decide
+        self.read_only = read_only
+
+    def reads_from_replica(self):
+        """ Tells if the plain SELECTs of this session go to the replica """
+        if self.replica is None or self.pinned:
+            return False
+        if self.read_only is not None:
+            return self.read_only
+        return has_request_context() and request.method in READ_ONLY_METHODS
+
+    def use_primary(self):
+        """ Sends every statement of this session to the primary from now on """
+        self.pinned = True
+
+    def fork(self):
+        """ Returns a new session, for another thread, that reads from the same database """
+        return type(self)(self.db, read_only=self.reads_from_replica(),
+                          query_cls=self._query_cls)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replica is not None and not self.pinned:
+            if self._flushing or not _is_plain_select(clause):
+                self.pinned = True
+            elif self.reads_from_replica():
+                return self.replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with sessions that route reads to a replica """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engines(self, app=None):
+        """ Returns the engine of the primary and those of every bind """
+        app = self.get_app(app)
+        return [self.get_engine(app)] + [
+            self.get_engine(app, bind=bind) for bind in app.config.get("SQLALCHEMY_BINDS") or {}
+        ]
+
+    def get_replica_engine(self, app=None):
+        """ Returns the engine of the read replica, or None if there is none """
+        app = self.get_app(app)
+        if REPLICA_BIND not in (app.config.get("SQLALCHEMY_BINDS") or {}):
+            return None
+        return self.get_engine(app, bind=REPLICA_BIND)
@@ -18,38 +18,62 @@ Shopcart Service with UI
 Paths:
 ------
 GET / - Displays a usage information for Selenium testing
-GET /shopcarts - Returns a list of all the Shopcarts
+GET /shopcarts - Returns a list of all the Shopcarts, a page of them with ?after_id=&limit=,
+                 or a newline delimited JSON stream of them with ?stream=true
 POST /shopcarts - Creates a new Shopcart record in the database
-GET /shopcarts/{id} - Returns the Shopcart with a given id number
+GET /shopcarts/{id} - Returns the Shopcart with a given id number, served from the
+                      shopcart cache until the shopcart is written to; the response has an
+                      ETag and If-None-Match is answered with 304 Not Modified
 DELETE /shopcarts/{id} - Deletes a Shopcart record in the database
-PUT /shopcarts/{id}/place-order - Places an order
-GET /shopcarts/{id}/items - Gets Shopcart Item list from a Shopcart
+GET /shopcarts/{id}/summary - Returns the subtotal, line count and unit count of a Shopcart
+PUT /shopcarts/{id}/place-order - Places an order, or queues it in the order outbox
+GET /shopcarts/{id}/items - Gets Shopcart Item list from a Shopcart, with the same ETag
 POST /shopcarts/{id}/items - Creates a new Shopcart Item record in the database
-GET /shopcarts/{id}/items/{item_id} - Returns the Shopcart Item with given id and item_id number
-PUT /shopcarts/{id}/items/{item_id} - Updates the Shopcart Item
+POST /shopcarts/{id}/items:batch - Adds a list of Shopcart Items in a single transaction
+GET /shopcarts/{id}/items/{item_id} - Returns the Shopcart Item with given id and item_id number,
+                                      with its version as ETag
+PUT /shopcarts/{id}/items/{item_id} - Updates the Shopcart Item, only if it is still at the
+                                      version given by If-Match or the body, or 409 Conflict
+PATCH /shopcarts/{id}/items/{item_id} - Adds a delta to the amount of the Shopcart Item,
+                                        deleting it when the amount drops to zero
 DELETE /shopcarts/{id}/items/{item_id} - Deletes the Shopcart Item
+GET /shopcarts/items - Returns a list of all the Shopcart Items, or queries them by any
+                       combination of sku, name, sid, price and amount ranges and update time,
+                       sorted by ?sort=; the list can be paged or streamed like GET /shopcarts
+GET /shopcarts/items/stats - Returns the top skus by units or revenue
+
+The POSTs, the PATCH and place-order accept an Idempotency-Key header: the
+retries of a request with the same key get its response again without running
 """
-import os
 import json
+import logging
+from datetime import timezone
+from functools import wraps
 import requests
-from flask import jsonify, request, make_response, abort
-from flask.logging import create_logger
+from flask import Blueprint, current_app, jsonify, request, make_response, abort, Response
+from flask import stream_with_context
 from flask_api import status  # HTTP Status Codes
-from flask_restplus import Api, Resource, fields, reqparse
+from flask_restplus import Api, Resource, fields, reqparse, inputs, marshal, representations
+from werkzeug.http import quote_etag
 from service.models import Shopcart, ShopcartItem, DataValidationError
-from . import app, constants
+from service.models import ConflictError, read_from_primary
+from service.cache import shopcart_cache
+from service.encoding import RowEncoder, encodes_like
+from service.idempotency import IDEMPOTENCY_HEADER, idempotent
+from service.instrumentation import timed
+from service.orders import OrderOutbox, order_client, build_order
+from . import constants
 
-# use create_logger function to avoid no-member errors for logger in pylint
-logger = create_logger(app)
+logger = logging.getLogger(__name__)
 
-ORDER_ENDPOINT = os.getenv('ORDER_ENDPOINT',
-                           'https://nyu-order-service-f20.us-south.cf.appdomain.cloud/orders')
+# All of the routes are registered on this blueprint by create_app()
+blueprint = Blueprint('shopcarts', __name__)
 
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
 
-api = Api(app,
+api = Api(blueprint,
           version='1.0.0',
           title='Shopcart REST API Service',
           description='This is a Shopcart server.',
@@ -60,6 +84,15 @@ api = Api(app,
           prefix='/api'
           )
 
+
+# The JSON of the responses is written by flask-restplus, timed as serialization
+@api.representation('application/json')
+@wraps(representations.output_json)
+def output_json(data, code, headers=None):  # pylint: disable=missing-docstring
+    with timed("serialize"):
+        return representations.output_json(data, code, headers)
+
+
 # Define the model so that the docs reflect what can be sent
 
 shopcart_item_model = api.model('ShopcartItem', {
@@ -78,7 +111,9 @@ shopcart_item_model = api.model('ShopcartItem', {
     'create_time': fields.DateTime(readOnly=True,
                                    description='The time the record is created'),
     'update_time': fields.DateTime(readOnly=True,
-                                   description='The time the record is updated')
+                                   description='The time the record is updated'),
+    'version': fields.Integer(readOnly=True,
+                              description='The version of the record, its ETag')
 })
 
 shopcart_model = api.model('Shopcart', {
@@ -90,9 +125,14 @@ shopcart_model = api.model('Shopcart', {
                                    description='The time the record is created'),
     'update_time': fields.DateTime(readOnly=True,
                                    description='The time the record is updated'),
+    'version': fields.Integer(readOnly=True,
+                              description='The version of the record'),
     'items': fields.List(fields.Nested(shopcart_item_model))
 })
 
+# The item lists are encoded from plain rows of the columns of this model
+shopcart_item_encoder = RowEncoder(shopcart_item_model)
+
 create_shopcart_model = api.model('Shopcart', {
     'user_id': fields.Integer(required=True,
                               description='The id of the User')
@@ -109,9 +149,53 @@ create_shopcart_item_model = api.model('ShopcartItem', {
                            description='The number of product')
 })
 
+shopcart_item_delta_model = api.model('ShopcartItemDelta', {
+    'delta': fields.Integer(required=True,
+                            description='The number of product to add, negative to remove')
+})
+
+shopcart_summary_model = api.model('ShopcartSummary', {
+    'id': fields.Integer(readOnly=True,
+                         description='The id of the Shopcart'),
+    'user_id': fields.Integer(readOnly=True,
+                              description='The id of the User'),
+    'subtotal': fields.Float(readOnly=True,
+                             description='The total price of the items in the Shopcart'),
+    'lines': fields.Integer(readOnly=True,
+                            description='The number of Shopcart Items'),
+    'units': fields.Integer(readOnly=True,
+                            description='The number of products in the Shopcart')
+})
+
+sku_stats_model = api.model('SkuStats', {
+    'sku': fields.Integer(readOnly=True,
+                          description='The product id'),
+    'name': fields.String(readOnly=True,
+                          description='The product name'),
+    'units': fields.Integer(readOnly=True,
+                            description='The number of this product in all Shopcarts'),
+    'revenue': fields.Float(readOnly=True,
+                            description='The total price of this product in all Shopcarts'),
+    'shopcarts': fields.Integer(readOnly=True,
+                                description='The number of Shopcarts holding this product')
+})
+
 # query string arguments
 shopcart_args = reqparse.RequestParser()
 shopcart_args.add_argument('user_id', type=int, required=False, help='Find Shopcart by User Id')
+shopcart_args.add_argument('after_id',
+                           type=int,
+                           required=False,
+                           help='Return the page of Shopcarts after this id')
+shopcart_args.add_argument('limit',
+                           type=int,
+                           required=False,
+                           help='Maximum number of Shopcarts in a page')
+shopcart_args.add_argument('stream',
+                           type=inputs.boolean,
+                           required=False,
+                           default=False,
+                           help='Stream the Shopcarts as newline delimited JSON')
 
 shopcart_item_args = reqparse.RequestParser()
 shopcart_item_args.add_argument('sku',
@@ -122,26 +206,104 @@ shopcart_item_args.add_argument('name',
                                 type=str,
                                 required=False,
                                 help='Find Shopcart Item by Product Name')
+shopcart_item_args.add_argument('sid',
+                                type=int,
+                                required=False,
+                                help='Find Shopcart Item by Shopcart Id')
 shopcart_item_args.add_argument('price',
                                 type=float,
                                 required=False,
-                                help='Find Shopcart Item by Product Price')
+                                help='Find Shopcart Item by Product Price, to the cent')
+shopcart_item_args.add_argument('min_price',
+                                type=float,
+                                required=False,
+                                help='Find Shopcart Items with at least this Product Price')
+shopcart_item_args.add_argument('max_price',
+                                type=float,
+                                required=False,
+                                help='Find Shopcart Items with at most this Product Price')
 shopcart_item_args.add_argument('amount',
                                 type=int,
                                 required=False,
                                 help='Find Shopcart Item by Product Amount')
+shopcart_item_args.add_argument('min_amount',
+                                type=int,
+                                required=False,
+                                help='Find Shopcart Items with at least this Product Amount')
+shopcart_item_args.add_argument('max_amount',
+                                type=int,
+                                required=False,
+                                help='Find Shopcart Items with at most this Product Amount')
+shopcart_item_args.add_argument('updated_after',
+                                type=inputs.datetime_from_iso8601,
+                                required=False,
+                                help='Find Shopcart Items updated at or after this ISO 8601 time')
+shopcart_item_args.add_argument('updated_before',
+                                type=inputs.datetime_from_iso8601,
+                                required=False,
+                                help='Find Shopcart Items updated before this ISO 8601 time')
+shopcart_item_args.add_argument('sort',
+                                type=str,
+                                required=False,
+                                default='id',
+                                choices=constants.ITEM_SORT_CHOICES,
+                                help='Sort the Shopcart Items by a column, prefixed with - '
+                                     'for descending order')
+shopcart_item_args.add_argument('after_id',
+                                type=int,
+                                required=False,
+                                help='Return the page of Shopcart Items after this id')
+shopcart_item_args.add_argument('limit',
+                                type=int,
+                                required=False,
+                                help='Maximum number of Shopcart Items in a page')
+shopcart_item_args.add_argument('stream',
+                                type=inputs.boolean,
+                                required=False,
+                                default=False,
+                                help='Stream the Shopcart Items as newline delimited JSON')
+
+
+sku_stats_args = reqparse.RequestParser()
+sku_stats_args.add_argument('limit',
+                            type=int,
+                            required=False,
+                            default=constants.DEFAULT_STATS_SIZE,
+                            help='Number of skus to return')
+sku_stats_args.add_argument('sort',
+                            type=str,
+                            required=False,
+                            default='units',
+                            choices=('units', 'revenue'),
+                            help='Rank the skus by units or by revenue')
+
+# the query arguments that filter the Shopcart Items
+ITEM_FILTER_ARGS = ('sku', 'name', 'sid', 'price', 'min_price', 'max_price', 'amount',
+                    'min_amount', 'max_amount', 'updated_after', 'updated_before')
 
 
 ######################################################################
 # Error Handlers
 ######################################################################
-@app.errorhandler(DataValidationError)
+@blueprint.app_errorhandler(DataValidationError)
 def request_validation_error(error):
     """ Handles Value Errors from bad data """
     return bad_request(error)
 
 
-@app.errorhandler(status.HTTP_400_BAD_REQUEST)
+@blueprint.app_errorhandler(ConflictError)
+def conflict(error):
+    """ Handles writes to a version that is not the current one with 409_CONFLICT """
+    logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_409_CONFLICT, error="Conflict", message=str(error)
+        ),
+        status.HTTP_409_CONFLICT,
+    )
+
+
+@blueprint.app_errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """ Handles bad reuests with 400_BAD_REQUEST """
     logger.warning(str(error))
@@ -153,7 +315,7 @@ def bad_request(error):
     )
 
 
-@app.errorhandler(status.HTTP_404_NOT_FOUND)
+@blueprint.app_errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """ Handles resources not found with 404_NOT_FOUND """
     logger.warning(str(error))
@@ -165,7 +327,7 @@ def not_found(error):
     )
 
 
-@app.errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@blueprint.app_errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
 def method_not_supported(error):
     """ Handles unsuppoted HTTP methods with 405_METHOD_NOT_SUPPORTED """
     logger.warning(str(error))
@@ -179,7 +341,7 @@ def method_not_supported(error):
     )
 
 
-@app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+@blueprint.app_errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
     logger.warning(str(error))
@@ -196,7 +358,7 @@ def mediatype_not_supported(error):
 ######################################################################
 # GET HEALTH CHECK
 ######################################################################
-@app.route('/healthcheck')
+@blueprint.route('/healthcheck')
 def healthcheck():
     """ Let them know our heart is still beating """
     return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
@@ -205,10 +367,10 @@ def healthcheck():
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route('/')
+@blueprint.route('/')
 def index():
     """ Root URL response """
-    return app.send_static_file('index.html')
+    return current_app.send_static_file('index.html')
 
 
 ######################################################################
@@ -219,31 +381,46 @@ class ShopcartCollection(Resource):
     """LIST ALL Shopcarts"""
     @api.doc('list_shopcarts')
     @api.expect(shopcart_args, validate=True)
-    @api.marshal_list_with(shopcart_model)
+    @api.response(400, 'The paging arguments were not valid')
+    @api.response(200, 'Shopcarts returned successfully', [shopcart_model])
     def get(self):
         """ Returns all of the Shopcarts """
         logger.info('Request to list Shopcarts...')
 
         args = shopcart_args.parse_args()
+        headers = {}
+
+        if args['stream']:
+            logger.info('Stream all')
+            shopcarts = Shopcart.stream_with_items(constants.STREAM_BATCH_SIZE, args['user_id'])
+            return ndjson_response(
+                (shopcart.serialize_with_items() for shopcart in shopcarts), shopcart_model
+            )
 
-        if args['user_id']:
+        if is_page_requested(args):
+            logger.info('Find page')
+            after_id, limit = check_page_args(args)
+            shopcarts = Shopcart.find_page_with_items(after_id, limit + 1, args['user_id'])
+            shopcarts, headers = paginate(shopcarts, limit, ShopcartCollection,
+                                          user_id=args['user_id'])
+        elif args['user_id']:
             logger.info('Find by user')
-            shopcarts = Shopcart.find_by_user(args['user_id'])
+            shopcarts = Shopcart.find_by_user_with_items(args['user_id'])
         else:
             logger.info('Find all')
-            shopcarts = Shopcart.all()
+            shopcarts = Shopcart.all_with_items()
 
-        results = [shopcart.serialize() for shopcart in shopcarts]
-        for shopcart in results:
-            items = ShopcartItem.find_by_shopcartid(shopcart["id"])
-            shopcart["items"] = [item.serialize() for item in items]
+        results = [shopcart.serialize_with_items() for shopcart in shopcarts]
 
         logger.info('[%s] Shopcarts returned', len(results))
-        return results, status.HTTP_200_OK
+        return api.marshal(results, shopcart_model), status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW Shopcart
     # ------------------------------------------------------------------
+    @idempotent
+    @api.param(IDEMPOTENCY_HEADER, 'A key unique to the request, sent again with its retries',
+               _in='header')
     @api.doc('create_shopcarts')
     @api.expect(create_shopcart_model)
     @api.response(400, 'The posted data was not valid')
@@ -270,9 +447,7 @@ class ShopcartCollection(Resource):
         logger.info("Shopcart with ID [%s] created.", shopcart.id)
 
         location_url = api.url_for(ShopcartResource, shopcart_id=shopcart.id, _external=True)
-        shopcart_result = shopcart.serialize()
-        items = ShopcartItem.find_by_shopcartid(shopcart_result["id"])
-        shopcart_result["items"] = [item.serialize() for item in items]
+        shopcart_result = shopcart.serialize_with_items()
         return shopcart_result, status.HTTP_201_CREATED, {"Location": location_url}
 
 
@@ -291,27 +466,50 @@ class ShopcartResource(Resource):
 
     @api.doc('get_shopcart')
     @api.response(404, 'Shopcart not found')
-    @api.response(200, 'Shopcart returned successfully')
-    @api.marshal_with(shopcart_model)
+    @api.response(304, 'Shopcart has not been modified')
+    @api.response(200, 'Shopcart returned successfully', shopcart_model)
     def get(self, shopcart_id):
         """
             Gets information about a Shopcart
             This endpoint will get information about a shopcart
         """
         logger.info("Request to get information of a shopcart")
-        shopcart = Shopcart.find(shopcart_id)
-        if shopcart is None:
+        cached, generation = shopcart_cache.lookup(shopcart_id)
+        if cached is not None:
+            logger.info("Shopcart with ID [%s] fetched from cache.", shopcart_id)
+            etag = cached["etag"]
+            if is_not_modified(etag):
+                return not_modified(etag)
+            return cached["shopcart"], status.HTTP_200_OK, {"ETag": quote_etag(etag)}
+
+        # The cache is only filled from the primary, since a replica that
+        # has not caught up would put the shopcart from before a write in it
+        read_from_primary()
+        etag = Shopcart.find_etag(shopcart_id)
+        if etag is None:
             logger.info("Shopcart with ID [%s] not found.", shopcart_id)
             api.abort(
                 status.HTTP_404_NOT_FOUND,
                 "Shopcart with id '{}' was not found.".format(shopcart_id)
             )
+        if is_not_modified(etag):
+            logger.info("Shopcart with ID [%s] not modified.", shopcart_id)
+            return not_modified(etag)
 
-        shopcart_items = ShopcartItem.find_by_shopcartid(shopcart_id)
-        response = shopcart.serialize()
-        response["items"] = [item.serialize() for item in shopcart_items]
+        shopcart = Shopcart.find(shopcart_id)
+        if shopcart is None:
+            api.abort(
+                status.HTTP_404_NOT_FOUND,
+                "Shopcart with id '{}' was not found.".format(shopcart_id)
+            )
+        cached = {
+            "etag": etag,
+            "shopcart": api.marshal(shopcart.serialize_with_items(), shopcart_model)
+        }
+        shopcart_cache.set(shopcart_id, cached, generation)
         logger.info("Shopcart with ID [%s] fetched.", shopcart.id)
-        return response, status.HTTP_200_OK
+
+        return cached["shopcart"], status.HTTP_200_OK, {"ETag": quote_etag(etag)}
 
     @api.doc('delete_shopcart')
     @api.response(204, 'Shopcart has been deleted')
@@ -342,6 +540,7 @@ class ShopcartItemResource(Resource):
         GET /shopcart/{id}/items/{id} - Returns a shopcart Item with the id
         DELETE /shopcart/{id}/items/{id} -  Deletes a shopcart Item with the id
         PUT /shopcart/{id}/items/{id} -  Updates a shopcart Item with the id
+        PATCH /shopcart/{id}/items/{id} -  Changes the amount of a shopcart Item with the id
     """
 
     @api.doc('get_shopcart_item')
@@ -367,10 +566,13 @@ class ShopcartItemResource(Resource):
             )
 
         logger.info("Fetched shopcart item with ID [%s].", item_id)
-        return shopcart_item.serialize(), status.HTTP_200_OK
+        return (shopcart_item.serialize(), status.HTTP_200_OK,
+                {"ETag": version_etag(shopcart_item.version)})
 
     @api.doc('update_shopcart_item')
+    @api.header('If-Match', 'The ETag of the version of the Shopcart Item that was changed')
     @api.response(404, 'Shopcart Item not found')
+    @api.response(409, 'Shopcart Item has been changed since that version')
     @api.response(400, 'The posted Item data was not valid')
     @api.response(200, 'Shopcart Item updated')
     @api.expect(shopcart_item_model)
@@ -395,15 +597,58 @@ class ShopcartItemResource(Resource):
             )
 
         data = api.payload
+        version = requested_version(data)
         data["sid"] = shopcart_id
         data["id"] = item_id
         shopcart_item.deserialize(data)
-        shopcart_item.update()
+        shopcart_item.update(version)
 
         logger.info("Shopcart item with ID [%s] updated.", shopcart_item.id)
-        return shopcart_item.serialize(), status.HTTP_200_OK
+        return (shopcart_item.serialize(), status.HTTP_200_OK,
+                {"ETag": version_etag(shopcart_item.version)})
+
+    @idempotent
+    @api.param(IDEMPOTENCY_HEADER, 'A key unique to the request, sent again with its retries',
+               _in='header')
+    @api.doc('change_shopcart_item_amount')
+    @api.response(404, 'Shopcart Item not found')
+    @api.response(400, 'The delta was not valid')
+    @api.response(204, 'Shopcart Item has been deleted, its amount dropped to zero')
+    @api.response(200, 'Shopcart Item amount changed', shopcart_item_model)
+    @api.expect(shopcart_item_delta_model)
+    def patch(self, shopcart_id, item_id):
+        """
+        Change the amount of a Shopcart item
+        This endpoint will add the delta that is posted to the amount of a Shopcart item,
+        and delete the item when its amount drops to zero
+        """
+        logger.info("Request to change the amount of Shopcart item with id: %s", item_id)
+        check_content_type("application/json")
+
+        data = request.get_json()
+        delta = data.get("delta") if isinstance(data, dict) else None
+        if not isinstance(delta, int) or isinstance(delta, bool) or delta == 0:
+            raise DataValidationError("Invalid delta: must be a non-zero integer")
+
+        shopcart_item = ShopcartItem.change_amount(shopcart_id, item_id, delta)
+        if shopcart_item is None:
+            logger.info(
+                "Shopcart item with ID [%s] not found in shopcart [%s].", item_id, shopcart_id
+            )
+            api.abort(
+                status.HTTP_404_NOT_FOUND,
+                "Shopcart item with id '{}' was not found.".format(item_id)
+            )
+
+        if shopcart_item.amount <= 0:
+            logger.info("Shopcart item with ID [%s] deleted.", item_id)
+            return "", status.HTTP_204_NO_CONTENT
+        logger.info("Shopcart item with ID [%s] changed to %s.", item_id, shopcart_item.amount)
+        return (api.marshal(shopcart_item.serialize(), shopcart_item_model), status.HTTP_200_OK,
+                {"ETag": version_etag(shopcart_item.version)})
 
     @api.doc('delete_shopcart_item')
+    @api.response(409, 'Shopcart Item has been changed while it was being deleted')
     @api.response(204, 'Shopcart Item has been deleted')
     def delete(self, shopcart_id, item_id):
         """
@@ -422,6 +667,33 @@ class ShopcartItemResource(Resource):
         logger.info('ShopcartItem with id: %s has been deleted', item_id)
         return "", status.HTTP_204_NO_CONTENT
 
+######################################################################
+#  PATH: /shopcarts/{id}/summary
+######################################################################
+@api.route('/shopcarts/<int:shopcart_id>/summary')
+@api.param('shopcart_id', 'The Shopcart identifier')
+class ShopcartSummaryResource(Resource):
+    """ Totals of a single Shopcart """
+
+    @api.doc('get_shopcart_summary')
+    @api.response(404, 'Shopcart not found')
+    @api.marshal_with(shopcart_summary_model)
+    def get(self, shopcart_id):
+        """
+        Returns the totals of a Shopcart
+        This endpoint returns the subtotal, line count and unit count of a shopcart
+        """
+        logger.info("Request for the summary of Shopcart with id: %s", shopcart_id)
+        summary = Shopcart.summarize(shopcart_id)
+        if summary is None:
+            logger.info("Shopcart with ID [%s] not found.", shopcart_id)
+            api.abort(
+                status.HTTP_404_NOT_FOUND,
+                "Shopcart with id '{}' was not found.".format(shopcart_id)
+            )
+        return summary, status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /shopcarts/:id/items
 ######################################################################
@@ -431,20 +703,30 @@ class ShopcartItemCollection(Resource):
     """ Handles all interactions with collections of Shopcart Items """
 
     @api.doc('list_shopcart_items')
-    @api.response(200, 'Shopcart Items returned successfully')
-    @api.marshal_list_with(shopcart_item_model)
+    @api.response(304, 'Shopcart Items have not been modified')
+    @api.response(200, 'Shopcart Items returned successfully', [shopcart_item_model])
     def get(self, shopcart_id):
         """
         Get information of a shopcart
         This endpoint will return items in the shop cart
         """
         logger.info("Request to get items in a shopcart")
-        shopcart_items = ShopcartItem.find_by_shopcartid(shopcart_id)
-        result = [item.serialize() for item in shopcart_items]
+        headers = {}
+        etag = Shopcart.find_etag(shopcart_id)
+        if etag is not None:
+            if is_not_modified(etag):
+                logger.info("Items for Shopcart with ID [%s] not modified.", shopcart_id)
+                return not_modified(etag)
+            headers["ETag"] = quote_etag(etag)
+
+        shopcart_items = ShopcartItem.find_rows_by_shopcartid(shopcart_id)
         logger.info("Fetched items for Shopcart with ID [%s].", shopcart_id)
 
-        return result, status.HTTP_200_OK
+        return rows_response(shopcart_items, shopcart_item_encoder, headers)
 
+    @idempotent
+    @api.param(IDEMPOTENCY_HEADER, 'A key unique to the request, sent again with its retries',
+               _in='header')
     @api.doc('create_shopcart_item')
     @api.response(201, 'Shopcart Items has been created')
     @api.response(400, 'The posted data was not valid')
@@ -476,40 +758,136 @@ class ShopcartItemCollection(Resource):
         return shopcart_item, status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /shopcarts/:id/items:batch
+######################################################################
+@api.route('/shopcarts/<int:shopcart_id>/items:batch')
+@api.param('shopcart_id', 'The Shopcart identifier')
+class ShopcartItemBatchResource(Resource):
+    """ Adds many Shopcart Items to a Shopcart at once """
+
+    @idempotent
+    @api.param(IDEMPOTENCY_HEADER, 'A key unique to the request, sent again with its retries',
+               _in='header')
+    @api.doc('create_shopcart_items_batch')
+    @api.response(201, 'Shopcart Items have been created, one per posted item')
+    @api.response(400, 'The posted data was not valid')
+    @api.expect([create_shopcart_item_model])
+    @api.marshal_list_with(shopcart_item_model, code=201)
+    def post(self, shopcart_id):
+        """
+        Create a list of Shopcart Items
+        Items with the same sku are merged, and all of them are written in a single transaction.
+        The response holds one Shopcart Item per posted item, at the same position: the
+        stored row its sku was merged into, which repeats for the items with the same sku
+        """
+        logger.info("Request to create a batch of shopcart items")
+        check_content_type("application/json")
+
+        data = request.get_json()
+        if not isinstance(data, list) or not data:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      "The body of the request must be a non-empty list of items.")
+        if len(data) > constants.MAX_BATCH_SIZE:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      "A batch can hold at most {} items.".format(constants.MAX_BATCH_SIZE))
+
+        shopcart_items = []
+        for position, item_data in enumerate(data):
+            if not isinstance(item_data, dict):
+                raise DataValidationError(
+                    "Invalid shopcart item {}: body of request contained bad or no data".format(
+                        position)
+                )
+            item_data.pop("id", None)
+            item_data["sid"] = shopcart_id
+            try:
+                shopcart_items.append(ShopcartItem().deserialize(item_data))
+            except DataValidationError as error:
+                raise DataValidationError("Item {}: {}".format(position, error)) from error
+
+        results = ShopcartItem.add_all(shopcart_id, shopcart_items)
+
+        logger.info("[%s] ShopcartItems added to Shopcart [%s].", len(set(results)), shopcart_id)
+        return [item.serialize() for item in results], status.HTTP_201_CREATED
+
+
 ######################################################################
 #  PATH: /shopcarts/items
 ######################################################################
 @api.route('/shopcarts/items', strict_slashes=False)
 class ShopcartItemQueryCollection(Resource):
-    """LIST ALL Shopcart Items or Query by sku, name, price, or amount"""
+    """LIST ALL Shopcart Items or Query them by any combination of their attributes"""
 
     @api.doc('list_shopcart_items')
     @api.expect(shopcart_item_args, validate=True)
-    @api.marshal_list_with(shopcart_item_model)
+    @api.response(400, 'The query arguments were not valid')
+    @api.response(200, 'Shopcart Items returned successfully', [shopcart_item_model])
     def get(self):
-        """ Returns all of the ShopcartItems """
+        """ Returns all of the ShopcartItems that match the query """
         logger.info('Request to list ShopcartItems...')
 
         args = shopcart_item_args.parse_args()
-
-        if args['sku']:
-            logger.info('Find by sku')
-            shopcart_items = ShopcartItem.find_by_sku(args['sku'])
-        elif args['name']:
-            logger.info('Find by name')
-            shopcart_items = ShopcartItem.find_by_name(args['name'])
-        elif args['price']:
-            logger.info('Find by price')
-            shopcart_items = ShopcartItem.find_by_price(args['price'])
-        elif args['amount']:
-            logger.info('Find by amount')
-            shopcart_items = ShopcartItem.find_by_amount(args['amount'])
+        headers = {}
+        sort = args['sort']
+        if args['after_id'] is not None and sort != 'id':
+            api.abort(status.HTTP_400_BAD_REQUEST, "after_id can only be used with sort=id.")
+
+        filters = {name: args[name] for name in ITEM_FILTER_ARGS}
+        for name in ('updated_after', 'updated_before'):
+            filters[name] = to_utc(filters[name])
+        query = ShopcartItem.as_rows(ShopcartItem.find_by_filters(sort=sort, **filters))
+
+        if args['stream']:
+            logger.info('Stream query')
+            shopcart_items = query.yield_per(constants.STREAM_BATCH_SIZE)
+            return ndjson_rows_response(shopcart_items, shopcart_item_encoder)
+
+        if is_page_requested(args):
+            after_id, limit = check_page_args(args)
+            if sort == 'id':
+                logger.info('Find page of query')
+                shopcart_items = query.filter(ShopcartItem.id > after_id).limit(limit + 1).all()
+                query_args = {name: value for name, value in request.args.items()
+                              if name not in ('after_id', 'limit')}
+                shopcart_items, headers = paginate(shopcart_items, limit,
+                                                   ShopcartItemQueryCollection, **query_args)
+            else:
+                logger.info('Find top of query')
+                shopcart_items = query.limit(limit).all()
         else:
-            logger.info('Find all')
-            shopcart_items = ShopcartItem.all()
+            logger.info('Find query')
+            shopcart_items = query.all()
+
+        logger.info('[%s] Shopcart Items returned', len(shopcart_items))
+        return rows_response(shopcart_items, shopcart_item_encoder, headers)
+
 
-        results = [shopcart_item.serialize() for shopcart_item in shopcart_items]
-        logger.info('[%s] Shopcart Items returned', len(results))
+######################################################################
+#  PATH: /shopcarts/items/stats
+######################################################################
+@api.route('/shopcarts/items/stats')
+class SkuStatsResource(Resource):
+    """ Popularity of the products in all of the Shopcarts """
+
+    @api.doc('get_sku_stats')
+    @api.expect(sku_stats_args, validate=True)
+    @api.response(400, 'The query arguments were not valid')
+    @api.marshal_list_with(sku_stats_model)
+    def get(self):
+        """
+        Returns the most popular skus
+        This endpoint ranks the skus in all of the shopcarts by units or by revenue
+        """
+        logger.info('Request for sku stats')
+        args = sku_stats_args.parse_args()
+        if args['limit'] <= 0 or args['limit'] > constants.MAX_PAGE_SIZE:
+            api.abort(
+                status.HTTP_400_BAD_REQUEST,
+                "limit must be between 1 and {}.".format(constants.MAX_PAGE_SIZE)
+            )
+        results = ShopcartItem.sku_stats(args['limit'], args['sort'])
+        logger.info('[%s] skus returned', len(results))
         return results, status.HTTP_200_OK
 
 
@@ -520,9 +898,13 @@ class ShopcartItemQueryCollection(Resource):
 @api.param('shopcart_id', 'The Shopcart identifier')
 class PlaceOrderResource(Resource):
     """ Place Order action on a Shopcart"""
+    @idempotent
+    @api.param(IDEMPOTENCY_HEADER, 'A key unique to the request, sent again with its retries',
+               _in='header')
     @api.doc('place_order')
     @api.response(404, 'Shopcart not found or is empty')
     @api.response(400, 'Unable to place order for shopcart')
+    @api.response(202, 'Order has been queued and Shopcart has been deleted')
     @api.response(204, 'Shopcart has been deleted')
     def put(self, shopcart_id):
         """
@@ -531,7 +913,9 @@ class PlaceOrderResource(Resource):
         """
         logger.info('Request to place order for Shopcart with id: %s', shopcart_id)
 
-        shopcart = Shopcart.find(shopcart_id)
+        # in outbox mode the shopcart is locked so no item can be added while it is emptied
+        outbox = current_app.config["ORDER_OUTBOX"]
+        shopcart = Shopcart.find(shopcart_id, for_update=outbox)
 
         if not shopcart:
             logger.info("Shopcart with ID [%s] is does not exist.", shopcart_id)
@@ -540,34 +924,29 @@ class PlaceOrderResource(Resource):
                 "Shopcart with ID [%s] is does not exist." % shopcart_id
             )
 
-        shopcart_items = ShopcartItem.find_by_shopcartid(shopcart_id)
+        shopcart_items = ShopcartItem.find_by_shopcartid(shopcart_id, for_update=outbox)
         if shopcart_items is None or len(shopcart_items) == 0:
             logger.info("Shopcart with ID [%s] is empty.", shopcart_id)
             api.abort(
                 status.HTTP_404_NOT_FOUND,
                 "Shopcart with ID [%s] is empty." % shopcart_id
             )
-        shopcart_items_list = [item.serialize() for item in shopcart_items]
 
         # once we have the list of shopcart items we can send in JSON format to the orders team
-        #add the order status as PLACED for a new order
-        order_items= []
-        for item in shopcart_items_list:
-            order_item = {}
-            order_item["item_id"] = int(item["id"])
-            order_item["product_id"] = int(item["sku"])
-            order_item["quantity"] = int(item["amount"])
-            order_item["price"] = item["price"]
-            order_item["status"] = "PLACED"
-            order_items.append(order_item)
-        order = {
-            "customer_id": int(shopcart.serialize()["user_id"]),
-            "order_items": order_items,
-        }
-        payload = json.dumps(order)
-        headers = {'content-type': 'application/json'}
-        res = requests.post(
-                ORDER_ENDPOINT, data=payload, headers=headers
+        order = build_order(shopcart, shopcart_items)
+        if outbox:
+            queued = OrderOutbox.enqueue(shopcart, order)
+            logger.info('Order %s queued and Shopcart with id: %s has been deleted',
+                        queued.id, shopcart_id)
+            return make_response("", status.HTTP_202_ACCEPTED)
+
+        try:
+            res = order_client.post(json.dumps(order))
+        except requests.RequestException as error:
+            logger.error('Unable to reach the Order Service: %s', error)
+            api.abort(
+                status.HTTP_400_BAD_REQUEST,
+                "Unable to place order for shopcart [%s]." % shopcart_id
             )
         logger.info('Put Order response %d %s', res.status_code, res.text)
 
@@ -599,8 +978,113 @@ def check_content_type(content_type):
     abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, 'Content-Type must be {}'.format(content_type))
 
 
-def init_db():
-    """ Initialies the SQLAlchemy app """
-    Shopcart.init_db(app)
-    ShopcartItem.init_db(app)
-    logger.info("Database has been initialized!")
+def is_not_modified(etag):
+    """ Checks whether the client already has the representation with this entity tag """
+    return request.if_none_match.contains_weak(etag)
+
+
+def version_etag(version):
+    """ Returns the quoted entity tag of a version of a record """
+    return quote_etag(str(version))
+
+
+def requested_version(data):
+    """ Returns the version of a record a write was made to, or None for any version
+    It is the ETag of If-Match, or else the version field of the body
+    """
+    if request.if_match.star_tag:
+        return None
+    etags = request.if_match.as_set()
+    if etags:
+        etag = etags.pop()
+        if etags or not etag.isdigit():
+            raise DataValidationError("Invalid If-Match: must be the ETag of one version")
+        return int(etag)
+    version = data.get("version") if isinstance(data, dict) else None
+    if version is not None and (not isinstance(version, int) or isinstance(version, bool)):
+        raise DataValidationError("Invalid version: must be an integer")
+    return version
+
+
+def not_modified(etag):
+    """ Returns an empty 304_NOT_MODIFIED response for an entity tag """
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+
+def to_utc(value):
+    """ Converts a datetime to the naive UTC time the timestamps are stored in """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def is_page_requested(args):
+    """ Checks whether the query string asks for a single page of a list """
+    return args['after_id'] is not None or args['limit'] is not None
+
+
+def check_page_args(args):
+    """ Returns the after_id and limit of a page request, or aborts if they are invalid """
+    after_id = args['after_id'] if args['after_id'] is not None else 0
+    limit = args['limit'] if args['limit'] is not None else constants.DEFAULT_PAGE_SIZE
+    if limit <= 0 or limit > constants.MAX_PAGE_SIZE:
+        api.abort(
+            status.HTTP_400_BAD_REQUEST,
+            "limit must be between 1 and {}.".format(constants.MAX_PAGE_SIZE)
+        )
+    return after_id, limit
+
+
+def paginate(records, limit, resource, **query_args):
+    """
+    Trims a page that was fetched with one record more than its limit
+    and returns it with the headers pointing to the next page, if there is one
+    """
+    if len(records) <= limit:
+        return records, {}
+
+    records = records[:limit]
+    after_id = records[-1].id
+    next_url = api.url_for(resource, after_id=after_id, limit=limit, _external=True,
+                           **query_args)
+    headers = {
+        constants.NEXT_AFTER_ID_HEADER: str(after_id),
+        "Link": '<{}>; rel="next"'.format(next_url)
+    }
+    return records, headers
+
+
+def ndjson_response(records, model):
+    """ Streams serialized records as newline delimited JSON marshalled with a model """
+    def generate():
+        for record in records:
+            yield json.dumps(marshal(record, model)) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype=constants.NDJSON_MIMETYPE)
+
+
+def ndjson_rows_response(rows, row_encoder):
+    """ Streams plain rows as newline delimited JSON, like ndjson_response() """
+    def generate():
+        for row in rows:
+            yield row_encoder.encode(row) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype=constants.NDJSON_MIMETYPE)
+
+
+def rows_response(rows, row_encoder, headers=None):
+    """
+    Returns a list of plain rows as the JSON that api.marshal() of the rows
+    would return, encoded directly from the rows when the Api allows it
+    """
+    if not encodes_like(api):
+        # marshal() takes tuples for lists, so the rows become dictionaries first
+        records = [dict(zip(row_encoder.names, row)) for row in rows]
+        with timed("serialize"):
+            data = api.marshal(records, row_encoder.model)
+        return data, status.HTTP_200_OK, headers
+    with timed("serialize"):
+        body = row_encoder.encode_list(rows) + "\n"
+    return Response(body, status=status.HTTP_200_OK, headers=headers, mimetype="application/json")
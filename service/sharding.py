@@ -0,0 +1,345 @@
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Horizontal sharding of the shopcarts
+
+Shard 0 is the database of SQLALCHEMY_DATABASE_URI, shard n the "shard<n>"
+entry of SQLALCHEMY_BINDS. A new shopcart goes to the shard picked by a
+hash of its user_id, and its items and orders follow it. Every id encodes
+its shard, since each shard only hands out ids with id % N == shard, so a
+row is found by its id alone:
+
+- Query.get(), refreshes and lazy loads go to the shard of the id
+- on_shard() and on_shard_of() restrict any other query to one shard
+- flushes write every object to its own shard
+- the remaining queries fan out to every shard: plain SELECTs run
+  concurrently on a thread pool the app shares across its requests, with
+  a thread per shard for every request thread, and the rows of the shards
+  are merged by the ORDER BY of the query before LIMIT and OFFSET apply
+
+Aggregates are computed by every shard on its own rows, so a GROUP BY that
+fans out returns one row per shard and group.
+
+With a single shard every statement goes straight to the primary, as before.
+"""
+import heapq
+import itertools
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import event, func, orm, select
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+from service.instrumentation import current_timings, use_timings
+from service.replica import RoutingSession, RoutingSQLAlchemy
+
+SHARD_BIND = "shard{}"
+
+
+class ShardMap:
+    """ Maps users and ids to the shards they are stored in """
+
+    def __init__(self, count):
+        self.count = count
+
+    def for_id(self, row_id):
+        """ Returns the shard of a shopcart, item or order by its id """
+        return int(row_id) % self.count
+
+    def for_user(self, user_id):
+        """ Returns the shard the shopcarts of a user are stored in """
+        return zlib.crc32(str(user_id).encode("utf-8")) % self.count
+
+    def next_id(self, last_id, shard):
+        """ Returns the first id of a shard that is greater than last_id """
+        last_id = last_id or 0
+        next_id = last_id - last_id % self.count + shard
+        return next_id + self.count if next_id <= last_id else next_id
+
+
+def shard_count(config):
+    """ Returns the number of shards configured for a Flask app """
+    binds = config.get("SQLALCHEMY_BINDS") or {}
+    count = 1
+    while SHARD_BIND.format(count) in binds:
+        count += 1
+    return count
+
+
+class _SortKey:
+    """ Orders rows like the database does, with NULLs after every value """
+
+    __slots__ = ("values", "descending")
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for value, other_value, descending in zip(self.values, other.values, self.descending):
+            if value == other_value:
+                continue
+            less = (value is None, value) < (other_value is None, other_value)
+            return not less if descending else less
+        return False
+
+
+class ShardedQuery(BaseQuery):
+    """ A query that runs on the shard of its rows, or on every shard """
+
+    _shard = None
+
+    def on_shard(self, shard):
+        """ Restricts the query to one shard """
+        query = self._clone()
+        query._shard = shard  # pylint: disable=protected-access
+        return query
+
+    def on_shard_of(self, row_id):
+        """ Restricts the query to the shard of a shopcart, item or order id """
+        return self.on_shard(self.session.shards.for_id(row_id))
+
+    def on_user_shard(self, user_id):
+        """ Restricts the query to the shard of the shopcarts of a user """
+        return self.on_shard(self.session.shards.for_user(user_id))
+
+    def get(self, ident):
+        if self._shard is None and self.session.shards.count > 1:
+            return self.on_shard_of(ident).get(ident)
+        return super().get(ident)
+
+    def count(self):
+        if self.session.shards.count == 1 or self._query_shard() is not None:
+            return super().count()
+        return sum(self.on_shard(shard).count() for shard in range(self.session.shards.count))
+
+    def _query_shard(self):
+        """ Returns the shard the query has to run on, or None for every shard """
+        if self._shard is not None:
+            return self._shard
+        for state in (self._refresh_state, self.lazy_loaded_from):
+            if state is not None and state.key is not None:
+                return self.session.shards.for_id(state.key[1][0])
+        # the children that eager loaders fetch live with their parents
+        return self.session.loading_shard
+
+    def _connection_from_session(self, **kw):
+        shard = self._query_shard()
+        if shard is not None:
+            kw["bind"] = self.session.shard_engine(shard)
+        return super()._connection_from_session(**kw)
+
+    def _execute_and_instances(self, querycontext):
+        session = self.session
+        if session.shards.count == 1:
+            return super()._execute_and_instances(querycontext)
+        shard = self._query_shard()
+        if shard is not None:
+            return self._instances_on_shard(querycontext, shard)
+        return self._fan_out()
+
+    def _instances_on_shard(self, querycontext, shard):
+        """ Loads the rows of one shard, with their eagerly loaded children """
+        query = self.on_shard(shard)
+        instances = super(ShardedQuery, query)._execute_and_instances(querycontext)
+        if self._yield_per:
+            return instances
+        session = self.session
+        previous, session.loading_shard = session.loading_shard, shard
+        try:
+            return iter(list(instances))
+        finally:
+            session.loading_shard = previous
+
+    def _execute_crud(self, stmt, mapper):
+        if self.session.shards.count == 1 or self._query_shard() is not None:
+            return super()._execute_crud(stmt, mapper)
+        results = [super(ShardedQuery, self.on_shard(shard))._execute_crud(stmt, mapper)
+                   for shard in range(self.session.shards.count)]
+        return _FanOutResult(sum(result.rowcount for result in results))
+
+    def _fan_out(self):
+        """ Runs the query on every shard and merges the rows """
+        limit, offset = self._limit, self._offset or 0
+        query = self.limit(None).offset(None)
+        if limit is not None:
+            query = query.limit(offset + limit)
+
+        shards = range(self.session.shards.count)
+        entities = [description["type"] is description["entity"]
+                    for description in self.column_descriptions]
+        if self._yield_per or self._for_update_arg is not None or (
+                any(entities) and entities != [True]):
+            # locks have to be held by this session, and streams stay lazy
+            results = [iter(query.on_shard(shard)) for shard in shards]
+        else:
+            results = self._load_concurrently(query, shards, entities == [True])
+
+        sort_key = self._sort_key()
+        if sort_key is None:
+            rows = itertools.chain(*results)
+        else:
+            rows = heapq.merge(*results, key=sort_key)
+        return itertools.islice(rows, offset, None if limit is None else offset + limit)
+
+    def _load_concurrently(self, query, shards, merge):
+        """ Runs a plain SELECT on every shard at once, in sessions of their own """
+        session = self.session
+        app = session.app
+        timings = current_timings()
+
+        def load(shard):
+            with app.app_context():
+                use_timings(timings)
+                shard_session = session.fork()
+                try:
+                    return query.with_session(shard_session).on_shard(shard).all()
+                finally:
+                    shard_session.close()
+
+        results = list(session.db.get_shard_executor(app).map(load, shards))
+        if merge:
+            results = [[session.merge(row, load=False) for row in rows] for rows in results]
+        return results
+
+    def _sort_key(self):
+        """ Returns a function that orders rows by the ORDER BY of the query """
+        keys = []
+        descending = []
+        for clause in self._order_by or ():
+            if isinstance(clause, UnaryExpression) and clause.modifier in (operators.desc_op,
+                                                                            operators.asc_op):
+                descending.append(clause.modifier is operators.desc_op)
+                clause = clause.element
+            else:
+                descending.append(False)
+            key = getattr(clause, "key", None)
+            if not isinstance(key, str):
+                return None
+            keys.append(key)
+        if not keys:
+            return None
+        descending = tuple(descending)
+        return lambda row: _SortKey(tuple(getattr(row, key) for key in keys), descending)
+
+
+class _FanOutResult:  # pylint: disable=too-few-public-methods
+    """ The result of an UPDATE or DELETE that ran on every shard """
+
+    def __init__(self, rowcount):
+        self.rowcount = rowcount
+
+
+class ShardedSession(RoutingSession):
+    """ A session that keeps every row on the shard of its shopcart """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.shards = ShardMap(shard_count(self.app.config))
+        self.loading_shard = None
+        if self.shards.count > 1:
+            self.connection_callable = self._connection_for_instance
+
+    def shard_engine(self, shard):
+        """ Returns the engine of a shard, or None for the primary """
+        if shard == 0:
+            return None
+        return self.db.get_engine(self.app, bind=SHARD_BIND.format(shard))
+
+    def shard_of(self, instance):
+        """ Returns the shard an object is stored in, or will be """
+        state = instance_state(instance)
+        if state.key is not None:
+            return self.shards.for_id(state.key[1][0])
+        return instance.shard(self.shards)
+
+    def _connection_for_instance(self, mapper, instance):
+        return self.connection(mapper=mapper, bind=self.shard_engine(self.shard_of(instance)))
+
+
+def _allocate_id(mapper, connection, target):
+    """ Picks the id of a new row for databases without sequences
+    On PostgreSQL `flask init-db` makes the sequences of each shard hand
+    out the ids of that shard. Other databases, used to run the service
+    locally, get the next id of the shard from the rows it already has.
+    """
+    session = orm.object_session(target)
+    if session.shards.count == 1 or connection.dialect.name == "postgresql":
+        return
+    column = mapper.primary_key[0]
+    if getattr(target, column.key) is not None:
+        return
+    last_id = connection.execute(select([func.max(column)])).scalar()
+    setattr(target, column.key, session.shards.next_id(last_id, session.shard_of(target)))
+
+
+class ShardedSQLAlchemy(RoutingSQLAlchemy):
+    """ Flask-SQLAlchemy with sessions and queries that route rows to their shard """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("query_class", ShardedQuery)
+        super().__init__(**kwargs)
+        self._executor_lock = threading.Lock()
+        event.listen(self.Model, "before_insert", _allocate_id, propagate=True)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ShardedSession, db=self, **options)
+
+    @property
+    def shards(self):
+        """ The shard map of the current session """
+        return self.session().shards
+
+    def shard_engine(self, shard):
+        """ Returns the engine of a shard, or None for the primary """
+        return self.session().shard_engine(shard)
+
+    def get_shard_engines(self, app=None):
+        """ Returns the engines of every shard, the primary first """
+        app = self.get_app(app)
+        return [self.get_engine(app)] + [
+            self.get_engine(app, bind=SHARD_BIND.format(shard))
+            for shard in range(1, shard_count(app.config))
+        ]
+
+    def get_shard_executor(self, app=None):
+        """ Returns the thread pool that runs the fan-out queries of an app
+
+        It is made on first use, so in each gunicorn worker rather than in the
+        master that preloads the app, with a thread per shard for every
+        thread serving requests.
+        """
+        app = self.get_app(app)
+        with self._executor_lock:
+            executor = app.extensions.get("shard_executor")
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=shard_count(app.config) * app.config.get("GUNICORN_THREADS", 1),
+                    thread_name_prefix="shard",
+                )
+                app.extensions["shard_executor"] = executor
+        return executor
+
+    def create_all(self, bind="__all__", app=None):
+        super().create_all(bind, app)
+        if bind == "__all__":
+            for engine in self.get_shard_engines(app)[1:]:
+                self.Model.metadata.create_all(bind=engine)
+
+    def drop_all(self, bind="__all__", app=None):
+        super().drop_all(bind, app)
+        if bind == "__all__":
+            for engine in self.get_shard_engines(app)[1:]:
+                self.Model.metadata.drop_all(bind=engine)
@@ -0,0 +1,39 @@
+"""
+Base Test Case for the tests that run against the test database
+"""
+import unittest
+from service.models import db
+from config import DATABASE_URI
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """ Runs every test in an app context on an empty test database
+
+    Subclasses set flask_app to the app of their module.
+    """
+
+    flask_app = None
+    testing = True
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once before Test suite """
+        cls.flask_app.debug = False
+        cls.flask_app.testing = cls.testing
+        # Set up the test database
+        cls.flask_app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        cls.context = cls.flask_app.app_context()
+        cls.context.push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """ These run once after Test suite """
+        cls.context.pop()
+
+    def setUp(self):
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
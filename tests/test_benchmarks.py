@@ -0,0 +1,111 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the benchmarks
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import random
+import unittest
+from database_test_case import DatabaseTestCase
+from benchmarks import seed, workload
+from benchmarks.order_stub import StubOrderService
+from service.models import Shopcart, ShopcartItem, db
+from service.orders import order_client
+from service import create_app
+
+app = create_app()
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestBenchmarks(DatabaseTestCase):
+    """ Test Cases for the benchmarks """
+
+    flask_app = app
+
+    def setUp(self):
+        super().setUp()
+        self.stub = StubOrderService().start()
+        self.order_endpoint = app.config["ORDER_ENDPOINT"]
+        app.config["ORDER_ENDPOINT"] = self.stub.endpoint
+        order_client.init_app(app)
+
+    def tearDown(self):
+        self.stub.stop()
+        app.config["ORDER_ENDPOINT"] = self.order_endpoint
+        order_client.init_app(app)
+        super().tearDown()
+
+    def test_seed(self):
+        """ Seed shopcarts with items made by the factories """
+        items = seed.seed(30, 4, batch_size=7, rng=random.Random(1))
+        shopcarts = Shopcart.all()
+        self.assertEqual(len(shopcarts), 30)
+        self.assertEqual(len(ShopcartItem.all()), items)
+        self.assertEqual(len({shopcart.user_id for shopcart in shopcarts}), 30)
+
+        # the next shopcarts follow the seeded ones
+        seed.seed(5, 0)
+        shopcart = Shopcart(user_id=1000)
+        shopcart.create()
+        self.assertEqual(shopcart.id, 36)
+
+    def test_run(self):
+        """ Drive a request mix and report every endpoint """
+        seed.seed(20, 3, rng=random.Random(1))
+        pool = workload.CartPool([shopcart.id for shopcart in Shopcart.all()], 20)
+        db.session.remove()
+
+        report = workload.run(app, pool, dict(workload.DEFAULT_MIX), 60, concurrency=2)
+        self.assertEqual(report["requests"], 60)
+        self.assertEqual(sorted(report["endpoints"]), sorted(workload.DEFAULT_MIX))
+        for summary in report["endpoints"].values():
+            latency = summary["latency_ms"]
+            self.assertLessEqual(latency["p50"], latency["p95"])
+            self.assertLessEqual(latency["p95"], latency["p99"])
+            self.assertLessEqual(latency["p99"], latency["max"])
+            self.assertFalse([code for code in summary["statuses"] if code.startswith("5")])
+        orders = report["endpoints"]["place_order"]["statuses"].get("204", 0)
+        self.assertEqual(self.stub.orders, orders)
+
+    def test_empty_pool(self):
+        """ Create shopcarts when there are none left to work on """
+        report = workload.run(app, workload.CartPool([], 0), {"place_order": 1}, 3)
+        self.assertEqual(report["endpoints"]["create_cart"]["statuses"], {"201": 2})
+        # the new shopcart has no item to order
+        self.assertEqual(report["endpoints"]["place_order"]["statuses"], {"404": 1})
+
+    def test_parse_mix(self):
+        """ Parse the weights of the operations """
+        self.assertEqual(workload.parse_mix("get_cart=70, add_item=30"),
+                         {"get_cart": 70, "add_item": 30})
+        for mix in ("get_cart=1,checkout=1", "get_cart=many", "get_cart=-1", "get_cart=0"):
+            self.assertRaises(ValueError, workload.parse_mix, mix)
+
+    def test_percentile(self):
+        """ Compute nearest-rank percentiles """
+        values = list(range(1, 101))
+        self.assertEqual(workload.percentile(values, 50), 50)
+        self.assertEqual(workload.percentile(values, 99), 99)
+        self.assertEqual(workload.percentile([7], 95), 7)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
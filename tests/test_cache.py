@@ -0,0 +1,212 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Shopcart cache
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from service.cache import LRUCache, NullCache, RedisCache, ShopcartCache
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(TestCase):
+    """ Test Cases for the in-process cache backend """
+
+    def test_get_and_set(self):
+        """ Get a value back from the cache """
+        cache = LRUCache()
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", {"id": 1})
+        self.assertEqual(cache.get("a"), {"id": 1})
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+        cache.delete("a")
+
+    @patch("service.cache.time.monotonic")
+    def test_add(self, monotonic):
+        """ Add a value only if the key has none """
+        monotonic.return_value = 100.0
+        cache = LRUCache(ttl=10)
+        self.assertTrue(cache.add("a", 1))
+        self.assertFalse(cache.add("a", 2))
+        self.assertEqual(cache.get("a"), 1)
+        monotonic.return_value = 110.0
+        self.assertTrue(cache.add("a", 3))
+        self.assertEqual(cache.get("a"), 3)
+        self.assertTrue(NullCache().add("a", 1))
+
+    def test_evict_least_recently_used(self):
+        """ Evict the least recently used value when the cache is full """
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    @patch("service.cache.time.monotonic")
+    def test_expire_after_ttl(self, monotonic):
+        """ Forget a value once its TTL has passed """
+        monotonic.return_value = 100.0
+        cache = LRUCache(ttl=10)
+        cache.set("a", 1)
+        monotonic.return_value = 109.0
+        self.assertEqual(cache.get("a"), 1)
+        monotonic.return_value = 110.0
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        """ Clear every value from the cache """
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class FakeRedis:
+    """ The part of the redis client that RedisCache uses, in memory """
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+
+    def get(self, key):
+        """ Returns the value of a key """
+        return self.values.get(key)
+
+    def mget(self, keys):
+        """ Returns the values of several keys """
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, px=None, nx=False):  # pylint: disable=invalid-name
+        """ Stores a value, only for a key without one with nx """
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        self.expires[key] = px
+        return True
+
+    def delete(self, *keys):
+        """ Removes keys """
+        for key in keys:
+            self.values.pop(key, None)
+
+    def scan_iter(self, match):
+        """ Returns the keys that match a pattern ending with * """
+        return [key for key in self.values if key.startswith(match.rstrip("*"))]
+
+
+class TestRedisCache(TestCase):
+    """ Test Cases for the Redis cache backend """
+
+    def test_get_and_set(self):
+        """ Keep the values pickled under the namespace of the cache """
+        client = FakeRedis()
+        cache = RedisCache(client, ttl=2.5, namespace="shopcart")
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", {"id": 1})
+        self.assertEqual(cache.get("a"), {"id": 1})
+        self.assertEqual(list(client.values), ["shopcart:a"])
+        self.assertEqual(client.expires["shopcart:a"], 2500)
+        self.assertEqual(cache.get_many(["a", "b"]), [{"id": 1}, None])
+        self.assertFalse(cache.add("a", 2))
+        self.assertTrue(cache.add("b", 2))
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+
+    def test_clear(self):
+        """ Clear only the values of the namespace """
+        client = FakeRedis()
+        client.set("idempotency:a", b"")
+        cache = RedisCache(client, namespace="shopcart")
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.clear()
+        self.assertEqual(list(client.values), ["idempotency:a"])
+
+
+class TestShopcartCache(TestCase):
+    """ Test Cases for the Shopcart cache """
+
+    def test_init_app(self):
+        """ Set up the backend from the app configuration """
+        app = Flask(__name__)
+        cache = ShopcartCache()
+        self.assertIsInstance(cache.backend, NullCache)
+        app.config.update(SHOPCART_CACHE_BACKEND="memory",
+                          SHOPCART_CACHE_SIZE=5, SHOPCART_CACHE_TTL=2)
+        cache.init_app(app)
+        self.assertIsInstance(cache.backend, LRUCache)
+        self.assertEqual(cache.backend.max_size, 5)
+        self.assertEqual(cache.backend.ttl, 2)
+        app.config["SHOPCART_CACHE_BACKEND"] = "none"
+        cache.init_app(app)
+        self.assertIsInstance(cache.backend, NullCache)
+        app.config.update(SHOPCART_CACHE_BACKEND="redis", REDIS_URL="redis://cache:6379/1")
+        with patch.object(RedisCache, "from_url") as from_url:
+            cache.init_app(app)
+        from_url.assert_called_once_with("redis://cache:6379/1", ttl=2, namespace="shopcart")
+        app.config["SHOPCART_CACHE_BACKEND"] = "memcached"
+        self.assertRaises(ValueError, cache.init_app, app)
+
+    def test_invalidate(self):
+        """ Invalidate the cached copies of shopcarts """
+        cache = ShopcartCache(LRUCache())
+        for shopcart_id in (1, 2, 3):
+            cache.set(shopcart_id, {"id": shopcart_id}, cache.lookup(shopcart_id)[1])
+        self.assertEqual(cache.get(1), {"id": 1})
+        cache.invalidate(1, 2)
+        self.assertIsNone(cache.get(1))
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), {"id": 3})
+
+    def test_copy_read_before_a_write(self):
+        """ Never serve a copy read before a write that committed while it was read """
+        cache = ShopcartCache(LRUCache())
+        self.assertEqual(cache.lookup(1)[0], None)
+        generation = cache.lookup(1)[1]
+        cache.invalidate(1)
+        cache.set(1, {"amount": 1}, generation)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {"amount": 2}, cache.lookup(1)[1])
+        self.assertEqual(cache.get(1), {"amount": 2})
+
+    def test_generation_expired(self):
+        """ Drop a copy whose generation was evicted """
+        backend = LRUCache()
+        cache = ShopcartCache(backend)
+        cache.set(1, {"id": 1}, cache.lookup(1)[1])
+        backend.delete("1:generation")
+        self.assertIsNone(cache.get(1))
+
+    def test_turned_off(self):
+        """ Cache nothing with the null backend """
+        cache = ShopcartCache()
+        cache.set(1, {"id": 1}, cache.lookup(1)[1])
+        self.assertEqual(cache.lookup(1), (None, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
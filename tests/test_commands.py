@@ -0,0 +1,230 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the command line tasks
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch, Mock
+import requests
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from database_test_case import DatabaseTestCase
+from service.models import Shopcart, ShopcartItem, db
+from service import create_app, commands
+from service.idempotency import IdempotencyKey
+from service.orders import OrderOutbox, order_client
+
+app = create_app()
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCommands(DatabaseTestCase):
+    """ Test Cases for the command line tasks """
+
+    flask_app = app
+    testing = False
+
+    def setUp(self):
+        super().setUp()
+        self.runner = app.test_cli_runner()
+
+    def _create_shopcart(self, user_id, age):
+        """ Creates a shopcart with one item that were last updated age ago """
+        shopcart = Shopcart(user_id=user_id)
+        shopcart.create()
+        shopcart_item = ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23,
+                                     amount=3)
+        shopcart_item.create()
+        shopcart.update_time = shopcart_item.update_time = datetime.utcnow() - age
+        db.session.commit()
+        return shopcart
+
+    def test_init_db(self):
+        """ Create the missing tables and keep the existing ones """
+        db.drop_all()
+        result = self.runner.invoke(commands.init_db_command)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Database tables are created", result.output)
+        Shopcart(user_id=1).create()
+
+        result = self.runner.invoke(commands.init_db_command)
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(len(Shopcart.all()), 1)
+
+    def test_create_app_does_not_connect(self):
+        """ Build an app without connecting to the database """
+        with patch("sqlalchemy.engine.Engine.connect") as connect:
+            create_app()
+        connect.assert_not_called()
+
+    def test_purge_carts(self):
+        """ Purge the abandoned shopcarts in batches """
+        for user_id in range(1, 4):
+            self._create_shopcart(user_id, timedelta(hours=3))
+        recent_id = self._create_shopcart(4, timedelta(minutes=5)).id
+
+        result = self.runner.invoke(commands.purge_carts_command,
+                                    ["--ttl-hours", "2", "--batch-size", "2", "--sleep", "0"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Purged 2 shopcarts and 2 items\n", result.output)
+        self.assertIn("Purged 1 shopcarts and 1 items\n", result.output)
+        self.assertIn("Purged 3 shopcarts and 3 items in", result.output)
+        self.assertIn("rows/sec", result.output)
+        self.assertEqual([shopcart.id for shopcart in Shopcart.all()], [recent_id])
+        self.assertEqual(len(ShopcartItem.all()), 1)
+
+    def test_purge_carts_with_default_settings(self):
+        """ Purge with the TTL and batch size from the configuration """
+        self._create_shopcart(1, timedelta(hours=app.config["CART_TTL_HOURS"] + 1))
+        self._create_shopcart(2, timedelta(hours=1))
+        result = self.runner.invoke(commands.purge_carts_command)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Purged 1 shopcarts and 1 items in", result.output)
+        self.assertEqual(len(Shopcart.all()), 1)
+
+    def test_purge_carts_with_bad_batch_size(self):
+        """ Purge with a batch size that is not positive """
+        result = self.runner.invoke(commands.purge_carts_command, ["--batch-size", "0"])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_purge_idempotency_keys(self):
+        """ Purge the idempotency keys older than their TTL in batches """
+        for key in ("key-1", "key-2", "key-3"):
+            IdempotencyKey.reserve(key, "a")
+        IdempotencyKey.query.update({"create_time": datetime.utcnow() - timedelta(days=2)})
+        IdempotencyKey.reserve("key-4", "a")
+        db.session.commit()
+
+        result = self.runner.invoke(commands.purge_idempotency_keys_command,
+                                    ["--batch-size", "2", "--sleep", "0"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Purged 3 idempotency keys sent before", result.output)
+        self.assertEqual([row.key for row in IdempotencyKey.query.all()], ["key-4"])
+
+    def test_purge_idempotency_keys_with_bad_batch_size(self):
+        """ Purge the idempotency keys with a batch size that is not positive """
+        result = self.runner.invoke(commands.purge_idempotency_keys_command, ["--batch-size", "0"])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def _queue_orders(self, count):
+        """ Places orders for shopcarts in the outbox """
+        for user_id in range(1, count + 1):
+            shopcart = self._create_shopcart(user_id, timedelta(0))
+            OrderOutbox.enqueue(shopcart, {"customer_id": user_id, "order_items": []})
+
+    def test_dispatch_orders(self):
+        """ Send the orders in the outbox in batches """
+        self._queue_orders(3)
+        with patch.object(order_client.session, "post") as post:
+            post.return_value = Mock(status_code=201, text="")
+            result = self.runner.invoke(commands.dispatch_orders_command,
+                                        ["--batch-size", "2", "--once"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Sent 2 orders, 0 failed\n", result.output)
+        self.assertIn("Sent 1 orders, 0 failed\n", result.output)
+        self.assertIn("Sent 3 orders, 0 failed\n", result.output)
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(OrderOutbox.all(), [])
+
+    def test_dispatch_orders_one_transaction_each(self):
+        """ Commit each order before the next one is posted """
+        self._queue_orders(3)
+        commits = []
+        commits_before_post = []
+
+        def count_commit(conn):
+            commits.append(conn)
+
+        def post(*args, **kwargs):  # pylint: disable=unused-argument
+            commits_before_post.append(len(commits))
+            return Mock(status_code=201, text="")
+
+        event.listen(Engine, "commit", count_commit)
+        try:
+            with patch.object(order_client.session, "post", side_effect=post):
+                result = self.runner.invoke(commands.dispatch_orders_command, ["--once"])
+        finally:
+            event.remove(Engine, "commit", count_commit)
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(commits_before_post, [0, 1, 2])
+        self.assertEqual(OrderOutbox.all(), [])
+
+    def test_dispatch_orders_with_failures(self):
+        """ Back off the orders that could not be sent """
+        self._queue_orders(2)
+        with patch.object(order_client.session, "post") as post:
+            post.side_effect = [Mock(status_code=503, text="busy"),
+                                requests.exceptions.ConnectTimeout("timed out")]
+            result = self.runner.invoke(commands.dispatch_orders_command, ["--once"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Sent 0 orders, 2 failed\n", result.output)
+        orders = OrderOutbox.all()
+        self.assertEqual([order.attempts for order in orders], [1, 1])
+        self.assertEqual(orders[0].last_error, "HTTP 503 busy")
+        self.assertEqual(orders[1].last_error, "timed out")
+        self.assertTrue(all(order.next_attempt_time > datetime.utcnow() for order in orders))
+
+        # nothing is due until the back off has passed
+        with patch.object(order_client.session, "post") as post:
+            result = self.runner.invoke(commands.dispatch_orders_command, ["--once"])
+        post.assert_not_called()
+        self.assertIn("Sent 0 orders, 0 failed\n", result.output)
+
+    def test_dispatch_orders_gives_up(self):
+        """ Mark an order failed once it has failed too many times """
+        self._queue_orders(1)
+        app.config["ORDER_OUTBOX_MAX_ATTEMPTS"] = 2
+        try:
+            with patch.object(order_client.session, "post") as post:
+                post.return_value = Mock(status_code=400, text="bad order")
+                self.runner.invoke(commands.dispatch_orders_command, ["--once"])
+                order = OrderOutbox.all()[0]
+                self.assertIsNone(order.failed_time)
+                order.next_attempt_time = datetime.utcnow()
+                db.session.commit()
+                with self.assertLogs("service.orders", "ERROR") as logs:
+                    result = self.runner.invoke(commands.dispatch_orders_command, ["--once"])
+                self.assertIn("Sent 0 orders, 1 failed\n", result.output)
+                self.assertIn("failed 2 times, giving up: HTTP 400 bad order", logs.output[0])
+
+                # a failed order is never sent again
+                order = OrderOutbox.all()[0]
+                self.assertIsNotNone(order.failed_time)
+                self.assertEqual(order.attempts, 2)
+                order.next_attempt_time = datetime.utcnow()
+                db.session.commit()
+                result = self.runner.invoke(commands.dispatch_orders_command, ["--once"])
+            self.assertEqual(post.call_count, 2)
+            self.assertIn("Sent 0 orders, 0 failed\n", result.output)
+        finally:
+            app.config["ORDER_OUTBOX_MAX_ATTEMPTS"] = 20
+
+    def test_dispatch_orders_with_bad_batch_size(self):
+        """ Send orders with a batch size that is not positive """
+        result = self.runner.invoke(commands.dispatch_orders_command, ["--batch-size", "-1"])
+        self.assertNotEqual(result.exit_code, 0)
+
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
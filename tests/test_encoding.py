@@ -0,0 +1,138 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the JSON encoding of plain rows
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import json
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+from flask_api import status  # HTTP Status Codes
+from flask_restplus import Model, fields, marshal
+from database_test_case import DatabaseTestCase
+from service.encoding import RowEncoder
+from service.models import Shopcart, ShopcartItem, db
+from service.routes import shopcart_item_model, shopcart_item_encoder
+from service import create_app
+
+app = create_app()
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRowEncoder(unittest.TestCase):
+    """ Test Cases for the RowEncoder """
+
+    def _marshalled(self, row):
+        """ Returns the JSON flask-restplus writes for a row """
+        return json.dumps(marshal(dict(zip(shopcart_item_encoder.names, row)),
+                                  shopcart_item_model))
+
+    def test_encode_like_marshal(self):
+        """ Encode rows as json.dumps of the marshalled rows """
+        rows = [
+            (1, 2, 3000, "soap", 2.23, 3, datetime(2020, 4, 1, 12, 30, 5, 123),
+             datetime(2020, 4, 1, 12, 30), 1),
+            (4, None, 0, "café \"bar\"\n\U0001f600", 0.1 + 0.2, -1, None, None, 2),
+            (5, 6, 7, "", float("nan"), 0, datetime(2020, 1, 1), datetime(2020, 1, 1), 3),
+            (8, 9, 10, "x", float("-inf"), 11, None, None, 4),
+            (12, 13, 14, None, None, None, None, None, None),
+            (True, 15.9, 16, 17, 18, 19.5, None, None, 5.5),
+        ]
+        for row in rows:
+            self.assertEqual(shopcart_item_encoder.encode(row), self._marshalled(row))
+        self.assertEqual(shopcart_item_encoder.encode_list(rows),
+                         json.dumps([marshal(dict(zip(shopcart_item_encoder.names, row)),
+                                             shopcart_item_model) for row in rows]))
+        self.assertEqual(shopcart_item_encoder.encode_list([]), "[]")
+
+    def test_unsupported_fields(self):
+        """ Refuse the fields that can not be encoded from a row """
+        for field in (fields.Nested(shopcart_item_model), fields.DateTime(dt_format="rfc822"),
+                      fields.String(attribute="title"), fields.Integer(default=1)):
+            model = Model("Unsupported", {"field": field})
+            self.assertRaises(TypeError, RowEncoder, model)
+
+
+class TestRowResponses(DatabaseTestCase):
+    """ Test Cases for the item lists served from plain rows """
+
+    flask_app = app
+
+    def setUp(self):
+        super().setUp()
+        self.app = app.test_client()
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        self.shopcart_id = shopcart.id
+        for sku, name, price in ((5000, "soap", 2.23), (6000, "café", 0.1 + 0.2),
+                                 (7000, "iron", 20.0)):
+            ShopcartItem(sid=shopcart.id, sku=sku, name=name, price=price, amount=3).create()
+        db.session.remove()
+
+    def _assert_same_response(self, url):
+        """ Asserts a GET returns the same response with and without marshalling """
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        with patch("service.routes.encodes_like", return_value=False):
+            marshalled = self.app.get(url)
+        self.assertEqual(resp.data, marshalled.data)
+        self.assertEqual(resp.headers, marshalled.headers)
+        return resp
+
+    def test_list_shopcart_items(self):
+        """ Serve the items of a shopcart from plain rows """
+        resp = self._assert_same_response("/api/shopcarts/{}/items".format(self.shopcart_id))
+        self.assertEqual([item["sku"] for item in resp.get_json()], [5000, 6000, 7000])
+        self.assertIn("ETag", resp.headers)
+
+    def test_query_shopcart_items(self):
+        """ Serve the item queries and their pages from plain rows """
+        resp = self._assert_same_response("/api/shopcarts/items?sort=-price")
+        self.assertEqual([item["name"] for item in resp.get_json()],
+                         ["iron", "soap", "café"])
+        resp = self._assert_same_response("/api/shopcarts/items?limit=2")
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn("Link", resp.headers)
+        self._assert_same_response("/api/shopcarts/items?sku=1")
+
+    def test_stream_shopcart_items(self):
+        """ Stream plain rows as the marshalled items """
+        resp = self.app.get("/api/shopcarts/items?stream=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        items = [item.serialize() for item in ShopcartItem.all()]
+        self.assertEqual(resp.get_data(as_text=True),
+                         "".join(json.dumps(marshal(item, shopcart_item_model)) + "\n"
+                                 for item in items))
+
+    def test_debug_marshals(self):
+        """ Fall back to marshalling when the JSON is indented """
+        app.debug = True
+        try:
+            resp = self.app.get("/api/shopcarts/{}/items".format(self.shopcart_id))
+        finally:
+            app.debug = False
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn(b'\n    {\n        "id": ', resp.data)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the gunicorn configuration
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import runpy
+import unittest
+from unittest.mock import patch, Mock
+from service import create_app
+from service.models import db
+
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py")
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestGunicornConf(unittest.TestCase):
+    """ Test Cases for gunicorn.conf.py """
+
+    def _load(self, **env):
+        """ Loads the configuration with only the given gunicorn variables set """
+        names = ("WEB_CONCURRENCY", "GUNICORN_THREADS", "GUNICORN_WORKER_CLASS",
+                 "GUNICORN_MAX_WORKERS", "GUNICORN_PRELOAD", "GUNICORN_MAX_REQUESTS",
+                 "WEB_STATEMENT_TIMEOUT_MS")
+        with patch.dict(os.environ, env):
+            for name in names:
+                if name not in env:
+                    os.environ.pop(name, None)
+            settings = runpy.run_path(CONFIG_FILE)
+            exported = (os.environ["WEB_CONCURRENCY"], os.environ["GUNICORN_THREADS"],
+                        os.environ["DB_STATEMENT_TIMEOUT_MS"])
+        return settings, exported
+
+    @patch("os.sched_getaffinity", return_value={0, 1})
+    def test_defaults(self, _):
+        """ Derive the workers from the CPUs """
+        settings, exported = self._load(GUNICORN_MAX_WORKERS="8")
+        self.assertEqual(settings["workers"], 5)
+        self.assertEqual(settings["worker_class"], "gthread")
+        self.assertEqual(settings["threads"], 4)
+        self.assertTrue(settings["preload_app"])
+        self.assertEqual(settings["max_requests"], 1000)
+        self.assertEqual(settings["max_requests_jitter"], 100)
+        self.assertEqual(exported, ("5", "4", "30000"))
+
+    @patch("os.sched_getaffinity", return_value=set(range(64)))
+    def test_workers_are_capped(self, _):
+        """ Cap the workers derived from the CPUs """
+        settings, _ = self._load()
+        self.assertEqual(settings["workers"], 4)
+        settings, _ = self._load(WEB_CONCURRENCY="12")
+        self.assertEqual(settings["workers"], 12)
+
+    def test_gevent(self):
+        """ Serve many connections per gevent worker without preloading """
+        settings, exported = self._load(WEB_CONCURRENCY="2", GUNICORN_WORKER_CLASS="gevent")
+        self.assertEqual(settings["worker_class"], "gevent")
+        self.assertFalse(settings["preload_app"])
+        self.assertEqual(exported, ("2", "100", "30000"))
+
+    def test_statement_timeout(self):
+        """ Export the statement timeout of the web workers """
+        _, exported = self._load(DB_STATEMENT_TIMEOUT_MS="0", WEB_STATEMENT_TIMEOUT_MS="5000")
+        self.assertEqual(exported[2], "5000")
+
+    def test_pre_fork_closes_connections(self):
+        """ Close the connections of the master before forking a worker """
+        settings, _ = self._load()
+        app = create_app()
+        server = Mock()
+        server.app.wsgi.return_value = app
+        with patch.object(db.get_engine(app), "dispose") as dispose:
+            server.cfg.preload_app = False
+            settings["pre_fork"](server, None)
+            dispose.assert_not_called()
+            server.cfg.preload_app = True
+            settings["pre_fork"](server, None)
+        dispose.assert_called_once_with()
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the idempotency keys
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from unittest.mock import patch, Mock
+from flask import Flask
+from flask_api import status  # HTTP Status Codes
+from database_test_case import DatabaseTestCase
+from service.models import Shopcart, ShopcartItem, db
+from service.cache import LRUCache, NullCache
+from service.idempotency import (DatabaseBackend, IdempotencyKey, IdempotencyStore,
+                                 idempotency_store, request_fingerprint)
+from service.orders import order_client
+from service import create_app
+
+app = create_app()
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestIdempotencyStore(unittest.TestCase):
+    """ Test Cases for the store of the idempotency keys """
+
+    def test_reserve(self):
+        """ Take a key once until it is released """
+        store = IdempotencyStore(LRUCache())
+        self.assertIsNone(store.reserve("key-1", "a"))
+        self.assertEqual(store.reserve("key-1", "b"), {"fingerprint": "a", "status": None})
+        self.assertIsNone(store.reserve("key-2", "a"))
+        store.release("key-1")
+        self.assertIsNone(store.reserve("key-1", "b"))
+
+    def test_turned_off(self):
+        """ Store nothing with the null backend """
+        store = IdempotencyStore()
+        self.assertIsInstance(store.backend, NullCache)
+        self.assertIsNone(store.reserve("key-1", "a"))
+        self.assertIsNone(store.reserve("key-1", "a"))
+
+    def test_init_app(self):
+        """ Set up the backend from the app configuration """
+        flask_app = Flask(__name__)
+        store = IdempotencyStore()
+        store.init_app(flask_app)
+        self.assertIsInstance(store.backend, DatabaseBackend)
+        flask_app.config.update(IDEMPOTENCY_BACKEND="memory", IDEMPOTENCY_SIZE=5, IDEMPOTENCY_TTL=2)
+        store.init_app(flask_app)
+        self.assertIsInstance(store.backend, LRUCache)
+        self.assertEqual(store.backend.max_size, 5)
+        flask_app.config["WEB_CONCURRENCY"] = 2
+        self.assertRaises(ValueError, store.init_app, flask_app)
+        flask_app.config["IDEMPOTENCY_BACKEND"] = "none"
+        store.init_app(flask_app)
+        self.assertIsInstance(store.backend, NullCache)
+
+
+class TestIdempotencyKeys(DatabaseTestCase):
+    """ Test Cases for the requests with an idempotency key """
+
+    flask_app = app
+
+    def setUp(self):
+        super().setUp()
+        self.app = app.test_client()
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        self.shopcart_id = shopcart.id
+        db.session.remove()
+
+    def _add_item(self, key, amount=3):
+        """ Posts an item to the shopcart with an idempotency key """
+        return self.app.post("/api/shopcarts/{}/items".format(self.shopcart_id),
+                             json={"sku": 5000, "name": "soap", "price": 2.23, "amount": amount},
+                             headers={"Idempotency-Key": key})
+
+    def test_replay_response(self):
+        """ Answer the retries of a request with its response, without running it again """
+        resp = self._add_item("key-1")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", resp.headers)
+
+        retry = self._add_item("key-1")
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.headers["Location"], resp.headers["Location"])
+        self.assertEqual(retry.get_json(), resp.get_json())
+        self.assertEqual(ShopcartItem.find_by_shopcartid(self.shopcart_id)[0].amount, 3)
+        self.assertEqual(IdempotencyKey.find("key-1")["status"], status.HTTP_201_CREATED)
+
+        # another key is another request, and so is no key at all
+        self._add_item("key-2")
+        self._add_item(None)
+        self.assertEqual(ShopcartItem.find_by_shopcartid(self.shopcart_id)[0].amount, 9)
+
+    def test_place_order_once(self):
+        """ Post an order to the Order Service once however often it is retried """
+        self._add_item(None)
+        url = "/api/shopcarts/{}/place-order".format(self.shopcart_id)
+        with patch.object(order_client.session, "post") as post:
+            post.return_value = Mock(status_code=201, text="")
+            for _ in range(3):
+                resp = self.app.put(url, headers={"Idempotency-Key": "order-1"})
+                self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(post.call_count, 1)
+
+    def test_failure_not_stored(self):
+        """ Run the retries of a request that failed again """
+        self._add_item(None)
+        url = "/api/shopcarts/{}/place-order".format(self.shopcart_id)
+        with patch.object(order_client.session, "post") as post:
+            post.return_value = Mock(status_code=503, text="")
+            resp = self.app.put(url, headers={"Idempotency-Key": "order-1"})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            # the key was rolled back with the request
+            self.assertIsNone(IdempotencyKey.find("order-1"))
+            post.return_value = Mock(status_code=201, text="")
+            resp = self.app.put(url, headers={"Idempotency-Key": "order-1"})
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(post.call_count, 2)
+        self.assertIsNone(Shopcart.find(self.shopcart_id))
+
+    def test_key_of_another_request(self):
+        """ Refuse a key that was sent with another request """
+        self._add_item("key-1")
+        resp = self._add_item("key-1", amount=4)
+        self.assertEqual(resp.status_code, 422)
+        resp = self.app.post("/api/shopcarts", json={"user_id": 202},
+                             headers={"Idempotency-Key": "key-1"})
+        self.assertEqual(resp.status_code, 422)
+        self.assertEqual(ShopcartItem.find_by_shopcartid(self.shopcart_id)[0].amount, 3)
+
+    def test_commit_failed(self):
+        """ Forget the key and the response of a request whose commit failed """
+        with patch.object(db.session, "commit", side_effect=RuntimeError("connection lost")):
+            # the testing app raises the error instead of answering 500
+            self.assertRaises(RuntimeError, self._add_item, "key-1")
+        self.assertIsNone(IdempotencyKey.find("key-1"))
+        self.assertEqual(ShopcartItem.find_by_shopcartid(self.shopcart_id), [])
+
+        resp = self._add_item("key-1")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", resp.headers)
+
+    def test_request_in_flight(self):
+        """ Refuse a retry that comes while the request is still running """
+        url = "/api/shopcarts/{}/items".format(self.shopcart_id)
+        with app.test_request_context(url, method="POST", json={"sku": 5000}):
+            idempotency_store.reserve("key-1", request_fingerprint())
+        db.session.commit()
+
+        resp = self.app.post(url, json={"sku": 5000}, headers={"Idempotency-Key": "key-1"})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(ShopcartItem.find_by_shopcartid(self.shopcart_id), [])
+
+    def test_bad_key(self):
+        """ Refuse a key that is empty or too long """
+        for key in ("", "k" * 256):
+            resp = self._add_item(key)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(ShopcartItem.find_by_shopcartid(self.shopcart_id), [])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
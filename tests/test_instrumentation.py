@@ -0,0 +1,106 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the per-request timings
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import re
+import unittest
+from unittest.mock import patch, Mock
+from flask_api import status  # HTTP Status Codes
+from database_test_case import DatabaseTestCase
+from service.models import Shopcart, ShopcartItem, db
+from service.cache import shopcart_cache
+from service.orders import order_client
+from service import create_app
+
+app = create_app()
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestInstrumentation(DatabaseTestCase):
+    """ Test Cases for the per-request timings """
+
+    flask_app = app
+
+    def setUp(self):
+        super().setUp()
+        shopcart_cache.clear()
+        app.config["INSTRUMENTATION"] = True
+        app.config["QUERY_BUDGET"] = 10
+        self.app = app.test_client()
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        self.shopcart_id = shopcart.id
+        ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3).create()
+        db.session.remove()
+
+    def tearDown(self):
+        app.config["INSTRUMENTATION"] = False
+        super().tearDown()
+
+    def _metrics(self, resp):
+        """ Returns the durations of the Server-Timing header by name """
+        metrics = {}
+        for metric in resp.headers["Server-Timing"].split(", "):
+            name, duration = re.match(r"(\w+);dur=([\d.]+)", metric).groups()
+            metrics[name] = float(duration)
+        return metrics
+
+    def test_server_timing(self):
+        """ Send the timings of a request in the Server-Timing header """
+        resp = self.app.get("/api/shopcarts/{}".format(self.shopcart_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertRegex(resp.headers["Server-Timing"], r'^db;dur=[\d.]+;desc="3 queries", ')
+        metrics = self._metrics(resp)
+        self.assertEqual(sorted(metrics), ["db", "serialize", "total"])
+        self.assertLessEqual(metrics["db"] + metrics["serialize"], metrics["total"])
+
+        # the shopcart is served from the cache now, without a query
+        resp = self.app.get("/api/shopcarts/{}".format(self.shopcart_id))
+        self.assertIn('desc="0 queries"', resp.headers["Server-Timing"])
+
+    def test_order_timing(self):
+        """ Time the calls to the Order Service """
+        with patch.object(order_client.session, "post") as post:
+            post.return_value = Mock(status_code=201, text="")
+            resp = self.app.put("/api/shopcarts/{}/place-order".format(self.shopcart_id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertIn("order", self._metrics(resp))
+
+    def test_query_budget(self):
+        """ Warn about the requests that run too many queries """
+        with self.assertLogs("service.instrumentation", "WARNING") as logs:
+            app.config["QUERY_BUDGET"] = 1
+            self.app.get("/api/shopcarts/{}".format(self.shopcart_id))
+        self.assertIn("over the budget of 1", logs.output[0])
+        self.assertIn("shopcarts.shopcart_resource", logs.output[0])
+
+    def test_turned_off(self):
+        """ Record nothing unless the instrumentation is turned on """
+        app.config["INSTRUMENTATION"] = False
+        resp = self.app.get("/api/shopcarts/{}/items".format(self.shopcart_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Server-Timing", resp.headers)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
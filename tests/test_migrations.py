@@ -0,0 +1,160 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the online schema migrations
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+from database_test_case import DatabaseTestCase
+from service.models import Shopcart, ShopcartItem, db
+from service import create_app, migrations, commands
+
+app = create_app()
+
+# The tables as they were created before the indexes were declared
+LEGACY_SCHEMA = [
+    "CREATE TABLE shopcart (id INTEGER PRIMARY KEY, user_id INTEGER, "
+    "create_time TIMESTAMP NOT NULL, update_time TIMESTAMP NOT NULL)",
+    "CREATE TABLE shopcart_item (id INTEGER PRIMARY KEY, sid INTEGER, sku INTEGER, "
+    "name VARCHAR, price FLOAT, amount INTEGER, "
+    "create_time TIMESTAMP NOT NULL, update_time TIMESTAMP NOT NULL)",
+]
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMigrations(DatabaseTestCase):
+    """ Test Cases for the schema migrations """
+
+    flask_app = app
+    testing = False
+
+    def setUp(self):
+        db.drop_all()  # clean up the last tests
+        for statement in LEGACY_SCHEMA:
+            db.session.execute(text(statement))
+        db.session.commit()
+
+    def _insert_item(self, item_id, sid, sku, amount):
+        """ Inserts a shopcart item row directly """
+        db.session.execute(
+            text("INSERT INTO shopcart_item "
+                 "(id, sid, sku, name, price, amount, create_time, update_time) VALUES "
+                 "(:id, :sid, :sku, 'soap', 2.23, :amount, :now, :now)"),
+            {"id": item_id, "sid": sid, "sku": sku, "amount": amount, "now": "2020-11-01 00:00:00"}
+        )
+
+    def _index_names(self, table):
+        """ Returns the names of the indexes and unique constraints of a table """
+        inspector = inspect(db.engine)
+        names = {index["name"] for index in inspector.get_indexes(table)}
+        names.update(constraint["name"] for constraint
+                     in inspector.get_unique_constraints(table))
+        return names
+
+    def test_upgrade_adds_indexes(self):
+        """ Upgrade a legacy database with the missing indexes """
+        migrations.upgrade(db.engine)
+        self.assertTrue({"ix_shopcart_user_id",
+                         "ix_shopcart_update_time"} <= self._index_names("shopcart"))
+        self.assertTrue({"ix_shopcart_item_sku", "ix_shopcart_item_name",
+                         "uq_shopcart_item_sid_sku"} <= self._index_names("shopcart_item"))
+
+    def test_upgrade_merges_duplicate_items(self):
+        """ Upgrade a legacy database that has duplicate items in a shopcart """
+        db.session.execute(text("INSERT INTO shopcart VALUES (1, 101, :now, :now)"),
+                           {"now": "2020-11-01 00:00:00"})
+        self._insert_item(1, 1, 5000, 3)
+        self._insert_item(2, 1, 5000, 2)
+        self._insert_item(3, 1, 6000, 1)
+        db.session.commit()
+
+        migrations.upgrade(db.engine)
+        db.session.remove()
+
+        shopcart_items = ShopcartItem.find_by_shopcartid(1)
+        self.assertEqual([(item.id, item.amount) for item in shopcart_items], [(1, 5), (3, 1)])
+        self.assertRaises(IntegrityError, self._insert_item, 4, 1, 5000, 1)
+        db.session.rollback()
+
+    def test_upgrade_adds_version_columns(self):
+        """ Upgrade a legacy database with the version columns, every row at version 1 """
+        db.session.execute(text("INSERT INTO shopcart VALUES (1, 101, :now, :now)"),
+                           {"now": "2020-11-01 00:00:00"})
+        self._insert_item(1, 1, 5000, 3)
+        db.session.commit()
+
+        migrations.upgrade(db.engine)
+        db.session.remove()
+
+        shopcart_item = ShopcartItem.find(1)
+        self.assertEqual(shopcart_item.version, 1)
+        shopcart_item.amount = 4
+        shopcart_item.update(1)
+        self.assertEqual(ShopcartItem.find(1).version, 2)
+        self.assertEqual(Shopcart.find(1).version, 1)
+
+    def test_upgrade_adds_failed_time_column(self):
+        """ Upgrade an order outbox created before orders could be marked failed """
+        db.session.execute(text(
+            "CREATE TABLE order_outbox (id INTEGER PRIMARY KEY, shopcart_id INTEGER NOT NULL, "
+            "payload TEXT NOT NULL, attempts INTEGER NOT NULL, "
+            "next_attempt_time TIMESTAMP NOT NULL, last_error VARCHAR, "
+            "create_time TIMESTAMP NOT NULL)"
+        ))
+        db.session.commit()
+
+        migrations.upgrade(db.engine)
+        db.session.remove()
+
+        columns = [info["name"] for info in inspect(db.engine).get_columns("order_outbox")]
+        self.assertIn("failed_time", columns)
+        migrations.upgrade(db.engine)
+
+    def test_upgrade_timestamp_defaults(self):
+        """ Let the database fill in the timestamps of a legacy database """
+        if db.engine.dialect.name != "postgresql":
+            with self.assertLogs("service.migrations", "WARNING") as logs:
+                migrations.upgrade(db.engine)
+            self.assertIn("shopcart.create_time has no default", logs.output[0])
+            return
+        migrations.upgrade(db.engine)
+        Shopcart(user_id=101).create()
+        self.assertIsNotNone(Shopcart.all()[0].create_time)
+
+    def test_upgrade_is_idempotent(self):
+        """ Upgrade a database that is already up to date """
+        migrations.upgrade(db.engine)
+        migrations.upgrade(db.engine)
+        self.assertIn("uq_shopcart_item_sid_sku", self._index_names("shopcart_item"))
+
+    def test_db_upgrade_command(self):
+        """ Upgrade the database from the command line """
+        runner = app.test_cli_runner()
+        result = runner.invoke(commands.db_upgrade_command)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("up to date", result.output)
+        self.assertIn("ix_shopcart_user_id", self._index_names("shopcart"))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
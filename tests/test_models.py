@@ -18,10 +18,17 @@ Test cases can be run with:
 """
 
 import unittest
-from service.models import Shopcart, ShopcartItem, DataValidationError, db
-from service import app
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from sqlalchemy import event
+from service.models import Shopcart, ShopcartItem, DataValidationError, ConflictError, db
+from service.models import check_pool_capacity
+from service.cache import shopcart_cache
+from service import create_app
 from config import DATABASE_URI
 
+app = create_app()
+
 
 ######################################################################
 #  T E S T   C A S E S
@@ -35,7 +42,13 @@ class TestShopcarts(unittest.TestCase):
         app.debug = False
         # Set up the test database
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
-        Shopcart.init_db(app)
+        cls.context = app.app_context()
+        cls.context.push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """ These run once after Test suite """
+        cls.context.pop()
 
     def setUp(self):
         db.drop_all()  # clean up the last tests
@@ -69,6 +82,24 @@ class TestShopcarts(unittest.TestCase):
         shopcarts = Shopcart.all()
         self.assertEqual(len(shopcarts), 1)
 
+    def test_changes_wait_for_the_request(self):
+        """ Stage the changes of a request until they are committed """
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        shopcart_cache.set(shopcart.id, {"etag": "cached"}, shopcart_cache.lookup(shopcart.id)[1])
+        with app.test_request_context(method="POST"):
+            ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3).add()
+            self.assertIsNotNone(shopcart_cache.get(shopcart.id))
+            db.session.rollback()
+        self.assertEqual(ShopcartItem.all(), [])
+        self.assertIsNotNone(shopcart_cache.get(shopcart.id))
+
+        with app.test_request_context(method="POST"):
+            ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3).add()
+            db.session.commit()
+        self.assertIsNone(shopcart_cache.get(shopcart.id))
+        self.assertEqual(len(ShopcartItem.all()), 1)
+
     def test_delete_a_shopcart(self):
         """Delete a shopcart and everything in it"""
         self.assertEqual(len(Shopcart.all()), 0)
@@ -95,6 +126,54 @@ class TestShopcarts(unittest.TestCase):
         self.assertEqual(len(ShopcartItem.all()), 0)
         self.assertEqual(len(Shopcart.all()), 0)
 
+    def test_delete_a_shopcart_in_one_transaction(self):
+        """Delete a shopcart with many items with a single commit"""
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        other = Shopcart(user_id=54321)
+        other.create()
+        for sku in range(1, 21):
+            ShopcartItem(sid=shopcart.id, sku=sku, name="obj", price=1, amount=1).create()
+        ShopcartItem(sid=other.id, sku=1, name="obj", price=1, amount=1).create()
+        self.assertEqual(len(shopcart.items), 20)
+
+        with patch.object(db.session, "commit", wraps=db.session.commit) as commit:
+            shopcart.delete()
+        self.assertEqual(commit.call_count, 1)
+
+        self.assertIsNone(Shopcart.find(shopcart.id))
+        self.assertEqual(ShopcartItem.find_by_shopcartid(shopcart.id), [])
+        self.assertEqual(len(ShopcartItem.find_by_shopcartid(other.id)), 1)
+
+    def test_purge_expired_shopcarts(self):
+        """ Purge the shopcarts abandoned before a cutoff """
+        cutoff = datetime.utcnow() - timedelta(days=30)
+        long_ago = cutoff - timedelta(days=1)
+        abandoned = Shopcart(user_id=1)
+        abandoned.create()
+        recent_item = Shopcart(user_id=2)
+        recent_item.create()
+        recent = Shopcart(user_id=3)
+        recent.create()
+        abandoned_items = Shopcart(user_id=4)
+        abandoned_items.create()
+        ShopcartItem(sid=recent_item.id, sku=1, name="obj", price=1, amount=1).create()
+        for sku in range(1, 4):
+            item = ShopcartItem(sid=abandoned_items.id, sku=sku, name="obj", price=1, amount=1)
+            item.create()
+            item.update_time = long_ago
+            item.update()
+        for shopcart in (abandoned, recent_item, abandoned_items):
+            shopcart.update_time = long_ago
+        db.session.commit()
+
+        self.assertEqual(Shopcart.purge_expired(cutoff, 1), (1, 0))
+        self.assertEqual(Shopcart.purge_expired(cutoff, 10), (1, 3))
+        self.assertEqual(Shopcart.purge_expired(cutoff, 10), (0, 0))
+        self.assertEqual(sorted(shopcart.id for shopcart in Shopcart.all()),
+                         [recent_item.id, recent.id])
+        self.assertEqual(len(ShopcartItem.all()), 1)
+
     def test_serialize_a_shopcart(self):
         """ Test serialization of a Shopcart """
         shopcart = Shopcart(user_id=101)
@@ -144,6 +223,55 @@ class TestShopcarts(unittest.TestCase):
         shopcart_queried = Shopcart.find(1)
         self.assertIsNone(shopcart_queried)
 
+    def test_find_etag(self):
+        """ Find the entity tag of a Shopcart and its items """
+        self.assertIsNone(Shopcart.find_etag(1))
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        tags = [Shopcart.find_etag(shopcart.id)]
+        item = ShopcartItem(sid=shopcart.id, sku=101, name="printer", price=101.29, amount=1)
+        item.create()
+        tags.append(Shopcart.find_etag(shopcart.id))
+        item.amount = 2
+        item.update()
+        tags.append(Shopcart.find_etag(shopcart.id))
+        self.assertEqual(Shopcart.find_etag(shopcart.id), tags[-1])
+        self.assertEqual(len(set(tags)), 3)
+        item.delete()
+        # an empty shopcart is represented the same way it was before the item was added
+        self.assertEqual(Shopcart.find_etag(shopcart.id), tags[0])
+
+    def test_find_etag_with_older_update_time(self):
+        """ Change the entity tag of a Shopcart written by a transaction that started earlier """
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        item = ShopcartItem(sid=shopcart.id, sku=101, name="printer", price=101.29, amount=1)
+        item.create()
+        update_time = item.update_time
+        tag = Shopcart.find_etag(shopcart.id)
+        # a slow request stores the time its transaction started, no later than the last write
+        ShopcartItem.query.filter_by(id=item.id).update(
+            {"amount": 2, "version": ShopcartItem.version + 1, "update_time": update_time},
+            synchronize_session=False
+        )
+        db.session.commit()
+        self.assertNotEqual(Shopcart.find_etag(shopcart.id), tag)
+
+    def test_summarize_shopcart(self):
+        """ Summarize the items in a Shopcart """
+        self.assertIsNone(Shopcart.summarize(1))
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        self.assertEqual(Shopcart.summarize(shopcart.id), {
+            "id": shopcart.id, "user_id": 101, "subtotal": 0, "lines": 0, "units": 0
+        })
+        ShopcartItem(sid=shopcart.id, sku=101, name="printer", price=101.29, amount=2).create()
+        ShopcartItem(sid=shopcart.id, sku=201, name="laptop", price=999.99, amount=1).create()
+        summary = Shopcart.summarize(shopcart.id)
+        self.assertEqual(summary["subtotal"], 1202.57)
+        self.assertEqual(summary["lines"], 2)
+        self.assertEqual(summary["units"], 3)
+
     def test_all_shopcarts(self):
         """ Get all Shopcarts"""
         count = 5
@@ -159,6 +287,67 @@ class TestShopcarts(unittest.TestCase):
         shopcarts = Shopcart.find_by_user(101)
         self.assertEqual(shopcarts[0].user_id, 101)
 
+    def test_all_shopcarts_with_items(self):
+        """ Get all Shopcarts with their items loaded """
+        shopcart_1 = Shopcart(user_id=101)
+        shopcart_1.create()
+        shopcart_2 = Shopcart(user_id=201)
+        shopcart_2.create()
+        ShopcartItem(sid=shopcart_1.id, sku=101, name="printer", price=101.29, amount=1).create()
+        ShopcartItem(sid=shopcart_1.id, sku=201, name="laptop", price=999.99, amount=2).create()
+        ShopcartItem(sid=shopcart_2.id, sku=101, name="printer", price=101.29, amount=3).create()
+        shopcarts = Shopcart.all_with_items()
+        self.assertEqual(len(shopcarts), 2)
+        self.assertEqual([item.sku for item in shopcarts[0].items], [101, 201])
+        self.assertEqual([item.amount for item in shopcarts[1].items], [3])
+
+    def test_find_by_user_with_items(self):
+        """ Find Shopcarts by user with their items loaded """
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        Shopcart(user_id=201).create()
+        ShopcartItem(sid=shopcart.id, sku=101, name="printer", price=101.29, amount=1).create()
+        shopcarts = Shopcart.find_by_user_with_items(101)
+        self.assertEqual(len(shopcarts), 1)
+        self.assertEqual(shopcarts[0].user_id, 101)
+        self.assertEqual(len(shopcarts[0].items), 1)
+        self.assertEqual(Shopcart.find_by_user_with_items(12345), [])
+
+    def test_find_page_of_shopcarts_with_items(self):
+        """ Find a page of Shopcarts after an id """
+        for user_id in range(1, 6):
+            Shopcart(user_id=user_id).create()
+        ShopcartItem(sid=3, sku=101, name="printer", price=101.29, amount=1).create()
+        shopcarts = Shopcart.find_page_with_items(2, 2)
+        self.assertEqual([shopcart.id for shopcart in shopcarts], [3, 4])
+        self.assertEqual(len(shopcarts[0].items), 1)
+        shopcarts = Shopcart.find_page_with_items(4, 2)
+        self.assertEqual([shopcart.id for shopcart in shopcarts], [5])
+        shopcarts = Shopcart.find_page_with_items(0, 10, user_id=4)
+        self.assertEqual([shopcart.user_id for shopcart in shopcarts], [4])
+
+    def test_stream_shopcarts_with_items(self):
+        """ Stream all of the Shopcarts in batches """
+        for user_id in range(1, 6):
+            Shopcart(user_id=user_id).create()
+        ShopcartItem(sid=5, sku=101, name="printer", price=101.29, amount=1).create()
+        shopcarts = list(Shopcart.stream_with_items(2))
+        self.assertEqual([shopcart.id for shopcart in shopcarts], [1, 2, 3, 4, 5])
+        self.assertEqual(len(shopcarts[4].items), 1)
+        self.assertEqual(list(Shopcart.stream_with_items(5, user_id=12345)), [])
+
+    def test_serialize_a_shopcart_with_items(self):
+        """ Test serialization of a Shopcart with its items """
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3).create()
+        data = Shopcart.find(shopcart.id).serialize_with_items()
+        self.assertEqual(data["id"], shopcart.id)
+        self.assertEqual(data["user_id"], 101)
+        self.assertEqual(len(data["items"]), 1)
+        self.assertEqual(data["items"][0]["sku"], 5000)
+        self.assertEqual(data["items"][0]["sid"], shopcart.id)
+
 
 class TestShopcartItems(unittest.TestCase):
     """ Test Cases for ShopcartItems """
@@ -169,7 +358,13 @@ class TestShopcartItems(unittest.TestCase):
         app.debug = False
         # Set up the test database
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
-        ShopcartItem.init_db(app)
+        cls.context = app.app_context()
+        cls.context.push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """ These run once after Test suite """
+        cls.context.pop()
 
     def setUp(self):
         db.drop_all()  # clean up the last tests
@@ -255,6 +450,78 @@ class TestShopcartItems(unittest.TestCase):
         self.assertEqual(shopcart_item.price, 2.23)
         self.assertEqual(shopcart_item.amount, 6)
 
+    def test_add_existing_shopcart_item_returns_stored_row(self):
+        """ Add a sku that is already in the shopcart and get the stored row back """
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        first = ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3)
+        first.add()
+        second = ShopcartItem(sid=shopcart.id, sku=5000, name="soap bar", price=3.00, amount=2)
+        second.add()
+        self.assertEqual(second.id, first.id)
+        self.assertEqual(second.amount, 5)
+        self.assertEqual(second.name, "soap")
+        self.assertEqual(second.price, 2.23)
+        self.assertEqual(second.create_time, first.create_time)
+        self.assertGreaterEqual(second.update_time, first.update_time)
+        shopcart_items = ShopcartItem.all()
+        self.assertEqual(len(shopcart_items), 1)
+        self.assertEqual(shopcart_items[0].amount, 5)
+
+    def test_add_all_shopcart_items(self):
+        """ Add a batch of shopcart items with repeated skus """
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        ShopcartItem(sid=shopcart.id, sku=6000, name="iron", price=20.99, amount=1).add()
+        shopcart_items = ShopcartItem.add_all(shopcart.id, [
+            ShopcartItem(sku=5000, name="soap", price=2.23, amount=3),
+            ShopcartItem(sku=6000, name="iron", price=20.99, amount=2),
+            ShopcartItem(sku=5000, name="soap", price=2.23, amount=4),
+        ])
+        self.assertEqual([(item.sku, item.amount) for item in shopcart_items],
+                         [(5000, 7), (6000, 3), (5000, 7)])
+        self.assertIs(shopcart_items[2], shopcart_items[0])
+        for shopcart_item in shopcart_items:
+            self.assertIsNotNone(shopcart_item.id)
+            self.assertEqual(shopcart_item.sid, shopcart.id)
+        stored = ShopcartItem.find_by_shopcartid(shopcart.id)
+        self.assertEqual(sorted((item.sku, item.amount) for item in stored),
+                         [(5000, 7), (6000, 3)])
+
+    def test_add_all_writes_in_sku_order(self):
+        """ Write the rows of a batch in the order of their skus """
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        shopcart_items = ShopcartItem.add_all(shopcart.id, [
+            ShopcartItem(sku=sku, name="obj", price=1, amount=1) for sku in (7000, 5000, 6000)
+        ])
+        self.assertEqual([item.sku for item in shopcart_items], [7000, 5000, 6000])
+        stored = sorted(ShopcartItem.find_by_shopcartid(shopcart.id), key=lambda item: item.id)
+        self.assertEqual([item.sku for item in stored], [5000, 6000, 7000])
+
+    def test_add_all_shopcart_items_with_not_existing_cart(self):
+        """ Add a batch of shopcart items to a shopcart that doesn't exist """
+        shopcart_items = [ShopcartItem(sku=5000, name="soap", price=2.23, amount=3)]
+        self.assertRaises(DataValidationError, ShopcartItem.add_all, 1000, shopcart_items)
+        self.assertEqual(len(ShopcartItem.all()), 0)
+
+    def test_add_sums_into_the_stored_row(self):
+        """ Add a sku that is already in the shopcart, alone and in a batch """
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        first = ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3)
+        first.add()
+        ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=2).add()
+        ShopcartItem.add_all(shopcart.id, [
+            ShopcartItem(sku=5000, name="soap", price=2.23, amount=1),
+            ShopcartItem(sku=6000, name="iron", price=20.99, amount=1),
+        ])
+        stored = sorted(ShopcartItem.find_by_shopcartid(shopcart.id), key=lambda item: item.sku)
+        self.assertEqual([(item.sku, item.amount, item.version) for item in stored],
+                         [(5000, 6, 3), (6000, 1, 1)])
+        self.assertEqual(stored[0].id, first.id)
+        self.assertEqual(stored[0].create_time, first.create_time)
+
     def test_add_shopcart_item_with_not_existing_cart(self):
         """ Test using add shopcart_item method when shopcart doesnt exists"""
         shopcarts = Shopcart.all()
@@ -288,6 +555,67 @@ class TestShopcartItems(unittest.TestCase):
         self.assertEqual(len(shopcart_item), 1)
         self.assertEqual(shopcart_item[0].name, "soap")
 
+    def test_writes_read_back_without_refresh(self):
+        """ Read the ids and timestamps back in the write statement itself """
+        statements = []
+
+        def record(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement.split()[0])
+
+        # without RETURNING, SQLite reads the timestamps with a SELECT
+        expected = ["INSERT"] if db.engine.dialect.name == "postgresql" else ["INSERT", "SELECT"]
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            shopcart = Shopcart(user_id=12345)
+            shopcart.create()
+            self.assertEqual(statements, expected)
+            self.assertIsNotNone(shopcart.create_time)
+            self.assertEqual(shopcart.create_time, shopcart.update_time)
+
+            del statements[:]
+            shopcart_item = ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23,
+                                         amount=3)
+            shopcart_item.create()
+            self.assertEqual(statements, expected)
+            self.assertEqual(shopcart_item.id, 1)
+
+            del statements[:]
+            create_time, update_time = shopcart_item.create_time, shopcart_item.update_time
+            shopcart_item.amount = 5
+            shopcart_item.update()
+            self.assertEqual(statements, ["UPDATE"] + expected[1:])
+            self.assertEqual(shopcart_item.create_time, create_time)
+            self.assertGreaterEqual(shopcart_item.update_time, update_time)
+
+            # the values are still there after the commit
+            del statements[:]
+            self.assertEqual(shopcart_item.serialize()["amount"], 5)
+            self.assertEqual(statements, [])
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+    def test_create_a_duplicated_shopcart_item(self):
+        """ Create a shopcart item with a sku that is already in the shopcart """
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3).create()
+        shopcart_item = ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23,
+                                     amount=1)
+        self.assertRaises(DataValidationError, shopcart_item.create)
+        self.assertEqual(len(ShopcartItem.all()), 1)
+
+    def test_update_a_shopcart_item_to_a_duplicated_sku(self):
+        """ Update a shopcart item to a sku that is already in the shopcart """
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3).create()
+        shopcart_item = ShopcartItem(sid=shopcart.id, sku=6000, name="iron", price=20.99,
+                                     amount=1)
+        shopcart_item.create()
+        shopcart_item.sku = 5000
+        self.assertRaises(DataValidationError, shopcart_item.update)
+        self.assertEqual(ShopcartItem.find_by_filters(sku=6000).one().amount, 1)
+
     def test_update_a_shopcart_item_without_id(self):
         """ Update a shopcart item """
         shopcart = Shopcart(user_id=12345)
@@ -300,6 +628,50 @@ class TestShopcartItems(unittest.TestCase):
         shopcart_item.id = None
         self.assertRaises(DataValidationError, shopcart_item.update)
 
+    def test_change_shopcart_item_amount(self):
+        """ Change the amount of a shopcart item and delete it at zero """
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        shopcart_item = ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3)
+        shopcart_item.create()
+
+        changed = ShopcartItem.change_amount(shopcart.id, shopcart_item.id, 4)
+        self.assertEqual(changed.amount, 7)
+        self.assertEqual(changed.name, "soap")
+        self.assertIsNotNone(changed.update_time)
+        self.assertIsNone(ShopcartItem.change_amount(shopcart.id + 1, shopcart_item.id, 1))
+
+        changed = ShopcartItem.change_amount(shopcart.id, shopcart_item.id, -7)
+        self.assertEqual(changed.amount, 0)
+        self.assertEqual(ShopcartItem.find_by_shopcartid(shopcart.id), [])
+        self.assertIsNone(ShopcartItem.change_amount(shopcart.id, shopcart_item.id, 1))
+
+    def test_update_a_stale_shopcart_item(self):
+        """ Refuse to update a shopcart item that was written since it was read """
+        shopcart = Shopcart(user_id=12345)
+        shopcart.create()
+        self.assertEqual(shopcart.version, 1)
+        shopcart_item = ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3)
+        shopcart_item.create()
+        self.assertEqual(shopcart_item.version, 1)
+
+        shopcart_item.amount = 4
+        self.assertRaises(ConflictError, shopcart_item.update, 2)
+        shopcart_item.amount = 4
+        shopcart_item.update(1)
+        self.assertEqual(shopcart_item.version, 2)
+
+        # the statements written without the ORM bump the version too
+        added = ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=1)
+        added.add()
+        self.assertEqual(added.version, 3)
+        self.assertEqual(ShopcartItem.change_amount(shopcart.id, added.id, 1).version, 4)
+
+        # the copy read before those writes is stale
+        shopcart_item.amount = 10
+        self.assertRaises(ConflictError, shopcart_item.update)
+        self.assertEqual(ShopcartItem.find(added.id).amount, 6)
+
     def test_delete_a_shopcart_item(self):
         """Delete a shopcart item"""
         shopcart = Shopcart(user_id=12345)
@@ -366,8 +738,39 @@ class TestShopcartItems(unittest.TestCase):
         shopcart_item = ShopcartItem()
         self.assertRaises(DataValidationError, shopcart_item.deserialize, data)
 
-    def test_find_by_sku(self):
-        """ Find Shopcart Items by sku """
+    def test_find_by_filters(self):
+        """ Find Shopcart Items matching several filters """
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        for sku, price, amount in ((101, 2.39, 1), (201, 20.99, 3), (301, 45.99, 2)):
+            ShopcartItem(sid=shopcart.id, sku=sku, name="soap", price=price,
+                         amount=amount).create()
+        self.assertEqual(len(ShopcartItem.find_by_filters().all()), 3)
+        shopcart_items = ShopcartItem.find_by_filters(sort="-amount", name="soap",
+                                                      min_price=10.0, max_price=None)
+        self.assertEqual([item.sku for item in shopcart_items], [201, 301])
+        shopcart_items = ShopcartItem.find_by_filters(price=20.99 + 1e-9, min_amount=3)
+        self.assertEqual([item.sku for item in shopcart_items], [201])
+        self.assertEqual(ShopcartItem.find_by_filters(sid=shopcart.id + 1).all(), [])
+
+    def test_sku_stats(self):
+        """ Rank the skus in all of the Shopcarts """
+        self.assertEqual(ShopcartItem.sku_stats(5), [])
+        for user_id in (1, 2):
+            shopcart = Shopcart(user_id=user_id)
+            shopcart.create()
+            ShopcartItem(sid=shopcart.id, sku=101, name="soap", price=2.0, amount=4).create()
+            ShopcartItem(sid=shopcart.id, sku=201, name="laptop", price=900.0,
+                         amount=user_id).create()
+        stats = ShopcartItem.sku_stats(5)
+        self.assertEqual([row["sku"] for row in stats], [101, 201])
+        self.assertEqual(stats[0], {"sku": 101, "name": "soap", "units": 8, "revenue": 16.0,
+                                    "shopcarts": 2})
+        stats = ShopcartItem.sku_stats(1, sort="revenue")
+        self.assertEqual([(row["sku"], row["revenue"]) for row in stats], [(201, 2700.0)])
+
+    def test_filter_by_sku(self):
+        """ Filter Shopcart Items by sku """
         shopcart_1 = Shopcart().deserialize({"user_id": 12345})
         shopcart_1.create()
         shopcart_2 = Shopcart().deserialize({"user_id": 12345})
@@ -375,37 +778,37 @@ class TestShopcartItems(unittest.TestCase):
         ShopcartItem(sid=shopcart_1.id, sku=101, name="printer", price=101.29, amount=1).create()
         ShopcartItem(sid=shopcart_2.id, sku=101, name="printer", price=101.29, amount=10).create()
         ShopcartItem(sid=shopcart_1.id, sku=201, name="printer", price=101.29, amount=1).create()
-        shopcart_items = ShopcartItem.find_by_sku(101)
+        shopcart_items = ShopcartItem.find_by_filters(sku=101).all()
         self.assertEqual(len(shopcart_items), 2)
         self.assertEqual(shopcart_items[0].sku, 101)
 
-    def test_find_by_name(self):
-        """ Find Shopcart Items by name """
+    def test_filter_by_name(self):
+        """ Filter Shopcart Items by name """
         shopcart = Shopcart().deserialize({"user_id": 12345})
         shopcart.create()
         ShopcartItem(sid=shopcart.id, sku=101, name="printer", price=101.29, amount=1).create()
         ShopcartItem(sid=shopcart.id, sku=201, name="laptop", price=101.29, amount=1).create()
-        shopcart_items = ShopcartItem.find_by_name("printer")
+        shopcart_items = ShopcartItem.find_by_filters(name="printer").all()
         self.assertEqual(len(shopcart_items), 1)
         self.assertEqual(shopcart_items[0].name, "printer")
 
-    def test_find_by_price(self):
-        """ Find Shopcart Items by price """
+    def test_filter_by_price(self):
+        """ Filter Shopcart Items by price """
         shopcart = Shopcart().deserialize({"user_id": 12345})
         shopcart.create()
         ShopcartItem(sid=shopcart.id, sku=101, name="printer", price=101.29, amount=1).create()
         ShopcartItem(sid=shopcart.id, sku=201, name="printer", price=99.99, amount=1).create()
-        shopcart_items = ShopcartItem.find_by_price(99.99)
+        shopcart_items = ShopcartItem.find_by_filters(price=99.99).all()
         self.assertEqual(len(shopcart_items), 1)
         self.assertEqual(shopcart_items[0].price, 99.99)
 
-    def test_find_by_amount(self):
-        """ Find Shopcart Items by amount """
+    def test_filter_by_amount(self):
+        """ Filter Shopcart Items by amount """
         shopcart = Shopcart().deserialize({"user_id": 12345})
         shopcart.create()
         ShopcartItem(sid=shopcart.id, sku=101, name="printer", price=101.29, amount=1).create()
         ShopcartItem(sid=shopcart.id, sku=201, name="printer", price=101.29, amount=10).create()
-        shopcart_items = ShopcartItem.find_by_amount(10)
+        shopcart_items = ShopcartItem.find_by_filters(amount=10).all()
         self.assertEqual(len(shopcart_items), 1)
         self.assertEqual(shopcart_items[0].amount, 10)
 
@@ -452,6 +855,51 @@ class TestShopcartItems(unittest.TestCase):
         self.assertEqual(item_queried.amount, 5)
 
 
+class TestPoolCapacity(unittest.TestCase):
+    """ Test Cases for the connection pool settings check """
+
+    def _config(self, workers, threads, pool_size, max_overflow, max_connections, **binds):
+        return {
+            "WEB_CONCURRENCY": workers,
+            "GUNICORN_THREADS": threads,
+            "DB_MAX_CONNECTIONS": max_connections,
+            "SQLALCHEMY_ENGINE_OPTIONS": {"pool_size": pool_size, "max_overflow": max_overflow,
+                                          "pool_timeout": 10},
+            "SQLALCHEMY_BINDS": binds,
+            "DATABASE_SHARD_URIS": [uri for name, uri in binds.items()
+                                    if name.startswith("shard")]
+        }
+
+    def test_pool_fits(self):
+        """ Accept pools that fit the concurrency and the database """
+        self.assertEqual(check_pool_capacity(self._config(4, 8, 5, 5, 40)), [])
+
+    def test_too_many_threads(self):
+        """ Warn when the threads of a worker outnumber its connections """
+        warnings = check_pool_capacity(self._config(1, 16, 5, 5, 100))
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("16 threads per worker need up to 16 connections but share only 10",
+                      warnings[0])
+
+    def test_too_many_connections(self):
+        """ Warn when the pools of all of the workers exceed the database limit """
+        warnings = check_pool_capacity(self._config(12, 1, 5, 5, 100))
+        self.assertEqual(warnings, ["12 workers may open 120 connections but the databases "
+                                    "allow 100"])
+
+    def test_shards_and_replica(self):
+        """ Count a pool per database, and two connections per thread with shards """
+        self.assertEqual(check_pool_capacity(self._config(4, 8, 5, 5, 40, replica="r")),
+                         ["4 workers may open 80 connections but the databases allow 40"])
+        warnings = check_pool_capacity(self._config(2, 8, 5, 5, 100, shard1="s"))
+        self.assertEqual(warnings, ["8 threads per worker need up to 16 connections but share "
+                                    "only 10, requests will wait up to 10s for one"])
+
+    def test_no_queue_pool(self):
+        """ Skip the check when the database has no connection pool """
+        self.assertEqual(check_pool_capacity({"SQLALCHEMY_ENGINE_OPTIONS": {}}), [])
+
+
 ######################################################################
 #   M A I N
 ######################################################################
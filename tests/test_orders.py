@@ -0,0 +1,65 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Order Service client
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from flask import Flask
+from service.models import Shopcart, ShopcartItem
+from service.orders import OrderClient, build_order
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestOrders(unittest.TestCase):
+    """ Test Cases for the Order Service client """
+
+    def test_build_order(self):
+        """ Build the order for a shopcart """
+        shopcart = Shopcart(id=1, user_id=42)
+        items = [ShopcartItem(id=7, sid=1, sku=101, name="printer", price=101.29, amount=2)]
+        self.assertEqual(build_order(shopcart, items), {
+            "customer_id": 42,
+            "order_items": [{"item_id": 7, "product_id": 101, "quantity": 2,
+                             "price": 101.29, "status": "PLACED"}]
+        })
+
+    def test_init_app(self):
+        """ Set up a pooled session with timeouts and retries """
+        app = Flask(__name__)
+        app.config.from_object("config")
+        app.config.update(ORDER_ENDPOINT="http://orders.local/orders", ORDER_RETRIES=2,
+                          ORDER_POOL_SIZE=4, ORDER_CONNECT_TIMEOUT=1, ORDER_READ_TIMEOUT=5)
+        client = OrderClient()
+        client.init_app(app)
+        self.assertEqual(client.endpoint, "http://orders.local/orders")
+        self.assertEqual(client.timeout, (1, 5))
+        adapter = client.session.get_adapter("http://orders.local/orders")
+        self.assertEqual(adapter._pool_maxsize, 4)  # pylint: disable=protected-access
+        retries = adapter.max_retries
+        self.assertEqual(retries.connect, 2)
+        self.assertEqual(retries.read, 0)
+        self.assertEqual(retries.status_forcelist, (503,))
+        self.assertIn("POST", retries.method_whitelist)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the read replica routing
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from sqlalchemy import event
+from flask_api import status  # HTTP Status Codes
+from database_test_case import DatabaseTestCase
+from service.models import Shopcart, ShopcartItem, db
+from service.cache import shopcart_cache
+from service import create_app
+from config import DATABASE_URI
+
+# The replica is the test database itself, seen through a second engine
+app = create_app()
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestReplicaRouting(DatabaseTestCase):
+    """ Test Cases for the read replica routing """
+
+    flask_app = app
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once before Test suite """
+        app.config["SQLALCHEMY_BINDS"] = {"replica": DATABASE_URI}
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        self.primary = db.get_engine(app)
+        self.replica = db.get_replica_engine(app)
+        self.statements = {self.primary: [], self.replica: []}
+        for engine in self.statements:
+            event.listen(engine, "before_cursor_execute", self._record)
+        shopcart = Shopcart(user_id=101)
+        shopcart.create()
+        ShopcartItem(sid=shopcart.id, sku=5000, name="soap", price=2.23, amount=3).create()
+        self.shopcart_id = shopcart.id
+        db.session.remove()
+        self._reset()
+
+    def tearDown(self):
+        for engine in self.statements:
+            event.remove(engine, "before_cursor_execute", self._record)
+        super().tearDown()
+
+    def _record(self, conn, cursor, statement, *args):  # pylint: disable=unused-argument
+        """ Remembers which engine ran a statement """
+        self.statements[conn.engine].append(statement)
+
+    def _reset(self):
+        """ Forgets the statements run so far """
+        for statements in self.statements.values():
+            del statements[:]
+
+    def test_replica_engine(self):
+        """ Build a second engine for the replica """
+        self.assertIsNotNone(self.replica)
+        self.assertIsNot(self.replica, self.primary)
+        app.config["SQLALCHEMY_BINDS"] = {}
+        try:
+            self.assertIsNone(db.get_replica_engine(app))
+        finally:
+            app.config["SQLALCHEMY_BINDS"] = {"replica": DATABASE_URI}
+
+    def test_get_reads_from_replica(self):
+        """ Read from the replica during a GET request """
+        with app.test_request_context(method="GET"):
+            self.assertEqual(len(Shopcart.all()), 1)
+            self.assertIsNotNone(Shopcart.find(self.shopcart_id))
+            self.assertEqual(len(ShopcartItem.find_by_shopcartid(self.shopcart_id)), 1)
+            db.session.remove()
+        self.assertEqual(self.statements[self.primary], [])
+        self.assertEqual(len(self.statements[self.replica]), 3)
+
+    def test_writes_use_primary(self):
+        """ Read and write on the primary outside of GET requests """
+        with app.test_request_context(method="PUT"):
+            shopcart_item = ShopcartItem.find_by_shopcartid(self.shopcart_id)[0]
+            shopcart_item.amount = 5
+            shopcart_item.update()
+            db.session.remove()
+        with app.test_request_context(method="GET"):
+            self.assertIsNotNone(Shopcart.find(self.shopcart_id, for_update=True))
+            db.session.remove()
+        self.assertEqual(self.statements[self.replica], [])
+
+    def test_read_own_writes(self):
+        """ Stay on the primary after writing in a GET request """
+        with app.test_request_context(method="GET"):
+            Shopcart.find(self.shopcart_id)
+            Shopcart(user_id=102).create()
+            self._reset()
+            self.assertEqual(len(Shopcart.all()), 2)
+            db.session.remove()
+        self.assertEqual(self.statements[self.replica], [])
+
+    def test_commands_use_primary(self):
+        """ Read from the primary outside of requests """
+        self.assertEqual(len(Shopcart.all()), 1)
+        self.assertEqual(self.statements[self.replica], [])
+
+    def test_routes(self):
+        """ Serve the GET endpoints from the replica """
+        client = app.test_client()
+        resp = client.get("/api/shopcarts/{}/items".format(self.shopcart_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.statements[self.primary], [])
+        self.assertNotEqual(self.statements[self.replica], [])
+
+        self._reset()
+        resp = client.post("/api/shopcarts", json={"user_id": 102})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(self.statements[self.primary], [])
+        self.assertEqual(self.statements[self.replica], [])
+
+    def test_cache_filled_from_primary(self):
+        """ Cache the shopcart read from the primary, and serve it without a query """
+        shopcart_cache.clear()
+        client = app.test_client()
+        url = "/api/shopcarts/{}".format(self.shopcart_id)
+        first = client.get(url)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.statements[self.replica], [])
+        self.assertNotEqual(self.statements[self.primary], [])
+        self.assertIsNotNone(shopcart_cache.get(self.shopcart_id))
+        db.session.remove()
+
+        self._reset()
+        second = client.get(url)
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(self.statements[self.primary], [])
+        self.assertEqual(self.statements[self.replica], [])
+        db.session.remove()
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()
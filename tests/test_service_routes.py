@@ -20,16 +20,25 @@ Test cases can be run with the following:
 nosetests -v --with-spec --spec-color
 nosetests --stop tests/test_service.py:TestPetServer
 """
+import json
 import unittest
+from datetime import datetime, timedelta
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import patch, Mock
+import requests
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
 from flask_api import status  # HTTP Status Codes
 from shopcart_factory import ShopcartFactory, ShopcartItemFactory
 from service.models import Shopcart, ShopcartItem, DataValidationError, db
-from service import routes
-from service import app
+from service import routes, constants
+from service.cache import ShopcartCache, shopcart_cache
+from service.orders import OrderOutbox
+from service import create_app
 from config import DATABASE_URI
 
+app = create_app()
+
 
 ######################################################################
 #  T E S T   C A S E S
@@ -44,11 +53,19 @@ class TestShopcartServer(TestCase):
         app.testing = True
         # Set up the test database
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        cls.context = app.app_context()
+        cls.context.push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """ These run once after Test suite """
+        cls.context.pop()
 
     def setUp(self):
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
-        self.app = routes.app.test_client()
+        shopcart_cache.clear()
+        self.app = app.test_client()
 
     def tearDown(self):
         db.session.remove()
@@ -247,6 +264,124 @@ class TestShopcartServer(TestCase):
         for i, item in enumerate(shopcart_items):
             self.assertTrue(self.is_shopcart_item_same(item.serialize(), response["items"][i]))
 
+    def test_get_shopcart_from_cache(self):
+        """ Read a Shopcart a second time without loading it again """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        self._create_shopcart_items(2, shopcart_id)
+        first = self.app.get("/api/shopcarts/{}".format(shopcart_id))
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        with patch.object(Shopcart, "find") as find, \
+                patch.object(Shopcart, "find_etag") as find_etag:
+            second = self.app.get("/api/shopcarts/{}".format(shopcart_id))
+            not_modified = self.app.get("/api/shopcarts/{}".format(shopcart_id),
+                                        headers={"If-None-Match": first.headers["ETag"]})
+        find.assert_not_called()
+        find_etag.assert_not_called()
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.get_json(), first.get_json())
+
+    def test_get_shopcart_written_by_another_worker(self):
+        """ Read a Shopcart that another worker sharing the cache wrote to """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        item = self._create_shopcart_items(1, shopcart_id)[0].serialize()
+        url = "/api/shopcarts/{}".format(shopcart_id)
+        first = self.app.get(url)
+        self.assertEqual(first.get_json()["items"][0]["amount"], item["amount"])
+
+        # the other worker commits a write and starts a new generation in the shared backend
+        db.session.execute(
+            text("UPDATE shopcart_item SET amount = amount + 1, version = version + 1, "
+                 "update_time = :later WHERE id = :id"),
+            {"id": item["id"], "later": datetime.utcnow() + timedelta(seconds=1)}
+        )
+        db.session.commit()
+        ShopcartCache(shopcart_cache.backend).invalidate(shopcart_id)
+
+        second = self.app.get(url)
+        self.assertEqual(second.get_json()["items"][0]["amount"], item["amount"] + 1)
+        self.assertNotEqual(second.headers["ETag"], first.headers["ETag"])
+
+    def test_get_shopcart_after_writes(self):
+        """ Read a Shopcart after each kind of write to it """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        url = "/api/shopcarts/{}".format(shopcart_id)
+        self.assertEqual(len(self.app.get(url).get_json()["items"]), 0)
+
+        item = self._create_shopcart_items(1, shopcart_id)[0].serialize()
+        items = self.app.get(url).get_json()["items"]
+        self.assertEqual(len(items), 1)
+
+        item["amount"] = items[0]["amount"] + 5
+        resp = self.app.put("{}/items/{}".format(url, item["id"]), json=item,
+                            content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).get_json()["items"][0]["amount"], item["amount"])
+
+        resp = self.app.delete("{}/items/{}".format(url, item["id"]))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(self.app.get(url).get_json()["items"]), 0)
+
+        resp = self.app.post("{}/items:batch".format(url),
+                             json=[ShopcartItemFactory(sid=shopcart_id).serialize()],
+                             content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(self.app.get(url).get_json()["items"]), 1)
+
+        resp = self.app.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_shopcart_not_modified(self):
+        """ Read a Shopcart that the client already has """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        items = self._create_shopcart_items(2, shopcart_id)
+        url = "/api/shopcarts/{}".format(shopcart_id)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers["ETag"]
+
+        shopcart_cache.clear()
+        with patch.object(Shopcart, "find") as find:
+            resp = self.app.get(url, headers={"If-None-Match": etag})
+        find.assert_not_called()
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.data, b"")
+
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        new_item = ShopcartItemFactory(sku=max(item.sku for item in items) + 1)
+        resp = self.app.post("{}/items".format(url), json=new_item.serialize(),
+                             content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(len(resp.get_json()["items"]), 3)
+
+    def test_get_shopcart_items_not_modified(self):
+        """ List the items of a Shopcart that the client already has """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        item = self._create_shopcart_items(1, shopcart_id)[0]
+        url = "/api/shopcarts/{}/items".format(shopcart_id)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+        etag = resp.headers["ETag"]
+
+        with patch.object(ShopcartItem, "find_by_shopcartid") as find_by_shopcartid:
+            resp = self.app.get(url, headers={"If-None-Match": etag})
+        find_by_shopcartid.assert_not_called()
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        resp = self.app.delete("{}/{}".format(url, item.id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+
     def test_get_shopcart_list(self):
         """ Get a list of Shopcarts """
         shopcarts = self._create_shopcarts(5)
@@ -256,6 +391,70 @@ class TestShopcartServer(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), len(shopcart_ids))
 
+    def test_get_shopcart_list_with_items(self):
+        """ Get a list of Shopcarts with the items in each of them """
+        shopcarts = self._create_shopcarts(3)
+        shopcart_items = self._create_shopcart_items(4, shopcarts[1].id)
+        resp = self.app.get("/api/shopcarts")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 3)
+        items_by_shopcart = {shopcart["id"]: shopcart["items"] for shopcart in data}
+        self.assertEqual(len(items_by_shopcart[shopcarts[0].id]), 0)
+        self.assertEqual(len(items_by_shopcart[shopcarts[2].id]), 0)
+        returned_items = items_by_shopcart[shopcarts[1].id]
+        self.assertEqual(len(returned_items), len(shopcart_items))
+        for i, item in enumerate(shopcart_items):
+            self.assertTrue(self.is_shopcart_item_same(item.serialize(), returned_items[i]))
+
+    def test_get_shopcart_list_by_page(self):
+        """ Get a list of Shopcarts one page at a time """
+        shopcarts = self._create_shopcarts(5)
+        shopcart_ids = sorted(shopcart.id for shopcart in shopcarts)
+        resp = self.app.get("/api/shopcarts", query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([shopcart["id"] for shopcart in resp.get_json()], shopcart_ids[:2])
+        self.assertEqual(resp.headers[constants.NEXT_AFTER_ID_HEADER], str(shopcart_ids[1]))
+        self.assertIn('rel="next"', resp.headers["Link"])
+
+        resp = self.app.get(
+            "/api/shopcarts",
+            query_string="after_id={}&limit=2".format(shopcart_ids[1])
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([shopcart["id"] for shopcart in resp.get_json()], shopcart_ids[2:4])
+
+        resp = self.app.get(
+            "/api/shopcarts",
+            query_string="after_id={}&limit=2".format(shopcart_ids[3])
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([shopcart["id"] for shopcart in resp.get_json()], shopcart_ids[4:])
+        self.assertNotIn(constants.NEXT_AFTER_ID_HEADER, resp.headers)
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_shopcart_list_with_bad_limit(self):
+        """ Get a page of Shopcarts with a limit out of range """
+        resp = self.app.get("/api/shopcarts", query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(
+            "/api/shopcarts", query_string="limit={}".format(constants.MAX_PAGE_SIZE + 1)
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_shopcart_list(self):
+        """ Stream the list of Shopcarts as newline delimited JSON """
+        shopcarts = self._create_shopcarts(3)
+        self._create_shopcart_items(2, shopcarts[0].id)
+        resp = self.app.get("/api/shopcarts", query_string="stream=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, constants.NDJSON_MIMETYPE)
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        data = [json.loads(line) for line in lines]
+        listed = self.app.get("/api/shopcarts").get_json()
+        self.assertEqual(data, listed)
+
     def test_query_shopcart_list_by_user(self):
         """ Query shopcart list by User """
         shopcarts = self._create_shopcarts(10)
@@ -312,14 +511,60 @@ class TestShopcartServer(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), len(sku_shopcart_items))
 
-        resp = self.app.put(
-            "/api/shopcarts/{}/place-order".format(shopcart_id),
-            content_type="application/json",
-        )
+        with patch.object(routes.order_client.session, "post") as post:
+            post.return_value = Mock(status_code=201, text="")
+            resp = self.app.put(
+                "/api/shopcarts/{}/place-order".format(shopcart_id),
+                content_type="application/json",
+            )
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(len(resp.data), 0)
         self.assertEqual(len(Shopcart.all()), 0)
         self.assertEqual(len(ShopcartItem.all()), 0)
+        args, kwargs = post.call_args
+        self.assertEqual(args[0], app.config["ORDER_ENDPOINT"])
+        self.assertEqual(kwargs["timeout"], (app.config["ORDER_CONNECT_TIMEOUT"],
+                                             app.config["ORDER_READ_TIMEOUT"]))
+        order = json.loads(kwargs["data"])
+        self.assertEqual(len(order["order_items"]), 10)
+
+    def test_place_order_rejected(self):
+        """ Test placing an order that the Order Service rejects """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        self._create_shopcart_items(2, shopcart_id)
+        with patch.object(routes.order_client.session, "post") as post:
+            post.return_value = Mock(status_code=500, text="")
+            resp = self.app.put("/api/shopcarts/{}/place-order".format(shopcart_id))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(ShopcartItem.find_by_shopcartid(shopcart_id)), 2)
+
+    def test_place_order_timeout(self):
+        """ Test placing an order when the Order Service does not answer in time """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        self._create_shopcart_items(2, shopcart_id)
+        with patch.object(routes.order_client.session, "post") as post:
+            post.side_effect = requests.exceptions.ReadTimeout()
+            resp = self.app.put("/api/shopcarts/{}/place-order".format(shopcart_id))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIsNotNone(Shopcart.find(shopcart_id))
+
+    def test_place_order_in_outbox(self):
+        """ Test queueing an order in the outbox """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        self._create_shopcart_items(3, shopcart_id)
+        with patch.dict(app.config, ORDER_OUTBOX=True), \
+                patch.object(routes.order_client.session, "post") as post:
+            resp = self.app.put("/api/shopcarts/{}/place-order".format(shopcart_id))
+        post.assert_not_called()
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIsNone(Shopcart.find(shopcart_id))
+        self.assertEqual(ShopcartItem.find_by_shopcartid(shopcart_id), [])
+        orders = OrderOutbox.all()
+        self.assertEqual(len(orders), 1)
+        self.assertEqual(orders[0].shopcart_id, shopcart_id)
+        self.assertEqual(len(orders[0].serialize()["order"]["order_items"]), 3)
+        resp = self.app.get("/api/shopcarts/{}".format(shopcart_id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_place_order_invalid_shopcart(self):
         """ Test placing order for invalid shopcart """
@@ -471,6 +716,117 @@ class TestShopcartServer(TestCase):
             new_shopcart_item["amount"], updated_amount, "Amounts do not match"
         )
 
+    def test_create_shopcart_items_batch(self):
+        """ Create a batch of ShopcartItems with repeated skus """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        self._create_shopcart_items(1, shopcart_id)
+        existing = ShopcartItem.find_by_shopcartid(shopcart_id)[0].serialize()
+        batch = [
+            {"sku": 1, "name": "soap", "price": 2.23, "amount": 3},
+            {"sku": existing["sku"], "name": existing["name"], "price": existing["price"],
+             "amount": 2},
+            {"sku": 1, "name": "soap", "price": 2.23, "amount": 1},
+        ]
+        resp = self.app.post(
+            "/api/shopcarts/{}/items:batch".format(shopcart_id),
+            json=batch, content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual([(item["sku"], item["amount"]) for item in data],
+                         [(1, 4), (existing["sku"], existing["amount"] + 2), (1, 4)])
+        self.assertEqual(data[1]["id"], existing["id"])
+        self.assertEqual(data[2]["id"], data[0]["id"])
+        for item in data:
+            self.assertEqual(item["sid"], shopcart_id)
+        self.assertEqual(len(ShopcartItem.find_by_shopcartid(shopcart_id)), 2)
+
+    def test_create_shopcart_items_batch_with_bad_item(self):
+        """ Create a batch of ShopcartItems where one of them is not valid """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        batch = [
+            {"sku": 1, "name": "soap", "price": 2.23, "amount": 3},
+            {"sku": 2, "name": "iron", "price": 20.99, "amount": 0},
+        ]
+        resp = self.app.post(
+            "/api/shopcarts/{}/items:batch".format(shopcart_id),
+            json=batch, content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(b"Item 1", resp.data)
+        self.assertEqual(len(ShopcartItem.all()), 0)
+
+        resp = self.app.post(
+            "/api/shopcarts/{}/items:batch".format(shopcart_id),
+            json=["not an item"], content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_shopcart_items_batch_with_bad_body(self):
+        """ Create a batch of ShopcartItems that is not a list or too long """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        url = "/api/shopcarts/{}/items:batch".format(shopcart_id)
+        resp = self.app.post(url, json={"sku": 1}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(url, json=[], content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        batch = [{"sku": sku, "name": "soap", "price": 2.23, "amount": 1}
+                 for sku in range(constants.MAX_BATCH_SIZE + 1)]
+        resp = self.app.post(url, json=batch, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(ShopcartItem.all()), 0)
+
+    def test_create_shopcart_items_batch_with_non_existing_shopcart(self):
+        """ Create a batch of ShopcartItems in a Shopcart that doesn't exist """
+        resp = self.app.post(
+            "/api/shopcarts/1/items:batch",
+            json=[{"sku": 1, "name": "soap", "price": 2.23, "amount": 3}],
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_one_commit_per_request(self):
+        """ Commit the writes of a request once, at the end of it """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        commits = []
+
+        def count_commit(conn):
+            commits.append(conn)
+
+        event.listen(Engine, "commit", count_commit)
+        try:
+            resp = self.app.post(
+                "/api/shopcarts/{}/items:batch".format(shopcart_id),
+                json=[{"sku": sku, "name": "soap", "price": 2.23, "amount": 1}
+                      for sku in range(5)],
+                content_type="application/json"
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(len(commits), 1)
+
+            resp = self.app.delete("/api/shopcarts/{}".format(shopcart_id))
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertEqual(len(commits), 2)
+        finally:
+            event.remove(Engine, "commit", count_commit)
+
+    def test_failed_request_rolls_back(self):
+        """ Roll back the writes of a request that fails after making them """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        resp = self.app.get("/api/shopcarts/{}".format(shopcart_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        with patch.object(ShopcartItem, "serialize", side_effect=DataValidationError("failed")):
+            resp = self.app.post(
+                "/api/shopcarts/{}/items:batch".format(shopcart_id),
+                json=[{"sku": 1, "name": "soap", "price": 2.23, "amount": 3}],
+                content_type="application/json"
+            )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(ShopcartItem.find_by_shopcartid(shopcart_id), [])
+        # nothing was committed, so the cached shopcart is still up to date
+        self.assertIsNotNone(shopcart_cache.get(shopcart_id))
+
     def test_update_shopcart_item(self):
         """ Update an existing shopcart item """
         test_shopcart = ShopcartFactory()
@@ -547,6 +903,103 @@ class TestShopcartServer(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_update_shopcart_item_version(self):
+        """ Update a shopcart item only at the version it was read at """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        item = self._create_shopcart_items(1, shopcart_id)[0]
+        url = "/api/shopcarts/{}/items/{}".format(shopcart_id, item.id)
+        resp = self.app.get(url)
+        self.assertEqual(resp.headers["ETag"], '"1"')
+        data = resp.get_json()
+        self.assertEqual(data["version"], 1)
+
+        data["amount"] = item.amount + 10
+        resp = self.app.put(url, json=data, headers={"If-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"2"')
+        self.assertEqual(resp.get_json()["version"], 2)
+
+        # another client still holds version 1
+        data["amount"] = item.amount + 20
+        resp = self.app.put(url, json=data, headers={"If-Match": '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.put(url, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(ShopcartItem.find(item.id).amount, item.amount + 10)
+
+        resp = self.app.patch(url, json={"delta": 1}, content_type="application/json")
+        self.assertEqual(resp.headers["ETag"], '"3"')
+        # the requests share the session of the test, unlike in the service
+        db.session.expire_all()
+        data["version"] = 3
+        resp = self.app.put(url, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["amount"], item.amount + 20)
+
+        # without a version the last write wins
+        data.pop("version")
+        data["amount"] = item.amount + 30
+        resp = self.app.put(url, json=data, headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["version"], 5)
+
+    def test_update_shopcart_item_bad_version(self):
+        """ Update a shopcart item with a version that is not one """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        item = self._create_shopcart_items(1, shopcart_id)[0]
+        url = "/api/shopcarts/{}/items/{}".format(shopcart_id, item.id)
+        data = self.app.get(url).get_json()
+        for if_match in ('"one"', '"1", "2"'):
+            resp = self.app.put(url, json=data, headers={"If-Match": if_match})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, if_match)
+        data["version"] = "1"
+        resp = self.app.put(url, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_change_shopcart_item_amount(self):
+        """ Add to and remove from the amount of a shopcart item """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        item = self._create_shopcart_items(1, shopcart_id)[0]
+        url = "/api/shopcarts/{}/items/{}".format(shopcart_id, item.id)
+        self.app.get("/api/shopcarts/{}".format(shopcart_id))
+
+        resp = self.app.patch(url, json={"delta": 2}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        changed = resp.get_json()
+        self.assertEqual(changed["amount"], item.amount + 2)
+        self.assertEqual(changed["sku"], item.sku)
+        self.assertEqual(changed["id"], item.id)
+        self.assertIsNone(shopcart_cache.get(shopcart_id))
+
+        resp = self.app.patch(url, json={"delta": -1}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["amount"], item.amount + 1)
+        self.assertEqual(ShopcartItem.find(item.id).amount, item.amount + 1)
+
+        # the item is deleted once its amount drops to zero
+        resp = self.app.patch(url, json={"delta": -(item.amount + 5)},
+                              content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(ShopcartItem.find_by_shopcartid(shopcart_id), [])
+        resp = self.app.patch(url, json={"delta": 1}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_change_shopcart_item_amount_bad_request(self):
+        """ Change the amount of a shopcart item with a bad delta or in another shopcart """
+        shopcart_ids = [shopcart.id for shopcart in self._create_shopcarts(2)]
+        item = self._create_shopcart_items(1, shopcart_ids[0])[0]
+        url = "/api/shopcarts/{}/items/{}".format(shopcart_ids[0], item.id)
+        for body in ({"delta": 0}, {"delta": "1"}, {"delta": 1.5}, {"delta": True}, {}, [1]):
+            resp = self.app.patch(url, json=body, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+        resp = self.app.patch(url, data="delta=1", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+        resp = self.app.patch("/api/shopcarts/{}/items/{}".format(shopcart_ids[1], item.id),
+                              json={"delta": 1}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(ShopcartItem.find(item.id).amount, item.amount)
+
     def test_query_shopcart_item(self):
         """ Query shopcart item list without any query string """
         test_shopcart = ShopcartFactory()
@@ -637,6 +1090,147 @@ class TestShopcartServer(TestCase):
         for shopcart_item in data:
             self.assertEqual(shopcart_item["amount"], test_amount)
 
+    def test_query_shopcart_item_list_by_page(self):
+        """ Query shopcart item list one page at a time """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        shopcart_items = self._create_shopcart_items(5, shopcart_id)
+        item_ids = sorted(shopcart_item.id for shopcart_item in shopcart_items)
+        resp = self.app.get("/api/shopcarts/items", query_string="limit=3")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([item["id"] for item in resp.get_json()], item_ids[:3])
+        after_id = resp.headers[constants.NEXT_AFTER_ID_HEADER]
+        resp = self.app.get(
+            "/api/shopcarts/items", query_string="after_id={}&limit=3".format(after_id)
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([item["id"] for item in resp.get_json()], item_ids[3:])
+        self.assertNotIn(constants.NEXT_AFTER_ID_HEADER, resp.headers)
+
+    def test_stream_shopcart_item_list(self):
+        """ Stream the shopcart item list as newline delimited JSON """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        self._create_shopcart_items(4, shopcart_id)
+        resp = self.app.get("/api/shopcarts/items", query_string="stream=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, constants.NDJSON_MIMETYPE)
+        data = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(data, self.app.get("/api/shopcarts/items").get_json())
+
+    def _create_items(self, shopcart_id, *items):
+        """ Creates shopcart items from (sku, name, price, amount) tuples """
+        for sku, name, price, amount in items:
+            ShopcartItem(sid=shopcart_id, sku=sku, name=name, price=price,
+                         amount=amount).create()
+
+    def test_query_shopcart_item_list_by_page_with_filter(self):
+        """ Query shopcart item list by name one page at a time """
+        shopcart_ids = [shopcart.id for shopcart in self._create_shopcarts(2)]
+        for shopcart_id in shopcart_ids:
+            self._create_items(shopcart_id, (1000, "soap", 2.39, 1), (2000, "iron", 20.99, 1),
+                               (3000, "soap", 5.99, 2))
+        resp = self.app.get("/api/shopcarts/items", query_string="name=soap&limit=3")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([item["sku"] for item in resp.get_json()], [1000, 3000, 1000])
+        self.assertIn("name=soap", resp.headers["Link"])
+        after_id = resp.headers[constants.NEXT_AFTER_ID_HEADER]
+        resp = self.app.get("/api/shopcarts/items",
+                            query_string="name=soap&limit=3&after_id={}".format(after_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([(item["sid"], item["sku"]) for item in resp.get_json()],
+                         [(shopcart_ids[1], 3000)])
+
+    def test_query_shopcart_item_list_with_combined_filters(self):
+        """ Query shopcart item list by several attributes at once """
+        shopcart_ids = [shopcart.id for shopcart in self._create_shopcarts(2)]
+        for shopcart_id in shopcart_ids:
+            self._create_items(shopcart_id, (1000, "soap", 2.39, 1), (2000, "iron", 20.99, 3),
+                               (3000, "boots", 45.99, 2), (4000, "laptop", 999.99, 5))
+        resp = self.app.get("/api/shopcarts/items", query_string={
+            "sid": shopcart_ids[1], "min_price": 10, "max_price": 100, "max_amount": 3,
+            "sort": "-price"
+        })
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([item["sku"] for item in data], [3000, 2000])
+        self.assertTrue(all(item["sid"] == shopcart_ids[1] for item in data))
+
+        resp = self.app.get("/api/shopcarts/items",
+                            query_string={"min_amount": 2, "sku": 2000, "price": 20.99})
+        self.assertEqual(len(resp.get_json()), 2)
+
+        resp = self.app.get("/api/shopcarts/items", query_string="sort=-amount&limit=3")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([item["amount"] for item in resp.get_json()], [5, 5, 3])
+        self.assertNotIn(constants.NEXT_AFTER_ID_HEADER, resp.headers)
+
+    def test_query_shopcart_item_list_by_update_time(self):
+        """ Query shopcart item list by a window of update times """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        self._create_items(shopcart_id, (1000, "soap", 2.39, 1), (2000, "iron", 20.99, 3))
+        old_item = ShopcartItem.find_by_sku_and_sid(1000, shopcart_id)
+        old_item.update_time = datetime(2020, 11, 1, 12, 0, 0)
+        db.session.commit()
+
+        resp = self.app.get("/api/shopcarts/items",
+                            query_string="updated_before=2020-11-01T13:00:00Z")
+        self.assertEqual([item["sku"] for item in resp.get_json()], [1000])
+        resp = self.app.get("/api/shopcarts/items",
+                            query_string="updated_after=2020-11-01T08:00:00-04:00")
+        self.assertEqual([item["sku"] for item in resp.get_json()], [1000, 2000])
+        resp = self.app.get("/api/shopcarts/items",
+                            query_string="updated_after=2020-11-01T12:00:01")
+        self.assertEqual([item["sku"] for item in resp.get_json()], [2000])
+
+    def test_get_shopcart_summary(self):
+        """ Get the totals of a Shopcart """
+        shopcart_ids = [shopcart.id for shopcart in self._create_shopcarts(2)]
+        self._create_items(shopcart_ids[0], (1000, "soap", 2.39, 3), (2000, "iron", 20.99, 1))
+        resp = self.app.get("/api/shopcarts/{}/summary".format(shopcart_ids[0]))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["id"], shopcart_ids[0])
+        self.assertAlmostEqual(data["subtotal"], 28.16)
+        self.assertEqual(data["lines"], 2)
+        self.assertEqual(data["units"], 4)
+
+        resp = self.app.get("/api/shopcarts/{}/summary".format(shopcart_ids[1]))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual((data["subtotal"], data["lines"], data["units"]), (0, 0, 0))
+
+        resp = self.app.get("/api/shopcarts/{}/summary".format(shopcart_ids[1] + 1))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_sku_stats(self):
+        """ Get the most popular skus """
+        shopcart_ids = [shopcart.id for shopcart in self._create_shopcarts(3)]
+        self._create_items(shopcart_ids[0], (1000, "soap", 2.39, 3), (2000, "iron", 20.99, 1))
+        self._create_items(shopcart_ids[1], (1000, "soap", 2.39, 2), (3000, "laptop", 999.99, 1))
+        self._create_items(shopcart_ids[2], (2000, "iron", 20.99, 2))
+        resp = self.app.get("/api/shopcarts/items/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([(row["sku"], row["units"], row["shopcarts"]) for row in data],
+                         [(1000, 5, 2), (2000, 3, 2), (3000, 1, 1)])
+        self.assertEqual(data[0]["name"], "soap")
+        self.assertAlmostEqual(data[0]["revenue"], 11.95)
+
+        resp = self.app.get("/api/shopcarts/items/stats", query_string="sort=revenue&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["sku"] for row in resp.get_json()], [3000, 2000])
+
+        resp = self.app.get("/api/shopcarts/items/stats", query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/api/shopcarts/items/stats", query_string="sort=name")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_shopcart_item_list_with_bad_sort(self):
+        """ Query shopcart item list with a sort that is not supported """
+        resp = self.app.get("/api/shopcarts/items", query_string="sort=password")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/api/shopcarts/items", query_string="sort=price&after_id=3")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_shopcart_items(self):
         """ Find shopcart items list by shopcart id """
         shopcart = self._create_shopcarts(1)
@@ -675,6 +1269,30 @@ class TestShopcartServer(TestCase):
 
         self.assertEqual(len(ShopcartItem.all()), 0)
 
+    def test_delete_a_stale_shopcart_item(self):
+        """ Refuse to delete a Shopcart Item that was written while it was being deleted """
+        shopcart_id = self._create_shopcarts(1)[0].id
+        item_id = self._create_shopcart_items(1, shopcart_id)[0].id
+        find = ShopcartItem.find
+
+        def find_then_write(*args, **kwargs):
+            # another request writes the item right after it was read
+            found = find(*args, **kwargs)
+            with db.engine.begin() as conn:
+                conn.execute(text("UPDATE shopcart_item SET version = version + 1 "
+                                  "WHERE id = :id"), id=item_id)
+            return found
+
+        url = "/api/shopcarts/{}/items/{}".format(shopcart_id, item_id)
+        with patch.object(ShopcartItem, "find", side_effect=find_then_write):
+            resp = self.app.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(len(ShopcartItem.all()), 1)
+
+        resp = self.app.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(ShopcartItem.all(), [])
+
     def test_post_request_without_content_type(self):
         """POST Request Without content_type"""
         resp = self.app.post("/api/shopcarts")
@@ -0,0 +1,323 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the sharding of the shopcarts
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from sqlalchemy import event, text
+from flask_api import status  # HTTP Status Codes
+from service.models import Shopcart, ShopcartItem, db
+from service.orders import OrderOutbox
+from service.sharding import ShardMap, shard_count
+from service import create_app, commands
+
+app = create_app()
+
+# users whose shopcarts go to shard 0 and to shard 1
+SHARD_0_USERS = (4, 5, 6)
+SHARD_1_USERS = (1, 2, 3)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestShardMap(unittest.TestCase):
+    """ Test Cases for the shard map """
+
+    def test_for_id(self):
+        """ Find the shard of an id """
+        shards = ShardMap(3)
+        self.assertEqual([shards.for_id(row_id) for row_id in range(1, 7)], [1, 2, 0, 1, 2, 0])
+
+    def test_for_user(self):
+        """ Spread the users over the shards """
+        shards = ShardMap(2)
+        self.assertEqual({shards.for_user(user_id) for user_id in SHARD_0_USERS}, {0})
+        self.assertEqual({shards.for_user(user_id) for user_id in SHARD_1_USERS}, {1})
+        self.assertEqual(ShardMap(1).for_user(12345), 0)
+
+    def test_next_id(self):
+        """ Hand out the ids of a shard in order """
+        shards = ShardMap(3)
+        self.assertEqual(shards.next_id(None, 0), 3)
+        self.assertEqual(shards.next_id(None, 1), 1)
+        self.assertEqual(shards.next_id(1, 1), 4)
+        self.assertEqual(shards.next_id(7, 2), 8)
+        self.assertEqual(ShardMap(1).next_id(41, 0), 42)
+
+    def test_shard_count(self):
+        """ Count the shards in the binds """
+        self.assertEqual(shard_count({}), 1)
+        self.assertEqual(shard_count({"SQLALCHEMY_BINDS": {"replica": "x"}}), 1)
+        self.assertEqual(shard_count({"SQLALCHEMY_BINDS": {"shard1": "x", "shard2": "y"}}), 3)
+
+
+class TestSharding(unittest.TestCase):
+    """ Test Cases for shopcarts spread over two databases """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once before Test suite """
+        app.debug = False
+        app.testing = True
+        # Set up two SQLite databases, whatever database the other tests use
+        cls.directory = tempfile.mkdtemp()
+        uris = ["sqlite:///" + os.path.join(cls.directory, "shard{}.db".format(shard))
+                for shard in range(2)]
+        app.config["SQLALCHEMY_DATABASE_URI"] = uris[0]
+        app.config["SQLALCHEMY_BINDS"] = {"shard1": uris[1]}
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {}
+        cls.context = app.app_context()
+        cls.context.push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """ These run once after Test suite """
+        cls.context.pop()
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        self.engines = db.get_shard_engines()
+        self.statements = {engine: [] for engine in self.engines}
+        for engine in self.engines:
+            event.listen(engine, "before_cursor_execute", self._record)
+
+    def tearDown(self):
+        for engine in self.engines:
+            event.remove(engine, "before_cursor_execute", self._record)
+        db.session.remove()
+        db.drop_all()
+
+    def _record(self, conn, cursor, statement, *args):  # pylint: disable=unused-argument
+        """ Remembers which shard ran a statement """
+        self.statements[conn.engine].append(statement)
+
+    def _reset(self):
+        """ Forgets the statements run so far """
+        for statements in self.statements.values():
+            del statements[:]
+
+    def _shards_used(self):
+        """ Returns the shards that ran a statement since the last reset """
+        return [shard for shard, engine in enumerate(self.engines) if self.statements[engine]]
+
+    def _ids_in_shard(self, shard, table):
+        """ Returns the ids of the rows a shard holds in a table """
+        rows = self.engines[shard].execute(text("SELECT id FROM {} ORDER BY id".format(table)))
+        return [row[0] for row in rows]
+
+    def _create_shopcart(self, user_id, skus=(1000,)):
+        """ Creates a shopcart of a user with an item for each sku """
+        shopcart = Shopcart(user_id=user_id)
+        shopcart.create()
+        for sku in skus:
+            ShopcartItem(sid=shopcart.id, sku=sku, name="soap", price=sku / 1000,
+                         amount=1).create()
+        return shopcart
+
+    def test_create_on_user_shard(self):
+        """ Store each shopcart and its items on the shard of its user """
+        for user_id in SHARD_0_USERS + SHARD_1_USERS:
+            self._create_shopcart(user_id, skus=(1000, 2000))
+        self.assertEqual(self._ids_in_shard(0, "shopcart"), [2, 4, 6])
+        self.assertEqual(self._ids_in_shard(1, "shopcart"), [1, 3, 5])
+        self.assertEqual(self._ids_in_shard(0, "shopcart_item"), [2, 4, 6, 8, 10, 12])
+        self.assertEqual(self._ids_in_shard(1, "shopcart_item"), [1, 3, 5, 7, 9, 11])
+        for shopcart in Shopcart.all():
+            self.assertEqual(shopcart.id % 2, db.shards.for_user(shopcart.user_id))
+            for item in shopcart.items:
+                self.assertEqual(item.id % 2, shopcart.id % 2)
+
+    def test_find_on_one_shard(self):
+        """ Find a shopcart and its items on their shard only """
+        shopcart = self._create_shopcart(SHARD_1_USERS[0])
+        item_id = shopcart.items[0].id
+        db.session.remove()
+        self._reset()
+
+        shopcart = Shopcart.find(shopcart.id)
+        self.assertEqual(shopcart.user_id, SHARD_1_USERS[0])
+        self.assertEqual(len(shopcart.items), 1)
+        self.assertEqual(ShopcartItem.find(item_id).sku, 1000)
+        self.assertEqual(len(ShopcartItem.find_by_shopcartid(shopcart.id)), 1)
+        self.assertIsNotNone(ShopcartItem.find_by_sku_and_sid(1000, shopcart.id))
+        self.assertIsNotNone(Shopcart.find_etag(shopcart.id))
+        self.assertEqual(Shopcart.summarize(shopcart.id)["lines"], 1)
+        self.assertEqual(Shopcart.find_by_user(SHARD_1_USERS[0]).count(), 1)
+        self.assertEqual(self._shards_used(), [1])
+        self.assertIsNone(Shopcart.find(shopcart.id + 2))
+
+    def test_write_on_one_shard(self):
+        """ Update, add and delete on the shard of the shopcart only """
+        shopcart = self._create_shopcart(SHARD_0_USERS[0])
+        self._create_shopcart(SHARD_1_USERS[0])
+        self._reset()
+
+        item = ShopcartItem.find_by_shopcartid(shopcart.id)[0]
+        item.amount = 5
+        item.update()
+        ShopcartItem(sid=shopcart.id, sku=1000, name="soap", price=1.0, amount=2).add()
+        items = ShopcartItem.add_all(shopcart.id, [
+            ShopcartItem(sku=3000, name="iron", price=3.0, amount=1),
+            ShopcartItem(sku=3000, name="iron", price=3.0, amount=1),
+        ])
+        self.assertEqual(items[0].amount, 2)
+        self.assertEqual(items[0].id % 2, 0)
+        Shopcart.find(shopcart.id).delete()
+        self.assertEqual(self._shards_used(), [0])
+        self.assertEqual(self._ids_in_shard(0, "shopcart_item"), [])
+        self.assertEqual(len(ShopcartItem.all()), 1)
+
+    def test_all_merges_shards(self):
+        """ List every shopcart and item in id order """
+        for user_id in (SHARD_1_USERS[0], SHARD_0_USERS[0], SHARD_1_USERS[1], SHARD_0_USERS[1]):
+            self._create_shopcart(user_id, skus=(1000, 3000))
+        db.session.remove()
+        self._reset()
+
+        self.assertEqual([shopcart.id for shopcart in Shopcart.all()], [1, 2, 3, 4])
+        self.assertEqual(self._shards_used(), [0, 1])
+        shopcarts = Shopcart.all_with_items()
+        self.assertEqual([len(shopcart.items) for shopcart in shopcarts], [2, 2, 2, 2])
+        self.assertEqual([item.id for item in ShopcartItem.all()], list(range(1, 9)))
+        self.assertEqual(ShopcartItem.query.count(), 8)
+        page = Shopcart.find_page_with_items(1, 2)
+        self.assertEqual([shopcart.id for shopcart in page], [2, 3])
+        self.assertEqual([len(shopcart.items) for shopcart in page], [2, 2])
+        self.assertEqual([shopcart.id for shopcart in Shopcart.stream_with_items(3)],
+                         [1, 2, 3, 4])
+        self.assertEqual([item.id for item in ShopcartItem.find_by_filters().yield_per(2)],
+                         list(range(1, 9)))
+
+    def test_fan_out_reuses_executor(self):
+        """ Run every fan-out query on the same thread pool """
+        self._create_shopcart(SHARD_1_USERS[0], skus=(1000,))
+        self._create_shopcart(SHARD_0_USERS[0], skus=(2000,))
+        executor = db.get_shard_executor()
+        with patch.object(executor, "map", wraps=executor.map) as executor_map:
+            self.assertEqual(len(Shopcart.all()), 2)
+            self.assertEqual(len(ShopcartItem.all()), 2)
+        self.assertEqual(executor_map.call_count, 2)
+        self.assertIs(db.get_shard_executor(), executor)
+        self.assertEqual(executor._max_workers, 2)  # pylint: disable=protected-access
+
+    def test_filters_merge_shards(self):
+        """ Sort and limit the items of every shard together """
+        self._create_shopcart(SHARD_1_USERS[0], skus=(1000, 4000))
+        self._create_shopcart(SHARD_0_USERS[0], skus=(2000, 3000))
+        items = ShopcartItem.find_by_filters(sort="-price").limit(3).all()
+        self.assertEqual([item.sku for item in items], [4000, 3000, 2000])
+        items = ShopcartItem.find_by_filters(sort="price", min_price=1.5).offset(1).all()
+        self.assertEqual([item.sku for item in items], [3000, 4000])
+        self.assertEqual([item.sku for item in ShopcartItem.find_by_filters(sku=3000)], [3000])
+
+        self._reset()
+        items = ShopcartItem.find_by_filters(sid=2).all()
+        self.assertEqual([item.sku for item in items], [2000, 3000])
+        self.assertEqual(self._shards_used(), [0])
+
+    def test_sku_stats_add_up_shards(self):
+        """ Add up the stats of a sku found in every shard """
+        self._create_shopcart(SHARD_1_USERS[0], skus=(1000, 2000))
+        self._create_shopcart(SHARD_0_USERS[0], skus=(1000,))
+        stats = ShopcartItem.sku_stats(1)
+        self.assertEqual(stats, [{"sku": 1000, "name": "soap", "units": 2, "revenue": 2.0,
+                                  "shopcarts": 2}])
+        stats = ShopcartItem.sku_stats(5, "revenue")
+        self.assertEqual([stat["sku"] for stat in stats], [1000, 2000])
+
+    def test_purge_every_shard(self):
+        """ Purge the abandoned shopcarts of every shard """
+        for user_id in (SHARD_1_USERS[0], SHARD_0_USERS[0]):
+            shopcart = self._create_shopcart(user_id)
+            shopcart.update_time = datetime.utcnow() - timedelta(hours=3)
+            shopcart.items[0].update_time = shopcart.update_time
+            db.session.commit()
+        recent = self._create_shopcart(SHARD_0_USERS[1])
+        self.assertEqual(Shopcart.purge_expired(datetime.utcnow() - timedelta(hours=2), 10),
+                         (2, 2))
+        self.assertEqual([shopcart.id for shopcart in Shopcart.all()], [recent.id])
+
+    def test_outbox_on_shard(self):
+        """ Keep the order of a shopcart on its shard """
+        shopcart = self._create_shopcart(SHARD_1_USERS[0])
+        outbox = OrderOutbox.enqueue(shopcart, {"customer_id": SHARD_1_USERS[0]})
+        self.assertEqual(outbox.id % 2, 1)
+        self.assertEqual(self._ids_in_shard(1, "shopcart"), [])
+        due = OrderOutbox.find_next_due(datetime.utcnow() + timedelta(seconds=1))
+        self.assertEqual(due.id, outbox.id)
+        due.sent()
+        db.session.commit()
+        self.assertEqual(self._ids_in_shard(1, "order_outbox"), [])
+
+    def test_init_db(self):
+        """ Create the tables of every shard """
+        db.drop_all()
+        result = app.test_cli_runner().invoke(commands.init_db_command)
+        self.assertEqual(result.exit_code, 0)
+        for shard in range(2):
+            self.assertEqual(self._ids_in_shard(shard, "shopcart"), [])
+
+    def test_routes(self):
+        """ Serve shopcarts stored on both shards """
+        client = app.test_client()
+        ids = []
+        for user_id in (SHARD_1_USERS[0], SHARD_0_USERS[0]):
+            resp = client.post("/api/shopcarts", json={"user_id": user_id})
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            ids.append(resp.get_json()["id"])
+            resp = client.post("/api/shopcarts/{}/items".format(ids[-1]), json={
+                "sid": ids[-1], "sku": 1000, "name": "soap", "price": 2.5, "amount": 2
+            })
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ids, [1, 2])
+
+        resp = client.get("/api/shopcarts/2")
+        self.assertEqual(resp.get_json()["user_id"], SHARD_0_USERS[0])
+        self.assertEqual(len(resp.get_json()["items"]), 1)
+        resp = client.get("/api/shopcarts")
+        self.assertEqual([shopcart["id"] for shopcart in resp.get_json()], [1, 2])
+        resp = client.get("/api/shopcarts/items", query_string={"sort": "-id"})
+        self.assertEqual([item["sid"] for item in resp.get_json()], [2, 1])
+        resp = client.delete("/api/shopcarts/1")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(client.get("/api/shopcarts/1").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_instrumentation_counts_every_shard(self):
+        """ Count the queries that fan out to other threads """
+        for user_id in (SHARD_1_USERS[0], SHARD_0_USERS[0]):
+            Shopcart(user_id=user_id).create()
+        app.config["INSTRUMENTATION"] = True
+        try:
+            resp = app.test_client().get("/api/shopcarts/items")
+        finally:
+            app.config["INSTRUMENTATION"] = False
+        self.assertIn('desc="2 queries"', resp.headers["Server-Timing"])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    unittest.main()